@@ -16,10 +16,12 @@
 #
 
 import os
+import sqlite3
 from logging import getLogger
 
-from PyQt5.QtCore import QTimer, pyqtSlot, QPoint
-from PyQt5.QtGui import QIcon, QStandardItem
+from PyQt5.QtCore import QTimer, Qt, pyqtSignal, pyqtSlot, QPoint, \
+    QRunnable, QThreadPool
+from PyQt5.QtGui import QIcon, QStandardItem, QStandardItemModel
 from PyQt5.QtWidgets import QMenu
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -29,6 +31,7 @@ from campaign.note import Note, InternalNote
 from core import filters, archive
 from core.archive import ArchiveMeta
 from core.config import TMP_PATH
+from core.async import mtexec
 from core.controller import QtController
 from model import GameBase, CampaignBase
 from model.tree import FixedNode, TableNode, TreeModel, BadNode
@@ -43,6 +46,99 @@ from ui.search import SearchCompleter
 log = getLogger(__name__)
 
 
+def snapshot_database(src, dst, progress=None, pages=256):
+    """
+    Copy the SQLite database at ``src`` to ``dst`` with SQLite's online
+    backup API. The copy is a consistent snapshot, even if ``src`` is being
+    written to all the while: the backup starts over if it is.
+
+    :param progress: An optional function of the number of bytes copied so
+                     far, and the total.
+    :param pages: The number of pages to copy at a time, between which other
+                  connections may write to the database.
+    """
+    source = sqlite3.connect(src)
+    try:
+        page_size = source.execute("PRAGMA page_size").fetchone()[0]
+        callback = None
+        if progress is not None:
+            def callback(_, remaining, total):
+                progress((total - remaining) * page_size, total * page_size)
+        destination = sqlite3.connect(dst)
+        try:
+            source.backup(destination, pages=pages, progress=callback)
+        finally:
+            destination.close()
+    finally:
+        source.close()
+
+
+class SaveCampaignTask(QRunnable):
+    """
+    Saves a campaign's working directory to its archive in the background,
+    so that it can still be edited meanwhile. The campaign database is
+    snapshotted first (see ``snapshot_database()``), and it is the snapshot
+    that is archived.
+
+    Like ``ExtractCampaignTask``, it has a ``result`` (the archive path) or
+    an ``exception`` once ``done_cb`` is called.
+    """
+
+    def __init__(self, meta, src, database, dst, snapshot, incremental,
+                 cb, done_cb, codec=archive.DEFAULT_CODEC):
+        """
+        :param meta: The ``ArchiveMeta`` to save.
+        :param src: The working directory to save.
+        :param database: The path of the campaign database, within ``src``.
+        :param dst: The path of the archive to save to.
+        :param snapshot: A path (outside of ``src``) to snapshot the
+                         campaign database to.
+        :param incremental: Only write what has changed since ``dst`` was
+                            saved (see ``archive.update_archive()``).
+        :param cb: Called with the name of the stage the save is at, and the
+                   number of bytes of it done and in total.
+        :param done_cb: Called once the save is over.
+        :param codec: The codec to compress the archive with (see
+                      ``archive.CODECS``).
+        """
+        super().__init__()
+        self.meta = meta
+        self.src = src
+        self.database = database
+        self.dst = dst
+        self.snapshot = snapshot
+        self.incremental = incremental
+        self.cb = cb
+        self.done_cb = done_cb
+        self.codec = codec
+        self.result = None
+        self.exception = None
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            snapshot_database(
+                self.database, self.snapshot,
+                lambda done, total: self.cb("snapshot", done, total))
+            name = os.path.relpath(self.database, self.src)
+            files = {name.replace(os.sep, '/'): self.snapshot}
+            save = archive.update_archive if self.incremental \
+                else archive.export
+            save(self.meta, self.src, self.dst, files=files,
+                 progress=lambda done, total: self.cb("archive", done, total),
+                 codec=self.codec)
+            self.result = self.dst
+        except Exception as e:
+            log.exception("failed to save campaign to `%s'", self.dst)
+            self.exception = e
+        finally:
+            try:
+                os.remove(self.snapshot)
+            except OSError:
+                pass
+        self.done_cb()
+
+
 class SearchController(QtController):
     """
     .. todo::
@@ -50,13 +146,25 @@ class SearchController(QtController):
         followed the general pattern of ``spawn_view()``.
 
     """
+    # Emitted (from Delphi's thread) with each search response.
+    search_results_received = pyqtSignal(object)
+    # Likewise, for each response to a completion request.
+    completions_received = pyqtSignal(object)
+    # Likewise, whenever the oracle publishes its indexing metrics.
+    indexing_progress = pyqtSignal(object)
+
     def __init__(self, delphi, completer, interval_msec=250):
         super().__init__()
         self._delphi = delphi
         delphi.responder = self
+        self.completer = completer
+        self.search_results_received.connect(self.on_search_results_updated)
+        self.completions_received.connect(self.on_completions_received)
+        self.indexing_progress.connect(self.on_indexing_progress)
 
         self._update_delay = interval_msec
         self.search_query = ""
+        self.results_model = None
 
         self._timer = QTimer()
         self._timer.setInterval(interval_msec)
@@ -111,8 +219,26 @@ class SearchController(QtController):
         self.search_query = text
         if not text:
             return
+        # Completion is answered straight from memory by the oracle, so it
+        # is not worth debouncing like searches are.
+        word = self.completer.last_word(text)
+        if word and self._delphi.enabled:
+            self._delphi.complete(word)
         self._timer.start()
 
+    @pyqtSlot(object)
+    def on_completions_received(self, response):
+        if self.completer.last_word(self.search_query) != response["prefix"]:
+            return
+        self.completer.set_completions(self.search_query,
+                                       response["completions"])
+
+    @pyqtSlot(object)
+    def on_indexing_progress(self, progress):
+        popup = getattr(self, "results_popup", None)
+        if popup is not None:
+            popup.set_indexing_progress(progress)
+
     @pyqtSlot()
     def on_search_requested(self):
         if not self._delphi.enabled:
@@ -122,11 +248,30 @@ class SearchController(QtController):
         self._timer.stop()
         self._delphi.search_query(self.search_query)
 
-    @pyqtSlot()
+    @pyqtSlot(object)
     def on_search_results_updated(self, results):
         log.debug("SearchController received search results!")
-        model = self._build_results_model(results)
-        self.results_popup.setModel(model)
+        # Kept so that a popup can show the latest results once it exists.
+        self.results_model = self._build_results_model(results)
+        popup = getattr(self, "results_popup", None)
+        if popup is not None:
+            popup.setModel(self.results_model)
+
+    @staticmethod
+    def _build_results_model(response):
+        model = QStandardItemModel()
+        for result in response["results"]:
+            notes = result.get("notes") or [result["note"]]
+            text = "Note{} {}".format("s" if len(notes) > 1 else "",
+                                      ", ".join(str(n) for n in notes))
+            if result["page"] is not None:
+                text += ", page {}".format(result["page"] + 1)
+            item = QStandardItem(text)
+            item.setToolTip(result["snippet"])
+            item.setData(result, Qt.UserRole)
+            item.setEditable(False)
+            model.appendRow(item)
+        return model
 
     def set_search_results(self, results):
         model = self.model
@@ -157,6 +302,7 @@ class NoteController(QtController):
 
     def item_doubleclicked(self, node):
         # FIXME this is incrensely hacky.
+        self._cc.delphi.notes_opened([node.id])
         db = self._cc.db()
         try:
             item = db.query(InternalNote).filter(Note.id == node.id)[0]
@@ -177,12 +323,13 @@ class NoteController(QtController):
     @pyqtSlot()
     def on_new_document(self):
         base_note = Note(name="Untitled", author=self._cc.campaign.author)
-        internal_note = InternalNote(note_id=base_note.id,
-                                     text="New note...")
         db = self._cc.db()
         db.add(base_note)
-        db.add(internal_note)
+        # The note needs an id before its text can refer to it.
+        db.flush()
+        db.add(InternalNote(note_id=base_note.id, text="New note..."))
         db.commit()
+        self._cc.delphi.notes_changed()
         self.tree_node.update()
 
     @pyqtSlot()
@@ -200,11 +347,12 @@ class NoteController(QtController):
         else:
             base_note = Note(name=os.path.basename(path),
                              author=self._cc.campaign.author)
-            note = InternalNote(text=contents)
             db = self._cc.db()
             db.add(base_note)
-            db.add(note)
+            db.flush()
+            db.add(InternalNote(note_id=base_note.id, text=contents))
             db.commit()
+            self._cc.delphi.notes_changed()
             self.tree_node.update()
 
     @pyqtSlot()
@@ -223,6 +371,7 @@ class NoteController(QtController):
             db = self._cc.db()
             db.add(note)
             db.commit()
+            self._cc.delphi.notes_changed()
             self.tree_node.update()
         except OSError as e:
             log.error("could not open note: %s", e)
@@ -288,11 +437,21 @@ class CampaignController(QtController):
     to be handled externally, e.g. by the ``AppController`` or test harnesses.
     """
 
-    def __init__(self, delphi, campaign, archive_meta=None):
+    # Saving is fast, for when the campaign is saved every few minutes, while
+    # "Save As" compresses harder, as it makes a copy to pass around.
+    save_codec = "zlib"
+    save_as_codec = "lzma"
+
+    def __init__(self, delphi, campaign, archive_meta=None, thread_pool=None):
+        """
+        :param thread_pool: The ``QThreadPool`` to save the campaign on.
+        """
         super().__init__(None)
         self.delphi = delphi
         self.campaign = campaign
         self.archive_meta = archive_meta
+        self.thread_pool = thread_pool or QThreadPool.globalInstance()
+        self.save_task = None
 
         self.dirty = True
 
@@ -349,6 +508,10 @@ class CampaignController(QtController):
 
     @staticmethod
     def xapian_database_path(campaign):
+        """
+        The oracle's index outlives the extracted archive, and is reused the
+        next time the campaign is opened.
+        """
         return os.path.join(CampaignController.working_directory(campaign),
                             "oracle")
 
@@ -368,6 +531,7 @@ class CampaignController(QtController):
         v.save_campaign.triggered.connect(self.on_sync_campaign)
         v.save_campaign_as.triggered.connect(self.on_save_campaign_as)
 
+        v.searchEdit.setCompleter(sc.completer)
         v.searchEdit.textChanged.connect(sc.on_search_text_changed)
         v.searchEdit.returnPressed.connect(sc.on_search_requested)
 
@@ -379,6 +543,13 @@ class CampaignController(QtController):
 
         v.campaign_properties.triggered.connect(self.on_campaign_properties)
 
+        self.delphi.entity_names("pin", self.map_pin_names())
+
+    def map_pin_names(self):
+        """:return: The name of every pin on every map in the campaign."""
+        return [entity.name for map_ in self.campaign.regional_maps.values()
+                for layer in map_.layers for entity in layer.objects]
+
     def build_asset_tree(self):
         root = FixedNode(*[controller.tree_node for controller in
                            [self.map_controller, self.session_controller,
@@ -425,13 +596,10 @@ class CampaignController(QtController):
                                        "been moved or deleted.\n\nPlease "
                                        "select a new location to save this "
                                        "archive.")
-            path = self._save_campaign_as()
-            if not path:
-                return
-        self._sync_archive_meta(path)
-        archive.export(self.archive_meta,
-                       CampaignController.extracted_archive_path(self.campaign),
-                       am.last_seen_path)
+            self._save_campaign_as()
+            return
+        # Only what has changed since the last save is written.
+        self.save(path, incremental=True)
 
     @pyqtSlot()
     def on_save_campaign_as(self):
@@ -457,16 +625,50 @@ class CampaignController(QtController):
                                  filter_=filters.campaign)
         if not path:
             return
-        try:
-            self._sync_archive_meta(path)
-            archive.export(self.archive_meta,
-                           CampaignController.extracted_archive_path(self.campaign),
-                           path)
-        except OSError as e:
-            log.error("could not export campaign: %s", e)
-        else:
+        if self.save(path, incremental=False):
             return path
 
+    def save(self, path, incremental):
+        """
+        Save the campaign to the archive at ``path`` on the thread pool.
+
+        :return: ``False`` if a save is already in progress.
+        """
+        if self.save_task is not None:
+            self.view.statusbar.showMessage("The campaign is already being "
+                                            "saved.")
+            return False
+        self._sync_archive_meta(path)
+        campaign = self.campaign
+        task = self.save_task = SaveCampaignTask(
+            self.archive_meta, self.extracted_archive_path(campaign),
+            self.database_path(campaign), path,
+            os.path.join(self.working_directory(campaign), "campaign.db.save"),
+            incremental, mtexec(self.on_save_progress),
+            mtexec(self.on_save_done),
+            self.save_codec if incremental else self.save_as_codec)
+        self.view.statusbar.showMessage("Saving campaign...")
+        self.thread_pool.start(task)
+        return True
+
+    def on_save_progress(self, stage, done, total):
+        if self.save_task is None:
+            return
+        percent = 100 * done // total if total else 100
+        text = "Copying the campaign database... {}%" if stage == "snapshot" \
+            else "Saving campaign... {}%"
+        self.view.statusbar.showMessage(text.format(percent))
+
+    def on_save_done(self):
+        task, self.save_task = self.save_task, None
+        if task.exception is not None:
+            self.view.statusbar.clearMessage()
+            display_error(self.view, "The campaign could not be saved:\n\n"
+                                     "{}".format(task.exception))
+            return
+        self.view.statusbar.showMessage("Saved campaign to `{}'.".format(
+            task.result), 5000)
+
     def _sync_archive_meta(self, path):
         campaign = self.campaign
         self.archive_meta = ArchiveMeta(campaign.id,
@@ -23,7 +23,7 @@ import os
 from datetime import datetime
 from urllib.parse import urlparse
 
-from sqlalchemy import Column, String, ForeignKey, Integer
+from sqlalchemy import Column, DDL, String, ForeignKey, Integer, event
 
 from model import GameBase
 
@@ -53,3 +53,47 @@ class InternalNote(GameBase):
     id = Column(Integer, primary_key=True)
     note_id = Column(Integer, ForeignKey('note.id'))
     text = Column(String)
+
+
+class NoteChange(GameBase):
+    """
+    A change-log of the ``note`` and ``internal_note`` tables. Rows are only
+    ever written by the SQLite triggers below, never by dmclient itself, so
+    that every commit (regardless of where it comes from) is captured.
+
+    ``seq`` increases monotonically and is never reused, which allows the
+    oracle to consume only the changes it has not yet seen.
+    """
+    __tablename__ = "note_change"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq = Column(Integer, primary_key=True)
+    note_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)
+
+
+_change_triggers = [
+    ("note_inserted", "AFTER INSERT ON note",
+     "VALUES (NEW.id, 'insert')"),
+    ("note_updated", "AFTER UPDATE ON note",
+     "VALUES (NEW.id, 'update')"),
+    ("note_deleted", "AFTER DELETE ON note",
+     "VALUES (OLD.id, 'delete')"),
+    ("internal_note_inserted",
+     "AFTER INSERT ON internal_note WHEN NEW.note_id IS NOT NULL",
+     "VALUES (NEW.note_id, 'update')"),
+    ("internal_note_updated",
+     "AFTER UPDATE ON internal_note WHEN NEW.note_id IS NOT NULL",
+     "VALUES (NEW.note_id, 'update')"),
+    ("internal_note_deleted",
+     "AFTER DELETE ON internal_note WHEN OLD.note_id IS NOT NULL",
+     "VALUES (OLD.note_id, 'update')"),
+]
+
+# Triggers are attached to the metadata rather than to the tables so that
+# they are (idempotently) installed into databases that predate them.
+for _name, _when, _values in _change_triggers:
+    event.listen(GameBase.metadata, "after_create", DDL(
+        "CREATE TRIGGER IF NOT EXISTS {} {} BEGIN "
+        "INSERT INTO note_change (note_id, op) {}; END".format(
+            _name, _when, _values)).execute_if(dialect="sqlite"))
@@ -0,0 +1,87 @@
+import os
+import sqlite3
+
+import pytest
+from PyQt5.QtWidgets import QApplication
+
+from campaign.controller import SaveCampaignTask, SearchController, \
+    snapshot_database
+from core.archive import ArchiveMeta
+from oracle import DummyDelphi
+from ui.search import SearchCompleter
+
+
+@pytest.fixture(scope="module")
+def qapp():
+    return QApplication.instance() or QApplication([])
+
+
+class FakePopup:
+    def __init__(self):
+        self.model = None
+
+    def setModel(self, model):
+        self.model = model
+
+
+def test_search_results_received(qapp):
+    controller = SearchController(DummyDelphi(), SearchCompleter())
+    response = {"results": [{"note": 3, "page": 1, "snippet": "fireball"}]}
+    # There may be no popup to show results in yet.
+    controller.search_results_received.emit(response)
+    assert 1 == controller.results_model.rowCount()
+    assert "Note 3, page 2" == controller.results_model.item(0).text()
+
+    controller.results_popup = FakePopup()
+    controller.search_results_received.emit(response)
+    assert controller.results_popup.model is controller.results_model
+
+
+def make_database(path, rows=2000):
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, text TEXT)")
+    db.executemany("INSERT INTO notes (text) VALUES (?)",
+                   [("note %d " % i * 10,) for i in range(rows)])
+    db.commit()
+    return db
+
+
+def test_snapshot_while_writing(tmpdir):
+    src, dst = str(tmpdir.join("campaign.db")), str(tmpdir.join("copy.db"))
+    writer = make_database(src)
+    progress = []
+
+    def write(done, total):
+        # Another connection writes between the steps of the backup, which
+        # makes it start over.
+        progress.append((done, total))
+        if len(progress) in (2, 5):
+            writer.execute("INSERT INTO notes (text) VALUES ('late')")
+            writer.commit()
+
+    snapshot_database(src, dst, write, pages=1)
+    writer.close()
+    assert len(progress) > 5
+    done, total = progress[-1]
+    assert done == total > 0
+    copy = sqlite3.connect(dst)
+    assert ("ok",) == copy.execute("PRAGMA integrity_check").fetchone()
+    assert (2002,) == copy.execute("SELECT COUNT(*) FROM notes").fetchone()
+    copy.close()
+
+
+def test_failed_save(tmpdir):
+    src = tmpdir.mkdir("src")
+    database = str(src.join("campaign.db"))
+    make_database(database, rows=10).close()
+    snapshot = str(tmpdir.join("campaign.db.save"))
+    done = []
+    meta = ArchiveMeta("0d7c0ba8-5e0f-4e3c-a5b1-6f3a1c6f6d2e", "FOO")
+    task = SaveCampaignTask(meta, str(src), database,
+                            str(tmpdir.join("missing", "foo.dmc")), snapshot,
+                            False, lambda *_: None, lambda: done.append(1))
+    task.run()
+    assert [1] == done
+    assert task.result is None
+    assert isinstance(task.exception, OSError)
+    assert not os.path.exists(snapshot)
@@ -1,6 +1,9 @@
 import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 
-from campaign.note import Note
+from campaign.note import InternalNote, Note, NoteChange
+from model import GameBase
 
 
 @pytest.fixture
@@ -10,3 +13,47 @@ def note():
 
 def test_type(note):
     assert note.type == "ftp"
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite:///:memory:")
+    GameBase.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def changes(session):
+    return [(c.note_id, c.op) for c in
+            session.query(NoteChange).order_by(NoteChange.seq)]
+
+
+def test_change_log(session):
+    note = Note(name="foo", url="file:///foo.pdf")
+    session.add(note)
+    session.commit()
+    note.name = "bar"
+    session.commit()
+    session.delete(note)
+    session.commit()
+    assert changes(session) == [(1, "insert"), (1, "update"), (1, "delete")]
+
+
+def test_change_log_internal_note(session):
+    note = Note(name="foo")
+    session.add(note)
+    session.flush()
+    session.add(InternalNote(note_id=note.id, text="hello"))
+    session.commit()
+    assert changes(session) == [(1, "insert"), (1, "update")]
+
+
+def test_change_log_sequence_is_never_reused(session):
+    for _ in range(3):
+        session.add(Note(name="foo"))
+    session.commit()
+    last = session.query(NoteChange).order_by(NoteChange.seq.desc()).first()
+    session.query(NoteChange).delete()
+    session.commit()
+    session.add(Note(name="bar"))
+    session.commit()
+    assert session.query(NoteChange).one().seq > last.seq
@@ -28,7 +28,8 @@ import game.config
 from campaign import Campaign
 from campaign.controller import CampaignController
 from core import filters, generate_uuid, archive
-from core.archive import PropertiesSchema, InvalidArchiveError, ArchiveMeta
+from core.archive import PropertiesSchema, InvalidArchiveError, ArchiveMeta, \
+    MetaCache
 from core.async import mtexec
 from core.controller import QtController
 from game import GameSystem
@@ -52,13 +53,19 @@ class GameSystemController(QtController):
     gameSystemAdded = pyqtSignal()
     gameSystemDenied = pyqtSignal()  # FIXME better name
 
+    # Where the metadata of game system archives is cached between runs.
+    meta_cache_path = os.path.join(core.config.CONFIG_PATH, "archives.json")
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.systems = SchemaTableModel(PropertiesSchema, GameSystem,
                                         readonly=True)
+        # Game system id to game system.
+        self._by_id = {}
         self.cc = None
         self.view = None
         self._last_path = {}
+        self.meta_cache = None
 
     def bind(self, view):
         self.view = view
@@ -73,7 +80,7 @@ class GameSystemController(QtController):
         """
         path = archive_meta.last_seen_path
         game_system_id = archive_meta.game_system_id
-        if game_system_id in [game_system.id for game_system in self.systems]:
+        if game_system_id in self._by_id:
             raise ExistingLibraryError(path, game_system_id)
         game_system = GameSystem(game_system_id,
                                  archive_meta.name,
@@ -86,21 +93,33 @@ class GameSystemController(QtController):
 
     def add(self, game_system):
         self.systems.append(game_system)
+        self._by_id[game_system.id] = game_system
 
     def load_config(self, config_path):
+        """
+        Register the game systems listed in the config file. Their archives
+        are only opened if they have changed since they were last seen (see
+        ``MetaCache``).
+        """
         game_systems = []
         last_seen_at = {}
+        if self.meta_cache is None:
+            self.meta_cache = MetaCache(self.meta_cache_path)
         with open(config_path) as config_file:
             reader = game.config.reader(config_file)
             for id_, path in reader:
                 try:
-                    meta = ArchiveMeta.load(path)
+                    meta = self.meta_cache.load(path)
                     self.add_from_archive(meta)
                 # bleh
                 except (OSError, InvalidArchiveError,
                         ExistingLibraryError) as e:
                     log.warning("game system `%s' (at `%s') is invalid: %s",
                                 id_, path, e)
+        try:
+            self.meta_cache.save()
+        except OSError as e:
+            log.warning("cannot save archive metadata cache: %s", e)
 
         return game_systems, last_seen_at
 
@@ -116,16 +135,20 @@ class GameSystemController(QtController):
                 else:
                     writer.write_system(system, path)
 
+    @staticmethod
+    def oracle_database_path(game_system):
+        """
+        The oracle's index of the documents common to every campaign of
+        ``game_system``, such as its rulebooks.
+        """
+        return os.path.join(core.config.APP_PATH, "oracle", game_system.id)
+
     def get(self, id_):
         """
         Return the game system associated with ``id``, or raise ``KeyError`` if
         the id is not associated with a game system.
         """
-        # ugh
-        for system in self.systems:
-            if system.id == id_:
-                return system
-        raise KeyError
+        return self._by_id[id_]
 
     def has_unsaved(self):
         return not all(system.id in self._last_path for system in self.systems)
@@ -146,9 +169,8 @@ class GameSystemController(QtController):
     @pyqtSlot()
     def on_game_system_update(self, propdlg):
         game_system = propdlg.game_system
-        # FIXME hack
-        is_new_system = game_system.id not in self.systems
-        self.systems.append(game_system)
+        is_new_system = game_system.id not in self._by_id
+        self.add(game_system)
         if is_new_system:
             self.gameSystemAdded.emit()
 
@@ -355,7 +377,8 @@ class AppController(QObject):
             delphi = Delphi(self.oracle_zygote, self.delphi_quit)
 
         # TODO: Ensure that the previous campaign was flushed out (i.e., tmp)
-        cc = self.cc = CampaignController(delphi, campaign, archive_meta)
+        cc = self.cc = CampaignController(delphi, campaign, archive_meta,
+                                          self.thread_pool)
 
         self.game_controller.cc = cc
 
@@ -369,7 +392,9 @@ class AppController(QObject):
 
         delphi.start(CampaignController.database_path(campaign),
                      CampaignController.xapian_database_path(campaign),
-                     cc.search_controller)
+                     cc.search_controller,
+                     GameSystemController.oracle_database_path(
+                         campaign.game_system))
 
         window.show()
         window.raise_()
@@ -407,6 +432,7 @@ class AppController(QObject):
         """
         self._raze_delphi()
         self._flush_game_config()
+        self._finish_saves()
         self._clear_campaign_temp_files()
 
     @shutdown_method
@@ -420,10 +446,17 @@ class AppController(QObject):
     def _flush_game_config(self):
         self.game_controller.save_config(self.game_config_path)
 
+    @shutdown_method
+    def _finish_saves(self):
+        # A campaign may still be being saved from its working directory.
+        self.thread_pool.waitForDone()
+
     @shutdown_method
     def _clear_campaign_temp_files(self):
+        # The rest of the working directory (i.e., the oracle's index) is kept
+        # so that it need not be rebuilt the next time the campaign is opened.
         if self.cc:
-            shutil.rmtree(self.cc.working_directory(self.cc.campaign))
+            shutil.rmtree(self.cc.extracted_archive_path(self.cc.campaign))
 
     @pyqtSlot()
     def on_new_campaign(self):
@@ -16,16 +16,61 @@
 #
 
 """
+Campaign (``.dmc``) and library (``.dml``) archives.
+
+An archive is laid out as follows (integers in network byte order)::
+
+    +-------+---------+-------+------------+--------------+--------------+
+    | magic | version | flags | properties | index offset | index length |
+    |  8s   |   u16   |  u16  | length u32 |     u64      |     u32      |
+    +-------+---------+-------+------------+--------------+--------------+
+    | properties.json (uncompressed)                                     |
+    +--------------------------------------------------------------------+
+    | member data: each file in blocks, compressed on their own          |
+    +--------------------------------------------------------------------+
+    | index (uncompressed JSON: data offset and ``ArchiveMember`` list)  |
+    +--------------------------------------------------------------------+
+
+so an archive's properties are read without decompressing anything, and any
+one member is read with a seek to its data. The index is written last, once
+the offsets of the members are known, and the header is then patched to
+point at it; an archive whose index offset is zero was never finished.
+
+Space is left after the properties so that they can be rewritten in place.
+Saving over an archive (``update_archive()``) appends only the files that
+have changed since it was last saved, followed by a new index, and then
+patches the header. Until then the old index, and every member it refers
+to, is intact. The space taken by superseded members and indexes is
+reclaimed by rewriting the archive once it outweighs the live data.
+
+Files are split into blocks of ``block_size`` bytes, each of which is
+compressed independently, so that blocks are compressed (when writing) and
+decompressed (when reading) on a thread pool, one per core. Each member
+records its ``codec`` (see ``CODECS``) and the compressed length of each of
+its blocks. The codec is chosen when the archive is written: e.g. ``zlib``
+for quick saves, or ``lzma`` for copies to hand out.
+
+Archives written before this format (a ``tar.bz2`` stream with
+``properties.json`` as a member) are read by ``LegacyArchive``, and both
+kinds are opened with ``open_archive()``.
 
 .. note ::
-    For whatever reason, ``tarfile`` on Windows uses forward slashes instead
-    of ``os.sep``. As a result, this module never makes use of
-    ``os.path.join()``.
+    Member names always use forward slashes, whatever ``os.sep`` is. As a
+    result, this module never makes use of ``os.path.join()`` for them.
 """
 
+import bz2
+import lzma
 import os
+import struct
 import tarfile
-from json import JSONDecodeError
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from functools import partial
+from json import JSONDecodeError, dumps, loads
+from logging import getLogger
 
 from io import BytesIO
 from sqlalchemy import Column, String
@@ -35,10 +80,52 @@ from model.schema import *
 
 __all__ = ["InvalidArchiveError", "InvalidSessionError", "ArchiveMeta",
            "InvalidArchiveMetadataError", "open", "open_campaign",
-           "update_archive", "export", "unpack"]
+           "open_archive", "update_archive", "export", "unpack", "Archive",
+           "ArchiveMember", "ArchiveWriter", "LegacyArchive", "MetaCache",
+           "CODECS", "DEFAULT_CODEC"]
+
+log = getLogger(__name__)
 
 _open = open
 
+MAGIC = b"DMARCHV\0"
+FORMAT_VERSION = 1
+
+_header = struct.Struct("!8sHHIQI")
+
+# The number of bytes compressed or decompressed at a time.
+_chunk_size = 256 * 1024
+
+# The number of bytes of a file compressed as one block.
+block_size = 1024 * 1024
+
+# Codec names to functions compressing and decompressing a block. All of
+# them release the GIL while they work. The codec of a member is recorded
+# in the index, so names must never be reused.
+CODECS = {
+    "store": (bytes, bytes),
+    "zlib": (partial(zlib.compress, level=1), zlib.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+    "lzma": (partial(lzma.compress, preset=6), lzma.decompress),
+}
+
+DEFAULT_CODEC = "bz2"
+
+ArchiveMember = namedtuple("ArchiveMember", "name type offset length size "
+                                            "crc32 mtime mode codec blocks")
+ArchiveMember.__doc__ = """
+An entry of an archive's index. ``type`` is ``"file"`` or ``"dir"``;
+``offset`` (from the start of the archive) and ``length`` locate the
+compressed data of a file, which is ``size`` bytes with the CRC-32
+``crc32`` once decompressed. ``blocks`` lists the compressed length of each
+of its blocks, which are compressed with ``codec``. Both are ``None`` for a
+directory.
+"""
+
+
+def _workers():
+    return os.cpu_count() or 1
+
 
 class InvalidArchiveError(Exception):
     """Raised when an archive is corrupt or missing essential data."""
@@ -64,35 +151,616 @@ def open(path):
     return ArchiveMeta.load(path)
 
 
+def open_archive(path):
+    """
+    :return: An ``Archive``, or a ``LegacyArchive`` if ``path`` is in the
+             old ``tar.bz2`` format.
+    :raises: InvalidArchiveError
+    """
+    with _open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+    if magic == MAGIC:
+        return Archive(path)
+    return LegacyArchive(path)
+
+
 def unpack(meta, destination):
-    with tarfile.open(meta.last_seen_path, "r:bz2") as f:
-        f.extractall(destination)
+    with open_archive(meta.last_seen_path) as a:
+        a.extractall(destination)
 
 
-def export(meta, src, dst):
+def export(meta, src, dst, previous=None, files=None, progress=None,
+           codec=DEFAULT_CODEC):
     """
     Export an archive's contents. Suitable for ``Save as`` operations.
 
     :param meta: The archive meta.
     :param src: The source working directory to package into an archive.
     :param dst: The destination filename to export to.
+    :param previous: An optional ``Archive`` that ``src`` was extracted
+                     from (or last saved to), whose compressed data is
+                     copied rather than recompressed for unchanged files.
+    :param files: An optional dictionary of member names to the paths of
+                  files to add in place of those in ``src``, e.g. a
+                  snapshot of a database that is still in use.
+    :param progress: An optional function of the number of bytes of files
+                     archived so far, and the total.
+    :param codec: The name of the codec (see ``CODECS``) to compress with.
+    """
+    tmp = dst + ".tmp"
+    try:
+        properties = _properties(meta)
+        try:
+            with ArchiveWriter(tmp, properties, previous,
+                               codec=codec) as writer:
+                _add_tree(writer, src, files, progress)
+        except BaseException:
+            # The file may not have been created at all.
+            with suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+    finally:
+        if previous is not None:
+            # It may be the archive being replaced.
+            previous.close()
+    os.replace(tmp, dst)
+
+
+def update_archive(meta, src, path, files=None, progress=None,
+                   codec=DEFAULT_CODEC):
+    """
+    Save ``src`` over the archive at ``path``, which it was extracted from,
+    writing only what has changed since. Suitable for ``Save`` operations.
+
+    Archives in the old format, and those with too much superseded data in
+    them, are rewritten (see ``export()``).
+
+    :param files: See ``export()``.
+    :param progress: See ``export()``.
+    :param codec: The codec to compress changed files with. Unchanged files
+                  keep theirs.
+    """
+    try:
+        old = open_archive(path)
+    except (FileNotFoundError, InvalidArchiveError):
+        old = None
+    if not isinstance(old, Archive):
+        if old is not None:
+            old.close()
+        export(meta, src, path, files=files, progress=progress,
+               codec=codec)
+        return
+    properties = _properties(meta)
+    live = sum(member.length for member in old.members.values())
+    unused = os.path.getsize(path) - old.data_offset - live
+    if len(properties) > old.properties_space or unused > live:
+        log.debug("rewriting `%s' (%d bytes unused)", path, unused)
+        export(meta, src, path, old, files, progress, codec)
+        return
+    with old, ArchiveWriter(path, properties, old, in_place=True,
+                            codec=codec) as writer:
+        _add_tree(writer, src, files, progress)
+    log.debug("saved `%s': %d bytes written, %d files unchanged", path,
+              writer.written, writer.reused)
+
+
+def _properties(meta):
+    schema = ArchiveMetaSchema()
+    return str(schema.dumps(meta).data).encode()
+
+
+def _add_tree(writer, src, files=None, progress=None):
+    files = files or {}
+    # Written to the header, rather than as a member.
+    entries = [(name, files.get(name, path)) for name, path in _walk(src)
+               if name != "properties.json"]
+    if progress is not None:
+        total = sum(os.path.getsize(path) for _, path in entries
+                    if not os.path.isdir(path))
+        writer.progress = lambda done: progress(done, total)
+        progress(0, total)
+    for name, path in entries:
+        writer.add(name, path)
+
+
+def _walk(src):
+    """
+    :return: An iterator of the ``(name, path)`` of everything below
+             ``src``, directories before their contents.
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames.sort()
+        relative = os.path.relpath(dirpath, src)
+        prefix = "" if relative == os.curdir \
+            else relative.replace(os.sep, '/') + '/'
+        for name in dirnames + sorted(filenames):
+            yield prefix + name, os.path.join(dirpath, name)
+
+
+def _check_name(name):
+    """
+    :raises: InvalidArchiveError if a member ``name`` would be extracted
+             outside of the destination directory.
+    """
+    parts = name.split('/')
+    if not name or name.startswith('/') or ".." in parts or ':' in parts[0]:
+        raise InvalidArchiveError("bad member name `{}'".format(name))
+
+
+def _unchanged(member, st):
+    """
+    :return: ``True`` if the file ``st`` was stat'ed from is the one
+             ``member`` was added from (or extracted to). Times are compared
+             to a microsecond, as they are rounded by ``os.utime()``.
+    """
+    return (member.type == "file" and member.size == st.st_size
+            and abs(member.mtime - st.st_mtime) < 1e-6)
+
+
+class ArchiveWriter:
+    """
+    Writes an archive, one member at a time. The archive is only valid once
+    the writer has been closed.
+
+    Blocks are compressed on a thread pool, while the writer reads ahead. At
+    most ``2 * workers`` blocks are in flight at once, and everything is
+    written out in the order it was added.
+    """
+
+    # The least space kept for the properties, so they can grow in place.
+    properties_space = 4096
+
+    def __init__(self, path, properties, previous=None, in_place=False,
+                 codec=DEFAULT_CODEC, workers=None):
+        """
+        :param path: Where to write the archive.
+        :param properties: The (JSON) bytes of the archive's properties.
+        :param previous: An optional ``Archive`` to copy the compressed data
+                         of unchanged files from.
+        :param in_place: Append to ``previous``, which is at ``path``,
+                         referring to its data of unchanged files rather
+                         than copying it. ``properties`` must fit in its
+                         ``properties_space``.
+        :param codec: The name of the codec to compress with.
+        :param workers: The number of threads compressing. Defaults to the
+                        number of processors on the machine.
+        """
+        if codec not in CODECS:
+            raise ValueError("unknown codec `{}'".format(codec))
+        self.path = path
+        self.codec = codec
+        self.compress = CODECS[codec][0]
+        workers = workers or _workers()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.window = 2 * workers
+        # Compressed blocks and other writes, in the order they are due.
+        self.pending = deque()
+        self.properties = properties
+        self.previous = previous
+        self.in_place = in_place
+        self.members = []
+        # Bytes of compressed data written, and files whose data was reused.
+        self.written = 0
+        self.reused = 0
+        # Bytes of files added so far, and an optional function of them.
+        self.done = 0
+        self.progress = None
+        if in_place:
+            self.data_offset = previous.data_offset
+            self.file = _open(path, 'r+b')
+            self.file.seek(0, os.SEEK_END)
+            return
+        self.file = _open(path, 'wb')
+        space = max(self.properties_space, 2 * len(properties))
+        self.file.write(_header.pack(MAGIC, FORMAT_VERSION, 0,
+                                     len(properties), 0, 0))
+        self.file.write(properties.ljust(space, b'\0'))
+        self.data_offset = self.file.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for future, _ in self.pending:
+                if future is not None:
+                    future.cancel()
+            self.executor.shutdown()
+            self.file.close()
+
+    def add(self, name, path):
+        """Add the file or directory at ``path`` (but not its contents)."""
+        _check_name(name)
+        st = os.stat(path)
+        mode = st.st_mode & 0o7777
+        if os.path.isdir(path):
+            self._then(self.members.append,
+                       ArchiveMember(name, "dir", 0, 0, 0, 0, st.st_mtime,
+                                     mode, None, None))
+            return
+        old = None
+        if self.previous is not None:
+            old = self.previous.members.get(name)
+        # Data is only copied from another archive in the same codec.
+        if old is not None and _unchanged(old, st) \
+                and (self.in_place or old.codec == self.codec):
+            self._then(self.reuse, old._replace(mode=mode))
+            return
+        member = {"name": name, "offset": None, "size": 0, "crc32": 0,
+                  "blocks": []}
+        with _open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                member["size"] += len(block)
+                member["crc32"] = zlib.crc32(block, member["crc32"])
+                self._submit(self.compress, block,
+                             partial(self._write_block, member, len(block)))
+        self._then(self._finish_file, member, st, mode)
+
+    def _submit(self, f, data, callback):
+        """Run ``f(data)`` on the pool, and ``callback`` on its result."""
+        while len(self.pending) >= self.window:
+            self._complete()
+        self.pending.append((self.executor.submit(f, data), callback))
+
+    def _then(self, f, *args):
+        """Call ``f(*args)`` once everything added before it is written."""
+        if not self.pending:
+            f(*args)
+        else:
+            self.pending.append((None, partial(f, *args)))
+
+    def _complete(self):
+        future, callback = self.pending.popleft()
+        if future is None:
+            callback()
+        else:
+            callback(future.result())
+
+    def _write_block(self, member, size, data):
+        if member["offset"] is None:
+            member["offset"] = self.file.tell()
+        self.file.write(data)
+        member["blocks"].append(len(data))
+        self.written += len(data)
+        self._advance(size)
+
+    def _finish_file(self, member, st, mode):
+        offset = member["offset"]
+        if offset is None:
+            # An empty file has no blocks.
+            offset = self.file.tell()
+        self.members.append(ArchiveMember(
+            member["name"], "file", offset, sum(member["blocks"]),
+            member["size"], member["crc32"], st.st_mtime, mode, self.codec,
+            member["blocks"]))
+
+    def reuse(self, member):
+        """Add a member of ``previous`` without recompressing its data."""
+        self.reused += 1
+        if self.in_place:
+            self.members.append(member)
+        else:
+            offset = self.file.tell()
+            self.previous.copy_data(member, self.file)
+            self.members.append(member._replace(offset=offset))
+        self._advance(member.size)
+
+    def _advance(self, n):
+        self.done += n
+        if self.progress is not None:
+            self.progress(self.done)
+
+    def close(self):
+        while self.pending:
+            self._complete()
+        self.executor.shutdown()
+        index = dumps({"data_offset": self.data_offset,
+                       "members": [member._asdict()
+                                   for member in self.members]}).encode()
+        offset = self.file.tell()
+        self.file.write(index)
+        if self.in_place:
+            # Nothing refers to the new data until the header is patched.
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        header = _header.pack(MAGIC, FORMAT_VERSION, 0, len(self.properties),
+                              offset, len(index))
+        if self.in_place:
+            # In one write, so that the two always agree.
+            header += self.properties
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.close()
+
+
+class Archive:
+    """
+    An archive in the current format. Only the header is read when it is
+    opened; the index is read the first time ``members`` is needed.
+    """
+
+    def __init__(self, path):
+        """:raises: InvalidArchiveError"""
+        self.path = path
+        self.file = _open(path, 'rb')
+        try:
+            header = self.file.read(_header.size)
+            if len(header) < _header.size:
+                raise InvalidArchiveError("truncated archive header")
+            magic, version, _, self.properties_length, self.index_offset, \
+                self.index_length = _header.unpack(header)
+            if magic != MAGIC:
+                raise InvalidArchiveError("not a dmclient archive")
+            if version > FORMAT_VERSION:
+                raise InvalidArchiveError(
+                    "unsupported archive version {}".format(version))
+            if not self.index_offset:
+                raise InvalidArchiveError("archive was never finished")
+        except InvalidArchiveError:
+            self.file.close()
+            raise
+        self._members = None
+        self._executor = None
+        self.workers = _workers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.file.close()
+
+    @property
+    def executor(self):
+        # Created lazily: most archives are only opened for their properties.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    @property
+    def data_offset(self):
+        """The offset at which the members' data begins."""
+        if self._members is None:
+            self._read_index()
+        return self._data_offset
+
+    @property
+    def properties_space(self):
+        """The most bytes of properties that fit before the members."""
+        return self.data_offset - _header.size
+
+    def copy_data(self, member, f):
+        """Copy the compressed data of ``member`` to the file ``f``."""
+        self.file.seek(member.offset)
+        remaining = member.length
+        while remaining:
+            chunk = self.file.read(min(remaining, _chunk_size))
+            if not chunk:
+                raise InvalidArchiveError("truncated archive member")
+            f.write(chunk)
+            remaining -= len(chunk)
+
+    def properties(self):
+        """:return: The bytes of the archive's ``properties.json``."""
+        self.file.seek(_header.size)
+        data = self.file.read(self.properties_length)
+        if len(data) != self.properties_length:
+            raise InvalidArchiveError("truncated archive properties")
+        return data
+
+    @property
+    def members(self):
+        """An ordered dictionary of member names to ``ArchiveMember``."""
+        if self._members is None:
+            self._read_index()
+        return self._members
+
+    def _read_index(self):
+        self.file.seek(self.index_offset)
+        try:
+            index = loads(self.file.read(self.index_length).decode())
+            data_offset = int(index["data_offset"])
+            members = [ArchiveMember(**entry) for entry in index["members"]]
+        except (ValueError, TypeError, KeyError) as e:
+            raise InvalidArchiveError("corrupt archive index: %s" % e)
+        for member in members:
+            _check_name(member.name)
+            if member.type != "file":
+                continue
+            if member.codec not in CODECS:
+                raise InvalidArchiveError("unknown codec `{}'".format(
+                    member.codec))
+            if not isinstance(member.blocks, list):
+                raise InvalidArchiveError("corrupt archive index: `{}' has "
+                                          "no blocks".format(member.name))
+        self._data_offset = data_offset
+        self._members = {member.name: member for member in members}
+
+    def getmember(self, name):
+        """:raises: NoSuchArchiveFileError"""
+        try:
+            return self.members[name]
+        except KeyError:
+            raise NoSuchArchiveFileError("no `{}' in archive".format(name))
+
+    def iter_data(self, member):
+        """
+        :return: An iterator over the decompressed data of ``member``, a
+                 block at a time.
+        :raises: InvalidArchiveError if the data is corrupt.
+        """
+        for _, data in self.iter_blocks([member]):
+            yield data
+
+    def iter_blocks(self, members):
+        """
+        Decompress the blocks of every file of ``members`` on the thread
+        pool, a few blocks ahead of the consumer.
+
+        :return: An iterator of ``(member, data)`` for each block, in order.
+        :raises: InvalidArchiveError if the data is corrupt.
+        """
+        window = deque()
+        limit = 2 * self.workers
+        crcs = {}
+        for member in members:
+            if member.type != "file":
+                continue
+            decompress = CODECS[member.codec][1]
+            offset = member.offset
+            crcs[member.name] = 0
+            for i, length in enumerate(member.blocks):
+                self.file.seek(offset)
+                data = self.file.read(length)
+                if len(data) != length:
+                    raise InvalidArchiveError("truncated archive member")
+                offset += length
+                if len(window) >= limit:
+                    yield self._decompressed(window.popleft(), crcs)
+                last = i == len(member.blocks) - 1
+                window.append((member, last,
+                               self.executor.submit(decompress, data)))
+            if not member.blocks:
+                window.append((member, True, None))
+        while window:
+            yield self._decompressed(window.popleft(), crcs)
+
+    @staticmethod
+    def _decompressed(entry, crcs):
+        member, last, future = entry
+        data = b''
+        if future is not None:
+            try:
+                data = future.result()
+            except (OSError, EOFError, ValueError, zlib.error,
+                    lzma.LZMAError) as e:
+                raise InvalidArchiveError("corrupt archive member `{}': "
+                                          "{}".format(member.name, e))
+        crc = crcs[member.name] = zlib.crc32(data, crcs[member.name])
+        if last and crc != member.crc32:
+            raise InvalidArchiveError("corrupt archive member `{}'".format(
+                member.name))
+        return member, data
+
+    def read(self, name):
+        """:return: The decompressed data of the member ``name``."""
+        return b''.join(self.iter_data(self.getmember(name)))
+
+    def extract(self, member, destination):
+        self.extractall(destination, [member])
+
+    def extractall(self, destination, members=None):
+        """
+        Extract ``members`` (by default, every member) into
+        ``destination``. Files are decompressed a few blocks ahead, across
+        file boundaries, so that many small files decompress in parallel
+        too.
+        """
+        if members is None:
+            members = list(self.members.values())
+        for member in members:
+            path = self._path(destination, member)
+            if member.type == "dir":
+                os.makedirs(path, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Empty files have no blocks to write.
+                _open(path, 'wb').close()
+        f = None
+        current = None
+        try:
+            for member, data in self.iter_blocks(members):
+                if member is not current:
+                    if f is not None:
+                        f.close()
+                    current = member
+                    f = _open(self._path(destination, member), 'ab')
+                f.write(data)
+        finally:
+            if f is not None:
+                f.close()
+        # Contents are written first, as writing them changes the times of
+        # their directories.
+        for member in reversed(members):
+            path = self._path(destination, member)
+            if member.mode:
+                os.chmod(path, member.mode)
+            os.utime(path, (member.mtime, member.mtime))
+
+    @staticmethod
+    def _path(destination, member):
+        return os.path.join(destination, *member.name.split('/'))
+
+
+class LegacyArchive:
+    """
+    An archive in the old format: a ``tar.bz2`` stream whose members are in
+    no particular order, so reading any of them may mean decompressing the
+    whole archive.
     """
-    if not src.endswith('/'):
-        src += '/'
-    with tarfile.open(dst, mode="w:bz2") as tf:
-        schema = ArchiveMetaSchema()
-        json = str(schema.dumps(meta).data).encode()
-        ti = tarfile.TarInfo("properties.json")
-        ti.size = len(json)
-        tf.addfile(ti, fileobj=BytesIO(json))
-        for (dirpath, dirnames, filenames) in os.walk(src):
-            for dirname in dirnames:
-                tf.add(os.path.join(dirpath, dirname), dirname)
-            for filename in filenames:
-                full_path = os.path.join(dirpath, filename)
-                tf.add(full_path, filename)
-            # Hacky? Tarfile recursively adds the dirs.
-            break
+
+    def __init__(self, path):
+        """:raises: InvalidArchiveError"""
+        self.path = path
+        try:
+            self.tarfile = tarfile.open(path, "r:bz2")
+        except (tarfile.ReadError, EOFError, OSError) as e:
+            raise InvalidArchiveError("corrupt archive: %s" % e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.tarfile.close()
+
+    def properties(self):
+        return self.read("properties.json")
+
+    @property
+    def members(self):
+        """
+        An ordered dictionary of member names to ``ArchiveMember``. Tar
+        members have no offset, length or checksum of their own.
+        """
+        try:
+            return {ti.name: ArchiveMember(ti.name,
+                                           "dir" if ti.isdir() else "file",
+                                           None, None, ti.size, None,
+                                           ti.mtime, ti.mode, None, None)
+                    for ti in self.tarfile.getmembers()}
+        except (tarfile.ReadError, EOFError, OSError) as e:
+            raise InvalidArchiveError("corrupt archive: %s" % e)
+
+    def read(self, name):
+        """:raises: NoSuchArchiveFileError, InvalidArchiveError"""
+        try:
+            f = self.tarfile.extractfile(name)
+        except KeyError:
+            raise NoSuchArchiveFileError("no `{}' in archive".format(name))
+        except (tarfile.ReadError, EOFError, OSError) as e:
+            raise InvalidArchiveError("corrupt archive: %s" % e)
+        if f is None:
+            raise NoSuchArchiveFileError("`{}' is not a file".format(name))
+        try:
+            return f.read()
+        except (tarfile.ReadError, EOFError, OSError) as e:
+            raise InvalidArchiveError("corrupt archive: %s" % e)
+
+    def extractall(self, destination):
+        try:
+            self.tarfile.extractall(destination)
+        except (tarfile.ReadError, EOFError) as e:
+            raise InvalidArchiveError("corrupt archive: %s" % e)
 
 
 class ArchiveMeta:
@@ -118,16 +786,93 @@ class ArchiveMeta:
         :return: An ``ArchiveMeta`` instance.
         :raises: InvalidArchiveMetadataError
         """
+        with open_archive(path) as a:
+            return cls.from_properties(a.properties(), path)
+
+    @classmethod
+    def from_properties(cls, properties, path):
+        """
+        :param properties: The bytes of an archive's ``properties.json``.
+        :param path: The path of the archive.
+        :raises: InvalidArchiveMetadataError
+        """
         try:
-            with tarfile.open(path, "r:bz2") as tf:
-                meta = _parse_json(tf.extractfile("properties.json"),
-                                   ArchiveMetaSchema)
-                meta.last_seen_path = path
-                return meta
+            meta = _parse_json(BytesIO(properties), ArchiveMetaSchema)
         except JSONDecodeError as e:
             raise InvalidArchiveMetadataError("invalid meta: %s" % e)
-        except (tarfile.ReadError, EOFError, JSONDecodeError) as e:
-            raise InvalidArchiveError("corrupt archive: %s" % e)
+        meta.last_seen_path = path
+        return meta
+
+
+class MetaCache:
+    """
+    A persistent cache of the properties of archives, so that they are not
+    opened at all (e.g. at startup) unless they have changed on disk since
+    they were last read. Entries are keyed by path, and are only used if the
+    archive's mtime and size are unchanged.
+
+    The cache is a JSON file, which is written by ``save()`` if anything in
+    it has changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        try:
+            with _open(path) as f:
+                entries = loads(f.read())
+            if isinstance(entries, dict):
+                self.entries = entries
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log.warning("ignoring archive metadata cache `%s': %s", path, e)
+
+    def load(self, path):
+        """
+        :return: The ``ArchiveMeta`` of the archive at ``path``.
+        :raises: OSError, InvalidArchiveError
+        """
+        st = os.stat(path)
+        entry = self.entries.get(path)
+        if entry and entry.get("mtime") == st.st_mtime \
+                and entry.get("size") == st.st_size:
+            try:
+                meta = ArchiveMeta.from_properties(
+                    entry["properties"].encode(), path)
+            except (InvalidArchiveMetadataError, KeyError,
+                    AttributeError) as e:
+                log.debug("cached metadata of `%s' is invalid: %s", path, e)
+            else:
+                self.hits += 1
+                return meta
+        self.misses += 1
+        with open_archive(path) as a:
+            properties = a.properties()
+        meta = ArchiveMeta.from_properties(properties, path)
+        self.entries[path] = {"mtime": st.st_mtime, "size": st.st_size,
+                              "properties": properties.decode()}
+        self.dirty = True
+        return meta
+
+    def discard(self, path):
+        if self.entries.pop(path, None) is not None:
+            self.dirty = True
+
+    def save(self):
+        """Write the cache, forgetting archives that no longer exist."""
+        for path in [p for p in self.entries if not os.path.exists(p)]:
+            self.discard(path)
+        if not self.dirty:
+            return
+        tmp = self.path + ".tmp"
+        with _open(tmp, 'w') as f:
+            f.write(dumps(self.entries))
+        os.replace(tmp, self.path)
+        self.dirty = False
 
 
 class ArchiveMetaSchema(Schema):
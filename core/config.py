@@ -83,6 +83,9 @@ elif platform.system() == "Linux":
 else:
     raise NotImplementedError("Support for your platform does not exist.")
 
+# Shared between campaigns, unlike their working directories in TMP_PATH.
+CACHE_PATH = os.path.join(TMP_PATH, "cache")
+
 # This folder is expected to be in:
 #  o  the shared dmclient installation location (ProgramFiles, /Applications &c)
 #  o  the user's local directory for dmclient
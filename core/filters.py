@@ -26,7 +26,7 @@ __all__ = ["join",
            "any", "campaign", "library", "expansion",
            "json", "yaml",
            "png", "gif", "jpeg", "svg", "icon",
-           "all_documents", "pdf", "txt", "document",
+           "all_documents", "pdf", "txt", "markdown", "rst", "document",
            ]
 
 
@@ -53,7 +53,10 @@ jpeg = join("JPEG (*.jpeg)", "JPG (*.jpg)")
 svg = "Scalable Vector Graphics (*.svg)"
 icon = join(png, gif, jpeg, svg)
 
-all_documents = "All supported document formats (*.pdf, *.txt)"
+all_documents = ("All supported document formats "
+                 "(*.pdf *.txt *.md *.markdown *.rst)")
 pdf = "PDF (*.pdf)"
 txt = "Plain text (*.txt)"
-document = join(all_documents, pdf, txt)
+markdown = "Markdown (*.md *.markdown)"
+rst = "reStructuredText (*.rst)"
+document = join(all_documents, pdf, txt, markdown, rst)
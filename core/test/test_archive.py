@@ -1,4 +1,5 @@
 """Tests for the campaign archive structure."""
+import os
 import tarfile
 
 import pytest
@@ -6,7 +7,7 @@ from dateutil.parser import parse as dtparse
 
 from core import archive
 from core.archive import InvalidArchiveError, InvalidArchiveMetadataError, \
-    ArchiveMetaSchema
+    ArchiveMetaSchema, NoSuchArchiveFileError
 
 
 @pytest.fixture(scope="module")
@@ -55,21 +56,194 @@ def test_export(archive_meta, tmpdir):
     tfpath = dest.join("foo.dml")
     archive.export(archive_meta, str(src), tfpath)
 
-    with tarfile.open(tfpath, "r:bz2") as tf:
-        members = [ti.name for ti in tf.getmembers()]
-        assert 4 == len(members)
+    with archive.open_archive(str(tfpath)) as a:
+        assert isinstance(a, archive.Archive)
+        members = list(a.members)
+        assert 3 == len(members)
         assert "foo.txt" in members
-        assert "properties.json" in members
-        assert "bar" in members and tf.getmember("bar").isdir()
+        assert "bar" in members and a.members["bar"].type == "dir"
         assert "bar/bar.txt" in members
+        assert b"goodbye, world" == a.read("bar/bar.txt")
 
         with open("resources/test/protege/testcampaign/properties.json") as f:
             schema = ArchiveMetaSchema()
             m1, errors = schema.loads(f.read())
             assert not errors
-            m2, errors = schema.loads(
-                tf.extractfile("properties.json").read().decode())
+            m2, errors = schema.loads(a.properties().decode())
             assert not errors
             # Hacky way of determining if equal and unmolested.
             test_loading_metadata(m1)
             test_loading_metadata(m2)
+
+
+def test_members_are_read_independently(tmpdir):
+    src = tmpdir.mkdir("src")
+    src.join("big.bin").write_binary(bytes(range(256)) * 4096)
+    src.join("small.txt").write("hello, world")
+    path = str(tmpdir.join("foo.dmc"))
+    with archive.ArchiveWriter(path, b'{"name": "foo"}') as writer:
+        writer.add("big.bin", str(src.join("big.bin")))
+        writer.add("small.txt", str(src.join("small.txt")))
+
+    with archive.open_archive(path) as a:
+        assert b'{"name": "foo"}' == a.properties()
+        assert b"hello, world" == a.read("small.txt")
+        with pytest.raises(NoSuchArchiveFileError):
+            a.read("missing.txt")
+        a.extractall(str(tmpdir.join("dest")))
+    assert src.join("big.bin").read_binary() == \
+        tmpdir.join("dest", "big.bin").read_binary()
+
+    # Corrupt the compressed data of one member; the other is unaffected.
+    with open(path, 'r+b') as f:
+        member = archive.Archive(path).members["big.bin"]
+        f.seek(member.offset + member.length // 2)
+        f.write(b"garbage")
+    with archive.open_archive(path) as a:
+        assert b"hello, world" == a.read("small.txt")
+        with pytest.raises(InvalidArchiveError):
+            a.read("big.bin")
+
+
+def test_legacy_archive(tmpdir):
+    path = str(tmpdir.join("old.dml"))
+    src = tmpdir.join("foo.txt")
+    src.write("hello, world")
+    with tarfile.open(path, "w:bz2") as tf:
+        tf.add(str(src), "foo.txt")
+    with archive.open_archive(path) as a:
+        assert isinstance(a, archive.LegacyArchive)
+        assert ["foo.txt"] == list(a.members)
+        assert b"hello, world" == a.read("foo.txt")
+
+
+def test_unfinished_archive(tmpdir):
+    path = str(tmpdir.join("foo.dmc"))
+    writer = archive.ArchiveWriter(path, b"{}")
+    writer.file.close()
+    with pytest.raises(InvalidArchiveError):
+        archive.open_archive(path)
+
+
+def test_meta_cache(tmpdir, monkeypatch):
+    path = str(tmpdir.join("foo.dml"))
+    properties = b'{"id": "0d7c0ba8-5e0f-4e3c-a5b1-6f3a1c6f6d2e", ' \
+                 b'"game_system_id": "FOO", "name": "Foo"}'
+    archive.ArchiveWriter(path, properties).close()
+    cache_path = str(tmpdir.join("archives.json"))
+
+    cache = archive.MetaCache(cache_path)
+    assert "FOO" == cache.load(path).game_system_id
+    cache.save()
+
+    opened = []
+    open_archive = archive.open_archive
+    monkeypatch.setattr(archive, "open_archive",
+                        lambda p: opened.append(p) or open_archive(p))
+    cache = archive.MetaCache(cache_path)
+    meta = cache.load(path)
+    assert "Foo" == meta.name and path == meta.last_seen_path
+    assert not opened
+
+    # A changed archive is read again.
+    archive.ArchiveWriter(path, properties.replace(b"Foo", b"Bar")).close()
+    os.utime(path, (0, 0))
+    assert "Bar" == cache.load(path).name
+    assert [path] == opened
+
+
+def test_update_archive(tmpdir):
+    src = tmpdir.mkdir("src")
+    src.join("map.png").write_binary(os.urandom(256 * 1024))
+    src.join("notes.txt").write("hello, world")
+    meta = archive.ArchiveMeta("0d7c0ba8-5e0f-4e3c-a5b1-6f3a1c6f6d2e", "FOO")
+    path = str(tmpdir.join("foo.dmc"))
+    archive.update_archive(meta, str(src), path)
+    with archive.open_archive(path) as a:
+        old = a.members["map.png"]
+    size = os.path.getsize(path)
+
+    src.join("notes.txt").write("goodbye, world")
+    src.join("new.txt").write("new")
+    meta.name = "Foo"
+    archive.update_archive(meta, str(src), path)
+    # The map was neither recompressed nor copied.
+    assert os.path.getsize(path) - size < 1024
+    with archive.open_archive(path) as a:
+        assert old == a.members["map.png"]
+        assert b"goodbye, world" == a.read("notes.txt")
+        assert b"new" == a.read("new.txt")
+        assert b'"name": "Foo"' in a.properties()
+        a.extractall(str(tmpdir.join("dest")))
+    assert src.join("map.png").read_binary() == \
+        tmpdir.join("dest", "map.png").read_binary()
+
+    # Once most of the archive is superseded, it is rewritten.
+    src.join("map.png").write_binary(os.urandom(256 * 1024))
+    archive.update_archive(meta, str(src), path)
+    assert os.path.getsize(path) > size + 256 * 1024
+    archive.update_archive(meta, str(src), path)
+    assert os.path.getsize(path) - size < 1024
+    with archive.open_archive(path) as a:
+        assert src.join("map.png").read_binary() == a.read("map.png")
+
+
+def test_export_progress_and_substitutes(tmpdir):
+    src = tmpdir.mkdir("src")
+    src.join("campaign.db").write("live")
+    src.mkdir("maps").join("map.png").write_binary(b"x" * 100000)
+    snapshot = tmpdir.join("snapshot.db")
+    snapshot.write("snapshot")
+    meta = archive.ArchiveMeta("0d7c0ba8-5e0f-4e3c-a5b1-6f3a1c6f6d2e", "FOO")
+    path = str(tmpdir.join("foo.dmc"))
+    progress = []
+    archive.export(meta, str(src), path,
+                   files={"campaign.db": str(snapshot)},
+                   progress=lambda done, total: progress.append((done, total)))
+    assert progress[0] == (0, 100008) and progress[-1] == (100008, 100008)
+    assert progress == sorted(progress)
+    with archive.open_archive(path) as a:
+        assert b"snapshot" == a.read("campaign.db")
+
+
+@pytest.mark.parametrize("codec", sorted(archive.CODECS))
+def test_blocks_and_codecs(tmpdir, monkeypatch, codec):
+    monkeypatch.setattr(archive, "block_size", 1000)
+    src = tmpdir.mkdir("src")
+    data = os.urandom(3500) * 2
+    src.join("big.bin").write_binary(data)
+    src.join("empty.txt").write("")
+    src.mkdir("maps").join("map.txt").write("here be dragons")
+    meta = archive.ArchiveMeta("0d7c0ba8-5e0f-4e3c-a5b1-6f3a1c6f6d2e", "FOO")
+    path = str(tmpdir.join("foo.dmc"))
+    archive.export(meta, str(src), path, codec=codec)
+
+    with archive.open_archive(path) as a:
+        big = a.members["big.bin"]
+        assert codec == big.codec
+        assert 7 == len(big.blocks)
+        assert data == a.read("big.bin")
+        assert b"" == a.read("empty.txt")
+        a.extractall(str(tmpdir.join("dest")))
+    for name in ("big.bin", "empty.txt", "maps/map.txt"):
+        assert src.join(name).read_binary() == \
+            tmpdir.join("dest", name).read_binary()
+
+    # Unchanged files keep their codec when saved in place with another.
+    src.join("maps", "map.txt").write("here be more dragons")
+    archive.update_archive(meta, str(src), path, codec="store")
+    with archive.open_archive(path) as a:
+        assert codec == a.members["big.bin"].codec
+        assert "store" == a.members["maps/map.txt"].codec
+        assert b"here be more dragons" == a.read("maps/map.txt")
+
+
+def test_export_failure_before_writing(tmpdir, monkeypatch):
+    def fail(_):
+        raise ValueError("bad metadata")
+    monkeypatch.setattr(archive, "_properties", fail)
+    meta = archive.ArchiveMeta("0d7c0ba8-5e0f-4e3c-a5b1-6f3a1c6f6d2e", "FOO")
+    path = str(tmpdir.join("foo.dmc"))
+    with pytest.raises(ValueError):
+        archive.export(meta, str(tmpdir.mkdir("src")), path)
+    assert not tmpdir.join("foo.dmc.tmp").check()
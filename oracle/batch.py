@@ -0,0 +1,171 @@
+# oracle/batch.py
+# Copyright (C) 2018 Alex Mair. All rights reserved.
+# This file is part of dmclient.
+#
+# dmclient is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# dmclient is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dmclient.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Batching of writes to the oracle's xapian database."""
+
+import time
+from functools import partial
+from logging import getLogger
+from threading import Lock, Timer
+
+from oracle.metrics import Histogram
+
+__all__ = ["BatchWriter"]
+
+log = getLogger(__name__)
+
+
+class BatchWriter:
+    """
+    Collects writes to an ``OracleDatabase`` and applies them in a single
+    xapian transaction. Each flush commits, so it is also the point at which
+    the writes become durable (and visible to readers).
+
+    A flush happens when ``max_documents`` writes or ``max_bytes`` of text
+    are pending, when the oldest pending write is ``max_delay`` seconds old,
+    or when ``flush()`` is called explicitly (e.g. once the indexing queue
+    drains).
+
+    If a write fails, the rest of its batch is written one at a time, so that
+    only the failed write is lost.
+    """
+
+    def __init__(self, database, max_documents=64, max_bytes=16 * 1024 * 1024,
+                 max_delay=2.0, dropped=None):
+        """
+        :param dropped: Called with the note id (or the digest, for shared
+                        documents) of each write that failed.
+        """
+        self.database = database
+        self.dropped = dropped
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.batch_sizes = Histogram()
+        self.commit_latency = Histogram()
+        self._operations = []
+        self._bytes = 0
+        self._timer = None
+        self._lock = Lock()
+
+    def replace_note(self, note_id, document, record, size=0):
+        """
+        :param size: The (approximate) size in bytes of the text indexed into
+                     ``document``.
+        """
+        self._add(note_id, partial(self.database.replace_note, note_id,
+                                   document, record), size)
+
+    def share_note(self, note_id, record):
+        self._add(note_id, partial(self.database.share_note, note_id, record),
+                  0)
+
+    def add_shared(self, digest, document, size=0):
+        self._add(digest, partial(self.database.add_shared, digest, document),
+                  size)
+
+    def link_note(self, note_id, record):
+        """
+        Make a note share the document of a note with the same contents,
+        which must have been written first.
+        """
+        self._add(note_id, partial(self._link_note, note_id, record), 0)
+
+    def _link_note(self, note_id, record):
+        if not self.database.link_note(note_id, record):
+            # Every note with the contents was deleted in the meantime.
+            log.warning("cannot index note %d, its document has gone",
+                        note_id)
+
+    def delete_note(self, note_id):
+        self._add(note_id, partial(self.database.delete_note, note_id), 0)
+
+    def __len__(self):
+        return len(self._operations)
+
+    def _add(self, key, operation, size):
+        with self._lock:
+            self._operations.append((key, operation))
+            self._bytes += size
+            full = (len(self._operations) >= self.max_documents
+                    or self._bytes >= self.max_bytes)
+            if not full and self._timer is None:
+                self._timer = Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            operations, self._operations = self._operations, []
+            self._bytes = 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not operations:
+            return
+        database = self.database
+        start = time.perf_counter()
+        dropped = []
+        with database.lock:
+            database.begin_transaction()
+            try:
+                for _, operation in operations:
+                    operation()
+            except Exception:
+                database.cancel_transaction()
+                log.exception("failed to write a batch of %d documents, "
+                              "writing them one at a time", len(operations))
+                dropped = self._apply_singly(operations)
+            else:
+                database.commit_transaction()
+        latency = time.perf_counter() - start
+        self.batch_sizes.add(len(operations))
+        self.commit_latency.add(latency)
+        database.committed()
+        log.debug("committed %d documents in %.3fs", len(operations), latency)
+        if self.dropped is not None:
+            for key in dropped:
+                self.dropped(key)
+
+    def _apply_singly(self, operations):
+        """
+        Apply each of ``operations`` in a transaction of its own.
+
+        :return: The keys of those which failed.
+        """
+        database = self.database
+        dropped = []
+        for key, operation in operations:
+            database.begin_transaction()
+            try:
+                operation()
+            except Exception:
+                database.cancel_transaction()
+                log.exception("failed to write `%s'", key)
+                dropped.append(key)
+            else:
+                database.commit_transaction()
+        return dropped
+
+    def close(self):
+        self.flush()
+
+    def metrics(self):
+        return {"batch_size": self.batch_sizes.snapshot(),
+                "commit_latency": self.commit_latency.snapshot()}
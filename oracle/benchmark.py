@@ -0,0 +1,384 @@
+# oracle/benchmark.py
+# Copyright (C) 2018 Alex Mair. All rights reserved.
+# This file is part of dmclient.
+#
+# dmclient is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# dmclient is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dmclient.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Benchmarks of the oracle against a synthetic corpus (see ``oracle.corpus``).
+
+A campaign database is made with a note for every document of the corpus
+(and a number of internal notes), and an ``OracleController`` is run over it
+in-process, exactly as the oracle process would. While it indexes, searcher
+threads query it continuously. The following are measured:
+
+* indexing throughput, in documents and bytes of text per second;
+* commit latency, and the latency of every other indexing stage;
+* search latency, both while indexing and once it has finished;
+* the peak resident memory of the process (and of the PDF mining pool).
+
+The results are written as JSON, and may be compared against those of
+another revision with ``--compare``::
+
+    python -m oracle.benchmark --size medium -o new.json --compare old.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from random import Random
+from threading import Event, Thread
+
+import xapian
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from campaign.note import InternalNote, Note
+from model import GameBase
+from oracle.corpus import CorpusGenerator, VOCABULARY
+from oracle.metrics import Histogram, psutil
+from oracle.oracle import OracleController, OracleDatabase, \
+    _load_default_providers
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = ["compare", "run_benchmark", "SIZES"]
+
+log = logging.getLogger(__name__)
+
+# Corpus sizes: the number of PDFs, plaintext files and internal notes.
+SIZES = {
+    "tiny": (4, 12, 20),
+    "small": (20, 60, 100),
+    "medium": (100, 400, 500),
+    "large": (500, 2000, 2500),
+}
+
+# The metrics compared by ``compare()``, and whether bigger is better.
+KEY_METRICS = [
+    (("indexing", "documents_per_second"), True),
+    (("indexing", "bytes_per_second"), True),
+    (("commit_latency", "p50"), False),
+    (("commit_latency", "p99"), False),
+    (("search_while_indexing", "p50"), False),
+    (("search_while_indexing", "p99"), False),
+    (("search_idle", "p50"), False),
+    (("search_idle", "p99"), False),
+    (("memory", "peak_rss"), False),
+]
+
+
+class NullChannel:
+    """
+    Stands in for the channel to Delphi; the benchmark runs the oracle
+    in-process, so nothing listens for its events.
+    """
+
+    def send(self, kind, method, request_id=0, payload=None):
+        pass
+
+
+class MemorySampler(Thread):
+    """
+    Polls the resident memory of this process and its children (the PDF
+    mining pool), keeping the peak of each.
+    """
+
+    def __init__(self, interval=0.05):
+        super().__init__(name="memory-sampler", daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self.peak_children = 0
+        self.stopped = Event()
+
+    def run(self):
+        if psutil is None:
+            return
+        process = psutil.Process()
+        while not self.stopped.wait(self.interval):
+            try:
+                self.peak = max(self.peak, process.memory_info().rss)
+                self.peak_children = max(self.peak_children, sum(
+                    child.memory_info().rss for child in process.children()))
+            except psutil.Error:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def results(self):
+        peak = self.peak
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux, but bytes on macOS.
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform != "darwin":
+                maxrss *= 1024
+            peak = max(peak, maxrss)
+        return {"peak_rss": peak, "peak_rss_children": self.peak_children}
+
+
+class SearchLoad:
+    """Searcher threads which query the oracle until told to stop."""
+
+    def __init__(self, searcher, queries, threads=2):
+        self.searcher = searcher
+        self.queries = queries
+        self.latency = Histogram(window=1 << 20)
+        self.errors = 0
+        self.stopped = Event()
+        self.threads = [Thread(target=self.run, args=(i,), daemon=True,
+                               name="search-load-%d" % i)
+                        for i in range(threads)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+
+    def run(self, offset):
+        queries = self.queries
+        i = offset
+        while not self.stopped.is_set():
+            self.search(i, queries[i % len(queries)])
+            i += len(self.threads)
+            # Leave the indexer some room, as a user typing would.
+            time.sleep(0.001)
+
+    def search(self, query_id, query):
+        response = self.searcher.search(query_id, query)
+        if response["error"]:
+            self.errors += 1
+        self.latency.add(response["latency"])
+
+
+def make_queries(seed, n=500):
+    """
+    :return: ``n`` queries of one to three words from the corpus vocabulary,
+             which are mostly distinct so that the result cache is not all
+             that is measured.
+    """
+    random = Random(seed)
+    return [' '.join(random.sample(VOCABULARY, random.randint(1, 3)))
+            for _ in range(n)]
+
+
+def make_campaign(path, documents, texts):
+    """
+    Create a campaign database with a note for each of ``documents`` and an
+    internal note for each of ``texts``.
+    """
+    engine = create_engine("sqlite:///{}".format(path))
+    GameBase.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    for document in documents:
+        session.add(Note(name=os.path.basename(document.path),
+                         url="file://" + document.path))
+    for i, text in enumerate(texts):
+        note = Note(name="Session note {}".format(i))
+        session.add(note)
+        session.flush()
+        session.add(InternalNote(note_id=note.id, text=text))
+    session.commit()
+    session.close()
+    return engine
+
+
+def run_benchmark(directory, pdfs, notes, internal, seed=0, pages=(4, 40),
+                  searchers=2, idle_queries=200):
+    """
+    Generate a corpus in ``directory`` and index it.
+
+    :param pdfs: The number of PDFs to generate.
+    :param notes: The number of plaintext (and Markdown) files to generate.
+    :param internal: The number of internal notes to generate.
+    :param searchers: The number of threads searching while indexing.
+    :param idle_queries: The number of searches made once indexing is done.
+    :return: A dictionary of results.
+    """
+    generator = CorpusGenerator(seed)
+    start = time.perf_counter()
+    documents = generator.generate(os.path.join(directory, "corpus"), pdfs,
+                                   notes, pages)
+    texts = [generator.note_text() for _ in range(internal)]
+    generation_time = time.perf_counter() - start
+    engine = make_campaign(os.path.join(directory, "campaign.db"), documents,
+                           texts)
+
+    path = os.path.join(directory, "xapian.db")
+    database = OracleDatabase(
+        xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OPEN), path)
+    providers = _load_default_providers()
+    controller = OracleController(NullChannel(), engine, database, providers)
+    queries = make_queries(seed)
+
+    memory = MemorySampler()
+    memory.start()
+    load = SearchLoad(controller.searcher, queries, searchers)
+    try:
+        start = time.perf_counter()
+        load.start()
+        controller.sync_notes()
+        controller.scheduler.join()
+        controller.writer.flush()
+        indexing_time = time.perf_counter() - start
+        load.stop()
+
+        idle = SearchLoad(controller.searcher, queries)
+        for i in range(idle_queries):
+            idle.search(i, queries[-1 - i % len(queries)])
+    finally:
+        memory.stop()
+        controller.scheduler.shutdown()
+        controller.writer.close()
+        for provider in providers.values():
+            provider.shutdown()
+
+    indexing = controller.indexing
+    return {
+        "corpus": {"seed": seed, "pdfs": pdfs, "notes": notes,
+                   "internal_notes": internal, "pages": list(pages),
+                   "bytes": sum(document.size for document in documents)
+                   + sum(len(text.encode()) for text in texts),
+                   "generation_time": generation_time},
+        "indexing": {"documents": indexing.documents.total,
+                     "bytes": indexing.bytes.total, "time": indexing_time,
+                     "documents_per_second":
+                         indexing.documents.total / indexing_time,
+                     "bytes_per_second":
+                         indexing.bytes.total / indexing_time,
+                     "pages_skipped": indexing.pages_skipped},
+        "stages": {name: histogram.snapshot()
+                   for name, histogram in indexing.stages.items()},
+        "commit_latency": controller.writer.commit_latency.snapshot(),
+        "batch_size": controller.writer.batch_sizes.snapshot(),
+        "search_while_indexing": dict(load.latency.snapshot(),
+                                      errors=load.errors),
+        "search_idle": dict(idle.latency.snapshot(), errors=idle.errors),
+        "memory": memory.results(),
+    }
+
+
+def revision():
+    """:return: The git revision being benchmarked, if it can be found."""
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after):
+    """
+    :param before: The results of an earlier run.
+    :param after: The results of a later run.
+    :return: A list of ``(metric, before, after, change)`` tuples, where
+             ``change`` is the relative improvement (positive) or regression
+             (negative) of the metric.
+    """
+    rows = []
+    for keys, bigger_is_better in KEY_METRICS:
+        old, new = before, after
+        for key in keys:
+            old = (old or {}).get(key)
+            new = (new or {}).get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        rows.append(('.'.join(keys), old, new,
+                     change if bigger_is_better else -change))
+    return rows
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Benchmark the oracle against a synthetic corpus.")
+    argparser.add_argument("--size", choices=sorted(SIZES), default="small",
+                           help="The size of the corpus.")
+    argparser.add_argument("--pdfs", type=int,
+                           help="The number of PDFs, overriding --size.")
+    argparser.add_argument("--notes", type=int,
+                           help="The number of plaintext files, overriding "
+                                "--size.")
+    argparser.add_argument("--internal", type=int,
+                           help="The number of internal notes, overriding "
+                                "--size.")
+    argparser.add_argument("--seed", type=int, default=0,
+                           help="The seed the corpus is generated from.")
+    argparser.add_argument("--searchers", type=int, default=2,
+                           help="Threads searching during indexing.")
+    argparser.add_argument("--directory",
+                           help="Where to generate the corpus and index. "
+                                "Defaults to a temporary directory.")
+    argparser.add_argument("-o", "--output",
+                           help="Write the results to this JSON file.")
+    argparser.add_argument("--compare", type=argparse.FileType('r'),
+                           help="Results of an earlier run to compare with.")
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("pdfminer").setLevel(logging.ERROR)
+
+    pdfs, notes, internal = SIZES[args.size]
+    if args.pdfs is not None:
+        pdfs = args.pdfs
+    if args.notes is not None:
+        notes = args.notes
+    if args.internal is not None:
+        internal = args.internal
+
+    with tempfile.TemporaryDirectory(prefix="dmoracle-bench-") as tmp:
+        directory = args.directory or tmp
+        log.info("indexing %d PDFs, %d files and %d internal notes in `%s'",
+                 pdfs, notes, internal, directory)
+        results = run_benchmark(directory, pdfs, notes, internal, args.seed,
+                                searchers=args.searchers)
+    results["revision"] = revision()
+    results["python"] = platform.python_version()
+    results["xapian"] = xapian.version_string()
+    results["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        before = json.load(args.compare)
+        print("{:<32} {:>14} {:>14} {:>8}".format(
+            "compared with {}".format(before.get("revision")), "before",
+            "after", "change"), file=sys.stderr)
+        for metric, old, new, change in compare(before, results):
+            print("{:<32} {:>14.4g} {:>14.4g} {:>+7.1%}".format(
+                metric, old, new, change), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
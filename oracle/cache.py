@@ -0,0 +1,291 @@
+# oracle/cache.py
+# Copyright (C) 2018 Alex Mair. All rights reserved.
+# This file is part of dmclient.
+#
+# dmclient is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# dmclient is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dmclient.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+A persistent cache of extracted document text, shared by every campaign.
+
+Mining (and spellchecking) a PDF is by far the most expensive thing the oracle
+does, so the final text of every document is kept on disk, addressed by the
+SHA-1 of the source file's contents. The same rulebook attached to ten
+campaigns is therefore only mined once.
+
+Hashing a large file is itself not free, so the ``(path, mtime, size)`` of
+every file seen is remembered and used to skip rehashing files that have not
+changed on disk.
+
+The cache directory contains an SQLite index (``index.db``) and one UTF-8 text
+file per cached document. Each entry records the byte offset at which every
+page of the document begins, so that individual pages can be read back without
+loading the entire document.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from logging import getLogger
+from threading import Lock
+
+__all__ = ["CacheWriter", "TextCache", "file_digest"]
+
+log = getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS texts (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    offsets TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS texts_last_used ON texts (last_used);
+"""
+
+
+def file_digest(path, blocksize=1 << 20):
+    """
+    :return: The hex SHA-1 digest of the contents of the file at ``path``.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class TextCache:
+    """
+    A size-bounded, least-recently-used store of extracted text.
+
+    Instances are safe to share between threads. Several oracle processes may
+    share the same cache directory; SQLite arbitrates between them.
+    """
+
+    default_max_bytes = 512 * 1024 * 1024
+
+    def __init__(self, path, max_bytes=default_max_bytes):
+        """
+        :param path: The cache directory. It is created if necessary.
+        :param max_bytes: The total size of cached text to keep before the
+                          least recently used entries are evicted.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self.conn = sqlite3.connect(os.path.join(path, "index.db"),
+                                    timeout=30, check_same_thread=False)
+        with self.conn:
+            self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def digest(self, path):
+        """
+        :return: The content digest of the file at ``path``, which is only
+                 recomputed if the file's size or mtime have changed.
+        """
+        st = os.stat(path)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest FROM files WHERE path=? AND mtime=? AND size=?",
+                (path, st.st_mtime, st.st_size)).fetchone()
+        if row:
+            return row[0]
+        digest = file_digest(path)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?)",
+                              (path, st.st_mtime, st.st_size, digest))
+        return digest
+
+    def get(self, digest):
+        """
+        :return: A list of the cached pages for ``digest``, or ``None`` if the
+                 document is not cached.
+        """
+        pages = self.iter_pages(digest)
+        return None if pages is None else list(pages)
+
+    def iter_pages(self, digest):
+        """
+        :return: An iterator over the cached pages for ``digest``, reading
+                 one page at a time, or ``None`` if the document is not
+                 cached.
+        """
+        offsets = self._touch(digest)
+        if offsets is not None:
+            try:
+                f = open(self._blob_path(digest), 'rb')
+            except OSError as e:
+                log.warning("cached text for %s went missing: %s", digest, e)
+                self._forget(digest)
+            else:
+                self.hits += 1
+                return self._read_pages(f, offsets)
+        self.misses += 1
+        return None
+
+    @staticmethod
+    def _read_pages(f, offsets):
+        with f:
+            for start, end in zip(offsets, offsets[1:] + [None]):
+                yield f.read(None if end is None else end - start).decode()
+
+    def get_page(self, digest, page):
+        """
+        :return: The text of a single (zero-based) ``page``, or ``None``.
+        """
+        offsets = self._touch(digest)
+        if offsets is None or not 0 <= page < len(offsets):
+            return None
+        try:
+            with open(self._blob_path(digest), 'rb') as f:
+                f.seek(offsets[page])
+                if page + 1 < len(offsets):
+                    data = f.read(offsets[page + 1] - offsets[page])
+                else:
+                    data = f.read()
+        except OSError:
+            return None
+        return data.decode()
+
+    def put(self, digest, pages):
+        """
+        Store the extracted ``pages`` (an iterable of strings) of the document
+        whose contents hash to ``digest``.
+        """
+        with self.writer(digest) as writer:
+            for page in pages:
+                writer.write(page)
+
+    def writer(self, digest):
+        """
+        :return: A ``CacheWriter`` to stream the pages of the document whose
+                 contents hash to ``digest`` into the cache, one at a time.
+        """
+        return CacheWriter(self, digest)
+
+    def _store(self, digest, tmp_path, size, offsets):
+        # Another oracle may be racing to store the same document; whichever
+        # rename lands last wins, and both wrote identical bytes anyway.
+        os.replace(tmp_path, self._blob_path(digest))
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO texts VALUES (?,?,?,?)",
+                              (digest, size, json.dumps(offsets), time.time()))
+        self.evict()
+
+    def evict(self):
+        """Discard least recently used entries until under ``max_bytes``."""
+        with self.lock:
+            total, = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM texts").fetchone()
+            if total <= self.max_bytes:
+                return
+            victims = []
+            rows = self.conn.execute("SELECT digest, size FROM texts "
+                                     "ORDER BY last_used, rowid")
+            for digest, size in rows:
+                if total <= self.max_bytes:
+                    break
+                victims.append(digest)
+                total -= size
+        for digest in victims:
+            log.debug("evicting cached text %s", digest)
+            self._forget(digest)
+
+    def _touch(self, digest):
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT offsets FROM texts WHERE digest=?",
+                                    (digest,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE texts SET last_used=? WHERE digest=?",
+                              (time.time(), digest))
+        return json.loads(row[0])
+
+    def _forget(self, digest):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM texts WHERE digest=?", (digest,))
+        try:
+            os.remove(self._blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _blob_path(self, digest):
+        return os.path.join(self.path, digest + ".txt")
+
+
+class CacheWriter:
+    """
+    Appends pages to a new cache entry. The entry only becomes visible once
+    ``commit()`` is called; used as a context manager, it is committed if the
+    block completes and discarded otherwise (e.g. when the document being
+    extracted is cancelled part way through).
+    """
+
+    def __init__(self, cache, digest):
+        self.cache = cache
+        self.digest = digest
+        self.offsets = []
+        self.size = 0
+        # Several threads (or oracles) may be writing the same digest at once,
+        # e.g. for notes with the same contents, so each has a file of its own.
+        blob = cache._blob_path(digest)
+        fd, self.tmp_path = tempfile.mkstemp(
+            ".tmp", os.path.basename(blob) + ".", os.path.dirname(blob))
+        self.file = os.fdopen(fd, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def write(self, page):
+        data = page.encode()
+        self.offsets.append(self.size)
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.file.close()
+        self.cache._store(self.digest, self.tmp_path, self.size, self.offsets)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
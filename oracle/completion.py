@@ -0,0 +1,277 @@
+# oracle/completion.py
+# Copyright (C) 2018 Alex Mair. All rights reserved.
+# This file is part of dmclient.
+#
+# dmclient is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# dmclient is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dmclient.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+As-you-type completion for the search box.
+
+Completions come from two places:
+
+* The words of every indexed document, weighted by how often they occur
+  across the whole index. This is kept up to date as documents are added,
+  replaced and removed, rather than being rebuilt.
+* The names of things in the campaign (players, notes, map pins...), which
+  always rank above plain words.
+
+Both are kept as sorted lists, so the candidates for a prefix are a contiguous
+slice found by bisection. One and two letter prefixes match such a large
+slice that ranking it takes tens of milliseconds, so the best words for every
+short prefix are maintained as documents are indexed instead.
+"""
+
+import re
+from bisect import bisect_left, insort
+from heapq import nlargest, nsmallest
+from itertools import islice
+from threading import Lock
+
+__all__ = ["CompletionIndex", "completion_terms"]
+
+_word_re = re.compile(r'\w+')
+
+# Prefixes this short (or shorter) have their best words maintained.
+_short_prefix_length = 2
+_short_prefix_words = 32
+
+
+def completion_terms(termlist):
+    """
+    :param termlist: An iterable of ``(term, frequency)`` pairs, e.g. from a
+                     xapian document's term list.
+    :return: A dictionary of the plain words in ``termlist`` to their
+             frequencies. Prefixed terms (``Zfoo``, ``Q12``...) and numbers
+             are not worth completing.
+    """
+    terms = {}
+    for term, frequency in termlist:
+        if isinstance(term, bytes):
+            term = term.decode()
+        if len(term) > 1 and term.isalpha() and term.islower():
+            terms[term] = terms.get(term, 0) + frequency
+    return terms
+
+
+class CompletionIndex:
+    """
+    Instances are safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.words = []
+        self.weights = {}
+        self.entity_keys = []
+        # Lower-case key to a list of (name, kind) pairs.
+        self.entities = {}
+        self.entity_names = {}
+        # Short prefix to a sorted list of its best (-weight, word) pairs.
+        self.top = {}
+        self.lock = Lock()
+
+    def add_terms(self, terms):
+        """
+        :param terms: A dictionary of words to frequencies, as produced by
+                      ``completion_terms()``.
+        """
+        with self.lock:
+            weights = self.weights
+            new = []
+            for word, frequency in terms.items():
+                if word in weights:
+                    weights[word] += frequency
+                else:
+                    weights[word] = frequency
+                    new.append(word)
+            # Inserting one at a time is quadratic; for many words, a single
+            # merge with the (already sorted) vocabulary is far cheaper.
+            if len(new) > 64:
+                self.words = self._merged(self.words, sorted(new))
+            else:
+                for word in new:
+                    insort(self.words, word)
+            self._promote(terms)
+
+    def remove_terms(self, terms):
+        with self.lock:
+            weights = self.weights
+            removed = []
+            demoted = set()
+            for word, frequency in terms.items():
+                weight = weights.get(word)
+                if weight is None:
+                    continue
+                if weight > frequency:
+                    weights[word] = weight - frequency
+                else:
+                    del weights[word]
+                    removed.append(word)
+                for prefix in self.short_prefixes([word]):
+                    if any(w == word for _, w in self.top.get(prefix, ())):
+                        demoted.add(prefix)
+            if len(removed) > 64:
+                self.words = [w for w in self.words if w in weights]
+            else:
+                for word in removed:
+                    del self.words[bisect_left(self.words, word)]
+            for prefix in demoted:
+                self._rank_prefix(prefix)
+
+    def update_terms(self, old, new):
+        """
+        Replace the terms ``old`` of a document with ``new``. Only the
+        difference between them is applied, so reindexing a document that
+        has barely changed is cheap.
+        """
+        added, removed = {}, {}
+        for word, frequency in new.items():
+            delta = frequency - old.get(word, 0)
+            if delta > 0:
+                added[word] = delta
+            elif delta < 0:
+                removed[word] = -delta
+        for word, frequency in old.items():
+            if word not in new:
+                removed[word] = frequency
+        if removed:
+            self.remove_terms(removed)
+        if added:
+            self.add_terms(added)
+
+    @staticmethod
+    def _merged(words, new):
+        """
+        :return: The sorted list of ``words`` and ``new`` (both sorted, and
+                 with no words in common), copied a run at a time.
+        """
+        merged = []
+        start = 0
+        for word in new:
+            end = bisect_left(words, word, start)
+            merged.extend(words[start:end])
+            merged.append(word)
+            start = end
+        merged.extend(words[start:])
+        return merged
+
+    @staticmethod
+    def short_prefixes(words):
+        return {word[:n] for word in words
+                for n in range(1, min(len(word), _short_prefix_length) + 1)}
+
+    def _promote(self, words):
+        """
+        Update the best words of the short prefixes of ``words``, whose
+        weights have only gone up. Only ``words`` are merged into each list,
+        so the cost is that of ``words`` rather than of the vocabulary.
+        """
+        weights = self.weights
+        entries = {}
+        for word in words:
+            entry = (-weights[word], word)
+            for prefix in self.short_prefixes([word]):
+                entries.setdefault(prefix, []).append(entry)
+        for prefix, promoted in entries.items():
+            changed = {word for _, word in promoted}
+            top = [entry for entry in self.top.get(prefix, ())
+                   if entry[1] not in changed]
+            self.top[prefix] = nsmallest(_short_prefix_words, top + promoted)
+
+    def _rank_prefix(self, prefix):
+        """Find the best words of a short prefix from scratch."""
+        weights = self.weights
+        self.top[prefix] = nsmallest(
+            _short_prefix_words,
+            ((-weights[word], word) for word in self._prefixed_words(prefix)))
+
+    def set_entities(self, kind, names):
+        """
+        Replace the names of every entity of ``kind`` (e.g. ``"player"``).
+        Names may be completed from any of their words.
+        """
+        names = sorted(set(names))
+        with self.lock:
+            if self.entity_names.get(kind) == names:
+                return
+            self.entity_names[kind] = names
+            entities = {}
+            for entity_kind, entity_names in self.entity_names.items():
+                for name in entity_names:
+                    for key in self.entity_keys_for(name):
+                        entities.setdefault(key, []).append((name,
+                                                             entity_kind))
+            self.entities = entities
+            self.entity_keys = sorted(entities)
+
+    @staticmethod
+    def entity_keys_for(name):
+        """
+        :return: The lower-case keys ``name`` is found under; the whole name,
+                 and the rest of it from the start of each word.
+        """
+        lower = name.lower()
+        return {lower[m.start():] for m in _word_re.finditer(lower)} | {lower}
+
+    def complete(self, prefix, limit=10):
+        """
+        :return: A list of up to ``limit`` ``(completion, kind)`` pairs for
+                 ``prefix``. The kind of a plain word is ``"term"``.
+        """
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        with self.lock:
+            completions = self._complete_entities(prefix, limit)
+            seen = {name.lower() for name, _ in completions}
+            for word in self._complete_words(prefix, limit):
+                if len(completions) >= limit:
+                    break
+                if word not in seen:
+                    completions.append((word, "term"))
+        return completions
+
+    def _complete_entities(self, prefix, limit):
+        keys = self.entity_keys
+        completions = []
+        seen = set()
+        for i in range(bisect_left(keys, prefix), len(keys)):
+            key = keys[i]
+            if not key.startswith(prefix):
+                break
+            for entity in self.entities[key]:
+                if entity not in seen:
+                    seen.add(entity)
+                    completions.append(entity)
+                    if len(completions) >= limit:
+                        return completions
+        return completions
+
+    def _complete_words(self, prefix, limit):
+        if len(prefix) <= _short_prefix_length \
+                and limit <= _short_prefix_words:
+            return [word for _, word in islice(self.top.get(prefix, ()),
+                                                limit)]
+        return nlargest(limit, self._prefixed_words(prefix),
+                        key=self.weights.__getitem__)
+
+    def _prefixed_words(self, prefix):
+        words = self.words
+        lo = bisect_left(words, prefix)
+        # Every word starting with prefix sorts before prefix + U+10FFFF.
+        hi = bisect_left(words, prefix + '\U0010ffff', lo)
+        return words[lo:hi]
+
+    def stats(self):
+        return {"words": len(self.words), "entities": len(self.entities)}
+
@@ -0,0 +1,229 @@
+# oracle/corpus.py
+# Copyright (C) 2018 Alex Mair. All rights reserved.
+# This file is part of dmclient.
+#
+# dmclient is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# dmclient is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dmclient.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Synthetic campaign documents, for benchmarking the oracle.
+
+The same seed always produces byte-for-byte the same corpus, so that results
+from different revisions of the oracle can be compared. Words are drawn from
+a tabletop RPG vocabulary with a Zipf-like distribution, which gives the
+index roughly the shape of a real rulebook's: a few very common words, and a
+long tail of names, spells and monsters that turn up only a handful of times.
+
+PDFs are written by hand rather than with a PDF library. They are as simple
+as PDFs get (one Helvetica text object per page), which is plenty for
+pdfminer to have to lay out.
+"""
+
+import os
+from collections import namedtuple
+from itertools import accumulate
+from random import Random
+
+__all__ = ["CorpusGenerator", "CorpusDocument", "VOCABULARY", "pdf_document"]
+
+CorpusDocument = namedtuple("CorpusDocument", "path kind size")
+
+_common = """
+the of and to a in is you that it for as with on be your this are by can or
+an at if creature its each has from target turn one must not which their
+attack damage roll saving throw hit points level spell action bonus check
+round within feet range ability score modifier armor class speed until
+""".split()
+
+_game = """
+dungeon master player character party adventure campaign session encounter
+initiative advantage disadvantage concentration ritual component material
+somatic verbal cantrip slot rest short long inspiration proficiency skill
+perception stealth athletics acrobatics arcana history insight investigation
+medicine nature religion deception intimidation performance persuasion
+survival strength dexterity constitution intelligence wisdom charisma
+fighter wizard cleric rogue ranger paladin barbarian bard druid monk sorcerer
+warlock dwarf elf halfling human gnome tiefling dragonborn orc goblin kobold
+longsword shortsword dagger crossbow longbow quarterstaff mace warhammer
+shield chainmail leather plate potion scroll wand staff ring amulet cloak
+tavern village castle crypt tower forest swamp mountain cavern temple ruins
+dragon lich beholder owlbear troll ogre giant wyvern basilisk gelatinous cube
+mimic skeleton zombie ghoul wraith vampire werewolf hag kraken hydra
+fireball lightning bolt magic missile cure wounds healing word shield bless
+bane sleep charm person hold dispel counterspell polymorph teleport wish
+poisoned stunned paralyzed frightened grappled prone restrained invisible
+necrotic radiant psychic thunder acid cold fire force poison piercing
+slashing bludgeoning gold silver copper platinum experience treasure hoard
+""".split()
+
+_syllables = """
+ar bel cor dra el fen gor hal ith jor kar lor mor nim or pel quor ros sil
+tor ul vor wyn xan yr zan ba ce di fo gu ka le mi no ra se ti vu
+""".split()
+
+# Common words first, so that they are drawn most often.
+VOCABULARY = _common + _game
+
+
+class CorpusGenerator:
+    def __init__(self, seed=0, vocabulary=VOCABULARY, names=200):
+        """
+        :param seed: Generators with the same seed generate the same corpus.
+        :param names: The number of proper names (of NPCs, places...) to mix
+                      in with the vocabulary.
+        """
+        self.random = Random(seed)
+        self.names = [self.name() for _ in range(names)]
+        self.words = list(vocabulary) + self.names
+        # The n-th most common word is drawn with probability ~ 1/n.
+        self.cumulative_weights = list(accumulate(
+            1 / rank for rank in range(1, len(self.words) + 1)))
+
+    def name(self):
+        syllables = self.random.choice((2, 2, 3))
+        return ''.join(self.random.choice(_syllables)
+                       for _ in range(syllables)).capitalize()
+
+    def sample_words(self, n):
+        return self.random.choices(self.words,
+                                   cum_weights=self.cumulative_weights, k=n)
+
+    def sentence(self):
+        words = self.sample_words(self.random.randint(6, 18))
+        if self.random.random() < 0.2:
+            # Dice notation and numbers, which the indexer must cope with.
+            words.insert(self.random.randrange(len(words)),
+                         "{}d{}".format(self.random.randint(1, 8),
+                                        self.random.choice((4, 6, 8, 10, 12,
+                                                            20))))
+        sentence = ' '.join(words)
+        return sentence[0].upper() + sentence[1:] + '.'
+
+    def paragraph(self):
+        return ' '.join(self.sentence()
+                        for _ in range(self.random.randint(3, 7)))
+
+    def page(self, words=350):
+        """:return: A list of the lines of a page of about ``words`` words."""
+        lines = []
+        line = []
+        for word in ' '.join(self.paragraph()
+                             for _ in range(words // 60 + 1)).split():
+            line.append(word)
+            if len(line) >= 12:
+                lines.append(' '.join(line))
+                line = []
+        if line:
+            lines.append(' '.join(line))
+        return lines
+
+    def markdown(self, sections=4):
+        parts = ["# {} of {}\n".format(self.random.choice(_game).title(),
+                                       self.random.choice(self.names))]
+        for _ in range(sections):
+            parts.append("\n## {}\n\n".format(
+                ' '.join(self.sample_words(3)).title()))
+            parts.append(self.paragraph() + "\n")
+            if self.random.random() < 0.5:
+                parts.append('\n' + ''.join(
+                    "* **{}** {}\n".format(*self.sample_words(2))
+                    for _ in range(self.random.randint(2, 6))))
+        return ''.join(parts)
+
+    def session_log(self, paragraphs=(5, 40)):
+        return '\n\n'.join(self.paragraph()
+                           for _ in range(self.random.randint(*paragraphs)))
+
+    def note_text(self):
+        """:return: The text of a short, internal note."""
+        return '\n\n'.join(self.paragraph()
+                           for _ in range(self.random.randint(1, 4)))
+
+    def generate(self, directory, pdfs=10, notes=40, pages=(4, 40)):
+        """
+        Write ``pdfs`` PDFs and ``notes`` plaintext and Markdown files into
+        ``directory``.
+
+        :param pages: The smallest and largest number of pages of a PDF.
+        :return: A list of ``CorpusDocument`` instances.
+        """
+        os.makedirs(directory, exist_ok=True)
+        documents = []
+        for i in range(pdfs):
+            path = os.path.join(directory, "rulebook-{:04d}.pdf".format(i))
+            npages = self.random.randint(*pages)
+            data = pdf_document([self.page() for _ in range(npages)])
+            with open(path, 'wb') as f:
+                f.write(data)
+            documents.append(CorpusDocument(path, "pdf", len(data)))
+        for i in range(notes):
+            if i % 2:
+                name, text = "notes-{:04d}.md".format(i), self.markdown()
+            else:
+                name, text = "log-{:04d}.txt".format(i), self.session_log()
+            path = os.path.join(directory, name)
+            data = text.encode()
+            with open(path, 'wb') as f:
+                f.write(data)
+            documents.append(CorpusDocument(path, "plaintext", len(data)))
+        return documents
+
+
+def _pdf_string(text):
+    text = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return '(' + text + ')'
+
+
+def pdf_document(pages):
+    """
+    :param pages: A list of pages, each of which is a list of lines of
+                  (Latin-1) text, or ``None`` for a page of artwork with no
+                  text at all.
+    :return: The bytes of a PDF document of ``pages``.
+    """
+    # Objects 1 and 2 are the catalog and page tree, and 3 is the font. Each
+    # page is then a page object followed by its content stream.
+    npages = len(pages)
+    kids = ' '.join("{} 0 R".format(4 + 2 * i) for i in range(npages))
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [{}] /Count {} >>".format(kids, npages),
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, lines in enumerate(pages):
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            "/Resources << /Font << /F1 3 0 R >> >> "
+            "/Contents {} 0 R >>".format(5 + 2 * i))
+        if lines is None:
+            content = "q 0.5 g 54 54 504 684 re f Q"
+        else:
+            content = "BT /F1 10 Tf 14 TL 54 750 Td\n{}\nET".format(
+                '\n'.join(_pdf_string(line) + " Tj T*" for line in lines))
+        content = content.encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream"
+                       % (len(content), content))
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        if isinstance(obj, str):
+            obj = obj.encode("latin-1")
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += (b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(objects) + 1, xref))
+    return bytes(out)
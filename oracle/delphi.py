@@ -24,12 +24,18 @@ to the oracle, you must first travel to Delphi  :)
     multiple connections to the oracle? Implement that one-to-many mapping.
 
 """
+import os
 import sys
 import threading
-from itertools import product
+from itertools import count, product
 from logging import getLogger
 from multiprocessing import Pipe
 
+from core.config import CACHE_PATH
+from oracle.exceptions import ProtocolError
+from oracle.protocol import Channel, RingBuffer, REQUEST, RESPONSE, PARTIAL, \
+    ERROR, EVENT
+
 log = getLogger("delphi")
 
 if __debug__:
@@ -77,7 +83,7 @@ class DummyDelphi:
         self.enabled = True
         self.documents = []
 
-    def start(self, _, __, ___):
+    def start(self, _, __, ___, shared_db_path=None):
         pass
 
     def init_database(self, _, __):
@@ -86,6 +92,21 @@ class DummyDelphi:
     def search_query(self, query):
         log.debug("dummy delphi received %s", query)
 
+    def notes_changed(self):
+        pass
+
+    def notes_opened(self, _):
+        pass
+
+    def complete(self, _, limit=10):
+        pass
+
+    def entity_names(self, _, __):
+        pass
+
+    def request_queue(self):
+        pass
+
     def shutdown(self):
         pass
 
@@ -98,6 +119,9 @@ class Delphi:
     *Delphi* represents the dmclient endpoint of the oracle api. It is
     responsible for dispatching search and indexing requests to the oracle
     and handling errors.
+
+    Requests and responses are framed as described in ``oracle.protocol``.
+    Every request is tagged with a new id, which its response carries back.
     """
 
     listen_timeout = 1
@@ -116,8 +140,22 @@ class Delphi:
         self.documents = []
         self.keep_going = False
         self.listen_thread = None
+        self.metrics = {}
+        # The indexing metrics last published by the oracle, see
+        # ``oracle.metrics.IndexingMetrics.snapshot()``.
+        self.progress = {}
+        self.queue = []
+        self.request_ids = count(1)
+        self.last_query_id = None
+        self.search_results = None
+        self.last_completion_id = None
+        self.completions = None
+        # Request id to the partial results received for it so far.
+        self.partials = {}
         pipe = Pipe()
         self.delphi_connection, self.oracle_connection = pipe
+        # The ring buffer is attached once the oracle is started.
+        self.channel = Channel(self.delphi_connection)
 
     @property
     def enabled(self):
@@ -131,8 +169,80 @@ class Delphi:
         log.debug("Delphi requested to index external: (%s, %s)", uuid, path)
         self.responder.indexing_started()
 
-    def search_query(self, query):
-        self._send_message("search %s", query)
+    def request(self, method, payload=None):
+        """
+        Send a request to the oracle.
+
+        :param method: A method name from ``oracle.protocol.METHODS``.
+        :return: The id of the request, which its response will carry.
+        """
+        request_id = next(self.request_ids)
+        self.channel.send(REQUEST, method, request_id, payload)
+        return request_id
+
+    def search_query(self, query, offset=0, limit=10):
+        """
+        Ask the oracle to search for ``query``. The response arrives later, in
+        ``search_completed()``.
+
+        :param offset: The rank of the first result wanted.
+        :param limit: The maximum number of results wanted.
+        :return: The id the response will be tagged with.
+        """
+        self.last_query_id = self.request("search", {
+            "query": query, "offset": offset, "limit": limit})
+        return self.last_query_id
+
+    def complete(self, prefix, limit=10):
+        """
+        Ask the oracle for completions of ``prefix``, which arrive later in
+        ``completions_received()``. Unlike searches, this is cheap enough to
+        do on every keystroke.
+
+        :return: The id the response will be tagged with.
+        """
+        self.last_completion_id = self.request("complete", {
+            "prefix": prefix, "limit": limit})
+        return self.last_completion_id
+
+    def completions_received(self, response):
+        if response["id"] != self.last_completion_id:
+            return
+        self.completions = response
+        signal = getattr(self.responder, "completions_received", None)
+        if signal is not None:
+            signal.emit(response)
+
+    def entity_names(self, kind, names):
+        """
+        Tell the oracle the names of every campaign entity of ``kind`` which it
+        cannot find in the campaign database itself, such as map pins, so
+        that they can be completed.
+        """
+        self.request("entities", {"kind": kind, "names": list(names)})
+
+    def request_metrics(self):
+        """Ask the oracle to send its latest metrics, see ``metrics``."""
+        self.request("metrics")
+
+    def notes_changed(self):
+        """
+        Tell the oracle that notes have been committed to the campaign
+        database, rather than waiting for it to notice by itself.
+        """
+        self.request("sync_notes")
+
+    def notes_opened(self, note_ids):
+        """
+        Tell the oracle that the user is looking at ``note_ids``, so that they
+        are indexed before anything else.
+        """
+        if note_ids:
+            self.request("boost", {"notes": list(note_ids)})
+
+    def request_queue(self):
+        """Ask the oracle to send its pending indexing work, see ``queue``."""
+        self.request("queue")
 
     def error(self):
         """
@@ -143,17 +253,44 @@ class Delphi:
         self.responder.on_error()
 
     def search_completed(self, id, results):
-        log.debug("received some completed results for %s: %s", id, results)
-
-    def start(self, campaign_db_path, xapian_db_path, responder):
+        """
+        :param results: The response dictionary described in
+                        ``oracle.search``.
+        """
+        if id != self.last_query_id:
+            log.debug("ignoring stale results for query %s", id)
+            return
+        log.debug("received %d results for query %s in %.3fs",
+                  len(results["results"]), id, results["latency"])
+        self.search_results = results
+        signal = getattr(self.responder, "search_results_received", None)
+        if signal is not None:
+            signal.emit(results)
+
+    def start(self, campaign_db_path, xapian_db_path, responder,
+              shared_db_path=None):
+        """
+        :param shared_db_path: The path of the index shared by the campaigns
+                               of the game system, if any.
+        """
         self.responder = responder
         self.keep_going = True
+        ring_path = os.path.join(os.path.dirname(xapian_db_path),
+                                 "delphi.ring")
+        try:
+            self.channel.ring = RingBuffer.create(ring_path)
+        except OSError as e:
+            log.warning("cannot create ring buffer, large responses will be "
+                        "sent through the pipe: %s", e)
+            ring_path = None
         self.listen_thread = threading.Thread(target=self.listen_loop,
                                               name="delphi")
         self.listen_thread.start()
         self.oracle_pid = self.zygote.spawn(
             {"delphi": self.oracle_connection, "campaign": campaign_db_path,
-             "xapian": xapian_db_path})
+             "xapian": xapian_db_path, "ring": ring_path,
+             "shared": shared_db_path,
+             "cache": os.path.join(CACHE_PATH, "text")})
         log.debug("delphi started, spawned oracle PID = %d", self.oracle_pid)
 
     def shutdown(self):
@@ -165,16 +302,56 @@ class Delphi:
     def listen_loop(self):
         log.debug("delphi thread started")
         timeout = self.listen_timeout
-        delphi_connection = self.delphi_connection
+        channel = self.channel
         while self.keep_going:
-            if delphi_connection.poll(timeout):
-                obj = delphi_connection.recv()
-                # FIXME: This is garbage.
-                if obj == "SIGTERM":
-                    self.quit(0)
-                elif obj == "hurk dead":
-                    log.warning("the oracle appears to have imbibed too much")
-                log.warning("received `%s' from oracle", obj)
-
-    def _send_message(self, message, *args):
-        self.delphi_connection.send(message % args)
+            if channel.poll(timeout):
+                try:
+                    self.received(channel.recv())
+                except ProtocolError as e:
+                    log.error("bad message from the oracle: %s", e.msg)
+
+    def received(self, message):
+        """Handle a ``Message`` from the oracle."""
+        kind, method, request_id, payload = message
+        if kind == PARTIAL:
+            self.partials.setdefault(request_id, []).append(payload)
+        elif kind == RESPONSE:
+            self.response_received(method, request_id, payload)
+        elif kind == EVENT:
+            if method == "terminated":
+                self.quit(0)
+            elif method == "crashed":
+                log.warning("the oracle appears to have imbibed too much: %s",
+                            payload)
+            elif method == "progress":
+                self.progress_received(payload)
+        elif kind == ERROR:
+            self.partials.pop(request_id, None)
+            log.error("oracle failed to answer %s request %d: %s", method,
+                      request_id, payload)
+        else:
+            log.warning("received unexpected %s message from oracle", method)
+
+    def progress_received(self, progress):
+        self.progress = progress
+        signal = getattr(self.responder, "indexing_progress", None)
+        if signal is not None:
+            signal.emit(progress)
+
+    def response_received(self, method, request_id, payload):
+        if method == "search":
+            # Results may have been streamed ahead of the response.
+            results = [result for part in self.partials.pop(request_id, ())
+                       for result in part]
+            payload["results"] = results + payload["results"]
+            self.search_completed(request_id, payload)
+        elif method == "complete":
+            self.completions_received(payload)
+        elif method == "metrics":
+            self.metrics = payload
+            log.debug("oracle metrics: %s", payload)
+        elif method == "queue":
+            self.queue = payload
+            log.debug("oracle queue: %s", payload)
+        else:
+            log.warning("received unknown `%s' response from oracle", method)
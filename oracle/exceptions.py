@@ -12,4 +12,9 @@ class IndexingError(Exception):
     """Occurs when a document cannot be indexed."""
 
 
+class IndexingCancelled(IndexingError):
+    """Occurs when a document is deleted or replaced while being indexed."""
 
+
+class ProtocolError(OracleError):
+    """Occurs when a malformed message is received from the other process."""
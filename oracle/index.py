@@ -16,30 +16,131 @@
 #
 
 """Classes and functions for indexing search providers."""
+import json
+import struct
+import time
+from bisect import bisect_right
 from logging import getLogger
 
 import xapian
 
+from oracle.exceptions import IndexingCancelled
+
 log = getLogger(__name__)
 
+# Document value slots.
+VALUE_PAGES = 0
+# The content digest of a document in a game system's shared index.
+VALUE_DIGEST = 1
+
+# Term positions skipped between pages, so that phrases cannot span them.
+PAGE_GAP = 100
+
+
+def pack_page_starts(starts):
+    """
+    :param starts: The first term position of each page of a document.
+    :return: ``starts`` packed for storage in the ``VALUE_PAGES`` slot.
+    """
+    return struct.pack(">{}I".format(len(starts)), *starts)
+
+
+def unpack_page_starts(value):
+    return struct.unpack(">{}I".format(len(value) // 4), value)
+
+
+def document_notes(data):
+    """
+    :param data: The decoded data of a document.
+    :return: The ids of every note whose content the document is.
+    """
+    if "notes" in data:
+        return data["notes"]
+    # Documents indexed before they were shared between notes.
+    return [data["note"]] if data.get("note") is not None else []
+
+
+def page_of(starts, position):
+    """
+    :param starts: The unpacked ``VALUE_PAGES`` of a document.
+    :return: The zero-based page containing term ``position``.
+    """
+    return max(0, bisect_right(starts, position) - 1)
+
 
 class Indexer:
-    def __init__(self):
+    """
+    Feeds documents into xapian one page at a time. Pages are never joined
+    together, and the text itself is not stored in the document, so memory
+    use does not depend on the size of the document.
+    """
+
+    def __init__(self, metrics=None):
+        """
+        :param metrics: An optional ``IndexingMetrics`` to record the time
+                        spent extracting and generating terms in.
+        """
         stemmer = xapian.Stem("english")
         self.term_generator = xapian.TermGenerator()
         self.term_generator.set_stemmer(stemmer)
         self.stemmer = stemmer
+        self.metrics = metrics
+        # The number of characters indexed by the last call to index_note().
+        self.indexed_size = 0
+
+    def index_note(self, provider, note, cancelled=None):
+        """
+        :param provider: The provider to extract the note's pages with.
+        :param note: The note to index.
+        :param cancelled: An optional function, polled between pages, which
+                          returns ``True`` if indexing should be abandoned.
+        :return:  The Xapian document associated with the note, and the note
+                  id. The starting term position of each page is stored in
+                  the ``VALUE_PAGES`` slot of the document.
+        :raises: IndexingCancelled
+        """
+        pages = provider.extract_document_pages(note.url)
+        return self.index_pages(note, pages, cancelled)
 
-    def index_note(self, provider, note):
+    def index_pages(self, note, pages, cancelled=None):
         """
+        Index text that is already at hand, e.g. the text of an internal note,
+        as the pages of ``note``. See ``index_note()``.
 
-        :param provider:
-        :param note:
-        :return:  The Xapian document associated with the note.
+        :param pages: An iterable of the text of each page.
         """
-        text = provider.extract_document_text(note.url)
         document = xapian.Document()
-        document.set_data(text)
-        self.term_generator.set_document(document)
-        self.term_generator.index_text(text)
+        term_generator = self.term_generator
+        term_generator.set_document(document)
+        starts = []
+        size = 0
+        extract_time = term_time = 0
+        clock = time.perf_counter
+        pages = iter(pages)
+        while 1:
+            start = clock()
+            page = next(pages, None)
+            extract_time += clock() - start
+            if page is None:
+                break
+            if cancelled and cancelled():
+                # Stop extraction (and any cache writes) right away, rather
+                # than whenever the generator is garbage collected.
+                if hasattr(pages, "close"):
+                    pages.close()
+                raise IndexingCancelled(note.id)
+            if starts:
+                term_generator.increase_termpos(PAGE_GAP)
+            starts.append(term_generator.get_termpos())
+            start = clock()
+            term_generator.index_text(page)
+            term_time += clock() - start
+            size += len(page)
+        if self.metrics is not None:
+            self.metrics.stage("extract").add(extract_time)
+            self.metrics.stage("terms").add(term_time)
+        document.add_value(VALUE_PAGES, pack_page_starts(starts))
+        document.set_data(json.dumps({"notes": [note.id], "url": note.url,
+                                      "pages": len(starts)}))
+        self.indexed_size = size
         return document, note.id
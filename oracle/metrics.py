@@ -0,0 +1,238 @@
+# oracle/metrics.py
+# Copyright (C) 2018 Alex Mair. All rights reserved.
+# This file is part of dmclient.
+#
+# dmclient is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# dmclient is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dmclient.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Lightweight measurements of what the oracle is spending its time on."""
+
+import sys
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = ["Histogram", "IndexingMetrics", "Rate", "resident_memory"]
+
+
+def resident_memory():
+    """
+    :return: The resident set size of this process in bytes, or ``None`` if
+             it cannot be measured. Without ``psutil``, it is the peak
+             resident set size so far.
+    """
+    if psutil is not None:
+        try:
+            return psutil.Process().memory_info().rss
+        except psutil.Error:
+            pass
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        maxrss *= 1024
+    return maxrss
+
+
+class Histogram:
+    """
+    A running summary of a stream of samples. A window of the most recent
+    samples is kept so that percentiles reflect current behaviour rather than
+    the entire lifetime of the oracle.
+    """
+
+    def __init__(self, window=256):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.recent = deque(maxlen=window)
+        self.lock = Lock()
+
+    def add(self, value):
+        with self.lock:
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+            self.recent.append(value)
+
+    @contextmanager
+    def time(self):
+        """Add the wall-clock duration (in seconds) of a ``with`` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(time.perf_counter() - start)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, p):
+        """
+        :param p: A percentile between 0 and 100.
+        :return: The ``p``-th percentile of the recent samples, or ``0`` if
+                 there are none.
+        """
+        with self.lock:
+            samples = sorted(self.recent)
+        if not samples:
+            return 0
+        index = min(len(samples) - 1, int(len(samples) * p / 100))
+        return samples[index]
+
+    def snapshot(self):
+        """
+        :return: A plain dictionary summarising the histogram, suitable for
+                 sending to Delphi.
+        """
+        return {"count": self.count, "mean": self.mean, "min": self.min,
+                "max": self.max, "p50": self.percentile(50),
+                "p99": self.percentile(99)}
+
+
+class Rate:
+    """
+    The rate at which something (documents, bytes...) is happening, averaged
+    over the last ``window`` seconds.
+    """
+
+    def __init__(self, window=30.0, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.total = 0
+        self.events = deque()
+        self.lock = Lock()
+
+    def add(self, amount=1):
+        with self.lock:
+            self.total += amount
+            self.events.append((self.clock(), amount))
+
+    def per_second(self):
+        now = self.clock()
+        with self.lock:
+            events = self.events
+            while events and events[0][0] < now - self.window:
+                events.popleft()
+            if not events:
+                return 0.0
+            # Until a whole window has passed, average over the time since
+            # the first event rather than pretending it was idle before then.
+            elapsed = max(now - events[0][0], 1.0)
+            return sum(amount for _, amount in events) / min(elapsed,
+                                                             self.window)
+
+
+class IndexingMetrics:
+    """
+    Where the oracle's indexing time goes. Each document passes through the
+    following stages, each of which has a ``Histogram`` of its latency (in
+    seconds, per document or per batch):
+
+    ``extract``
+        Waiting for the provider to produce the document's pages, which
+        includes any spellchecking done on the way.
+    ``spellcheck``
+        Spellchecking mined text. This happens in parallel on the PDF
+        provider's process pool, so it is the time spent by the workers
+        rather than wall-clock time.
+    ``terms``
+        Generating xapian terms from the pages.
+    ``commit``
+        Committing a batch of documents to the database.
+
+    Pages which providers found had no text to extract, and so skipped, are
+    counted in ``pages_skipped``.
+    """
+
+    stage_names = ("extract", "spellcheck", "terms", "commit")
+
+    def __init__(self, window=30.0, commit_latency=None):
+        """
+        :param window: The number of seconds throughput is averaged over.
+        :param commit_latency: The ``Histogram`` the ``BatchWriter`` records
+                               its commits in, if any.
+        """
+        self.stages = {name: Histogram() for name in self.stage_names}
+        if commit_latency is not None:
+            self.stages["commit"] = commit_latency
+        self.documents = Rate(window)
+        self.bytes = Rate(window)
+        # Like ``bytes``, but in the units documents are queued with.
+        self.queued_bytes = Rate(window)
+        self.pages_skipped = 0
+
+    def stage(self, name):
+        return self.stages[name]
+
+    def skipped_pages(self, n):
+        self.pages_skipped += n
+
+    def indexed(self, size, queued_size=None):
+        """
+        Count a document of ``size`` bytes (of text) as indexed.
+
+        :param queued_size: The size the document was queued with, if not
+                            ``size``: e.g. the size of a PDF file, which is
+                            nothing like that of its text.
+        """
+        self.documents.add(1)
+        self.bytes.add(size)
+        self.queued_bytes.add(size if queued_size is None else queued_size)
+
+    def snapshot(self, queue):
+        """
+        :param queue: The pending indexing work, as returned by
+                      ``IndexScheduler.queue()``.
+        :return: A plain dictionary of the metrics, suitable for sending to
+                 Delphi. ``eta`` is the estimated number of seconds until
+                 the queue is empty, or ``None`` if it cannot be estimated.
+        """
+        documents_per_second = self.documents.per_second()
+        bytes_per_second = self.bytes.per_second()
+        queued_bytes = sum(job["size"] for job in queue)
+        # Queued sizes are not sizes of text, so neither is their rate.
+        queued_bytes_per_second = self.queued_bytes.per_second()
+        eta = None
+        if queued_bytes and queued_bytes_per_second:
+            eta = queued_bytes / queued_bytes_per_second
+        elif queue and documents_per_second:
+            eta = len(queue) / documents_per_second
+        elif not queue:
+            eta = 0.0
+        return {"indexed": self.documents.total,
+                "indexed_bytes": self.bytes.total,
+                "documents_per_second": documents_per_second,
+                "bytes_per_second": bytes_per_second,
+                "queue_depth": len(queue), "queued_bytes": queued_bytes,
+                "eta": eta, "pages_skipped": self.pages_skipped,
+                "stages": {name: histogram.snapshot()
+                           for name, histogram in self.stages.items()},
+                "rss": resident_memory()}
@@ -19,8 +19,10 @@
 This module provides the majority of the implementation of the *oracle*, the
 document indexing and searching powered by xapian.
 
-The oracle is a separate process that periodically checks the campaign database
-for documents. It then attempts to index those documents in a separate thread.
+The oracle is a separate process that follows the campaign database's note
+change-log (see ``campaign.note.NoteChange``), either when Delphi tells it that
+notes were committed or periodically. It then attempts to index the changed
+documents in a separate thread.
 Search queries are read line-by-line from ``stdin`` and return results as a
 JSON result object.
 
@@ -28,35 +30,54 @@ The context in which this module is imported and executed is within that
 oracle subprocess, _not_ the primary dmclient process.
 """
 
+import hashlib
 import importlib
+import json
 import logging
+import os
+import sqlite3
 import sys
-from concurrent.futures import ThreadPoolExecutor
+import time
+from datetime import datetime
+from functools import partial
 from threading import Lock, Thread
+from urllib.parse import urlparse
 
 import xapian
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 
-from campaign.note import Note
-from oracle.index import Indexer
+from campaign import Player
+from campaign.note import InternalNote, Note, NoteChange
+from oracle.batch import BatchWriter
+from oracle.cache import TextCache
+from oracle.completion import CompletionIndex, completion_terms
+from oracle.exceptions import IndexingCancelled, ProtocolError
+from oracle.index import Indexer, VALUE_DIGEST, document_notes
+from oracle.metrics import IndexingMetrics
+from oracle.protocol import Channel, RingBuffer, REQUEST, RESPONSE, \
+    PARTIAL, ERROR, EVENT
+from oracle.provider import FileProvider
+from oracle.scheduler import IndexScheduler
+from oracle.search import Searcher
 
 log = logging.getLogger("dmoracle")
 
 
-def _load_default_providers():
+def _load_default_providers(cache=None):
     """
-
+    :param cache: The ``TextCache`` shared by the providers, if any.
     :return: A dictionary of provider-name to provider classes.
     """
     providers = {}
-    default_providers = ["pdf"]
+    default_providers = ["pdf", "plaintext"]
     for provider_name in default_providers:
         try:
             log.debug("loading search provider `%s'...", provider_name)
             provider_module = importlib.import_module(
                 "oracle.provider.{}".format(provider_name))
-            providers[provider_name] = provider_module.Provider()
+            providers[provider_name] = provider_module.Provider(cache=cache)
             log.debug("done!")
         except AttributeError:
             log.error("search provider `%s' is unusable (no Provider found)",
@@ -69,33 +90,348 @@ def _load_default_providers():
 
 
 class OracleDatabase:
-    def __init__(self, xdb):
-        self.documents = {}
+    """
+    The oracle's xapian database, which persists between sessions.
+
+    Every indexed note has exactly one xapian document, identified by the
+    unique term ``Q<note id>``. Alongside it, a *version record* is stored in
+    the database metadata under ``note:<note id>``. The record is a JSON
+    object containing the note's ``url``, the ``digest`` of its contents
+    when it was indexed and the time it was indexed at (``indexed_at``),
+    which lets the oracle skip notes that have not changed since last time.
+
+    Notes with identical contents (the same PDF attached to several notes,
+    say) share a single document, which is also identified by the term
+    ``XH<digest>``. It has a ``Q`` term for each of its notes, and lists them
+    all in its data, and it is deleted along with the last of them.
+
+    A game system's shared index (see ``OracleController``) is also an
+    ``OracleDatabase``, but its documents belong to no note, or campaign.
+    They are identified by their ``XH`` term alone, and keep their digest in
+    the ``VALUE_DIGEST`` slot. The time each was last used by a campaign is
+    kept in its ``used:<digest>`` metadata, and documents no campaign has
+    used for ``shared_max_age`` seconds are pruned (see ``prune_shared()``).
+    A campaign that does still refer to one just indexes it again.
+    """
+
+    record_prefix = "note:"
+    used_prefix = "used:"
+
+    # About six months.
+    shared_max_age = 180 * 24 * 60 * 60
+
+    def __init__(self, xdb, path=None):
         self.xdb = xdb
+        self.path = path
         self.lock = Lock()
+        # Bumped every time a batch of writes is committed.
+        self.revision = 0
+        # Kept in step with the documents, see ``build_completions()``.
+        self.completions = None
+        # Changes to ``completions`` made in the current transaction, which
+        # only apply once it commits; ``None`` outside of a transaction.
+        self.completion_changes = None
 
     @classmethod
     def from_xapian(cls, path):
-        # TODO
-        xdb = xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OVERWRITE)
-        db = cls(xdb)
+        xdb = xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OPEN)
+        db = cls(xdb, path)
         return db
 
+    @staticmethod
+    def note_term(note_id):
+        return "Q{}".format(note_id)
+
+    @staticmethod
+    def content_term(digest):
+        return "XH{}".format(digest)
+
+    def find_document(self, term):
+        """:return: The docid of the document with ``term``, or ``None``."""
+        for posting in self.xdb.postlist(term):
+            return posting.docid
+        return None
+
+    def records(self):
+        """
+        :return: A dictionary of note id to version record for every note in
+                 the database.
+        """
+        records = {}
+        prefix = self.record_prefix
+        for key in self.xdb.metadata_keys(prefix):
+            key = key.decode()
+            try:
+                records[int(key[len(prefix):])] = json.loads(
+                    self.xdb.get_metadata(key).decode())
+            except ValueError as e:
+                log.warning("ignoring corrupt version record `%s': %s",
+                            key, e)
+        return records
+
+    def build_completions(self):
+        """
+        Build the ``CompletionIndex`` of every word in the database, which
+        is then updated as notes are replaced or deleted.
+        """
+        xdb = self.xdb
+        completions = CompletionIndex()
+        completions.add_terms(completion_terms(
+            (t.term, xdb.get_collection_freq(t.term)) for t in xdb.allterms()))
+        self.completions = completions
+        return completions
+
+    def begin_transaction(self):
+        self.xdb.begin_transaction()
+        self.completion_changes = []
+
+    def commit_transaction(self):
+        self.xdb.commit_transaction()
+        changes, self.completion_changes = self.completion_changes, None
+        for change in changes:
+            change()
+
+    def cancel_transaction(self):
+        self.xdb.cancel_transaction()
+        self.completion_changes = None
+
+    def update_completions(self, method, *args):
+        """
+        Call ``method`` of ``completions`` with ``args``, once the current
+        transaction (if any) commits.
+        """
+        if self.completions is None:
+            return
+        change = partial(getattr(self.completions, method), *args)
+        if self.completion_changes is None:
+            change()
+        else:
+            self.completion_changes.append(change)
+
+    def document_data(self, document):
+        """
+        :param document: A xapian document, or its docid.
+        :return: The document's decoded data.
+        """
+        if isinstance(document, int):
+            document = self.xdb.get_document(document)
+        return json.loads(document.get_data().decode())
+
+    def document_terms(self, docid):
+        """:return: The completion terms of the document ``docid``."""
+        return completion_terms((t.term, t.wdf)
+                                for t in self.xdb.termlist(docid))
+
+    def set_record(self, note_id, record):
+        self.xdb.set_metadata(self.record_prefix + str(note_id),
+                              json.dumps(record) if record else "")
+
+    def replace_note(self, note_id, document, record):
+        """
+        Add or replace the document (and version record) for a note. If a
+        document with the same ``digest`` as ``record`` has been added since
+        the note was extracted, the note shares it and ``document`` is
+        discarded.
+        """
+        digest = record.get("digest")
+        if digest and self.link_note(note_id, record):
+            return
+        term = self.note_term(note_id)
+        docid = self.find_document(term)
+        old_terms = {}
+        if docid is not None:
+            if len(document_notes(self.document_data(docid))) > 1:
+                # Other notes still have the old contents.
+                self.unlink_note(note_id)
+                docid = None
+            else:
+                old_terms = self.document_terms(docid)
+        document.add_boolean_term(term)
+        if digest:
+            document.add_boolean_term(self.content_term(digest))
+        self.update_completions("update_terms", old_terms, completion_terms(
+            (t.term, t.wdf) for t in document.termlist()))
+        if docid is None:
+            self.xdb.add_document(document)
+        else:
+            self.xdb.replace_document(docid, document)
+        self.set_record(note_id, record)
+
+    def link_note(self, note_id, record):
+        """
+        Make a note share the document with the same ``digest`` as
+        ``record``.
+
+        :return: ``False`` if there is no such document.
+        """
+        docid = self.find_document(self.content_term(record["digest"]))
+        if docid is None:
+            return False
+        document = self.xdb.get_document(docid)
+        data = self.document_data(document)
+        notes = document_notes(data)
+        if note_id not in notes:
+            self.unlink_note(note_id)
+            data["notes"] = notes + [note_id]
+            data.pop("note", None)
+            document.set_data(json.dumps(data))
+            document.add_boolean_term(self.note_term(note_id))
+            self.xdb.replace_document(docid, document)
+        self.set_record(note_id, record)
+        return True
+
+    def unlink_note(self, note_id):
+        """
+        Remove a note from the document it shares with other notes, or
+        delete the document if it was the only one.
+        """
+        term = self.note_term(note_id)
+        docid = self.find_document(term)
+        if docid is None:
+            return
+        document = self.xdb.get_document(docid)
+        data = self.document_data(document)
+        notes = [n for n in document_notes(data) if n != note_id]
+        if not notes:
+            if self.completions is not None:
+                self.update_completions("remove_terms",
+                                        self.document_terms(docid))
+            self.xdb.delete_document(docid)
+            return
+        if data.get("url") is not None:
+            # The url is used to find snippets, so it should be one that is
+            # still in the campaign.
+            record = self.record(notes[0])
+            if record and record.get("url"):
+                data["url"] = record["url"]
+        data["notes"] = notes
+        data.pop("note", None)
+        document.set_data(json.dumps(data))
+        document.remove_term(term)
+        self.xdb.replace_document(docid, document)
+
+    def record(self, note_id):
+        value = self.xdb.get_metadata(self.record_prefix + str(note_id))
+        try:
+            return json.loads(value.decode()) if value else None
+        except ValueError:
+            return None
+
+    def delete_note(self, note_id):
+        self.unlink_note(note_id)
+        self.set_record(note_id, None)
+
+    def share_note(self, note_id, record):
+        """
+        Record that a note's contents are in the shared index, rather than
+        this one.
+        """
+        self.unlink_note(note_id)
+        self.set_record(note_id, record)
+
+    def shared_digests(self):
+        """:return: The set of content digests in a shared index."""
+        prefix = self.content_term("").encode()
+        return {t.term[len(prefix):].decode()
+                for t in self.xdb.allterms(prefix)}
+
+    def add_shared(self, digest, document):
+        """Add a document to a shared index, unless it is there already."""
+        term = self.content_term(digest)
+        if self.find_document(term) is not None:
+            return
+        document.add_boolean_term(term)
+        document.add_value(VALUE_DIGEST, digest)
+        self.xdb.add_document(document)
+        self.touch_shared([digest])
+
+    def shared_terms(self, digest):
+        """
+        :return: The completion terms of the shared document of ``digest``,
+                 or ``None`` if there is no such document.
+        """
+        docid = self.find_document(self.content_term(digest))
+        if docid is None:
+            return None
+        return self.document_terms(docid)
+
+    def touch_shared(self, digests, now=None):
+        """Record that the shared documents of ``digests`` are in use."""
+        now = str(now or time.time())
+        for digest in digests:
+            self.xdb.set_metadata(self.used_prefix + digest, now)
+
+    def prune_shared(self, max_age=None, now=None):
+        """
+        Delete the shared documents that no campaign has used for
+        ``max_age`` seconds (by default, ``shared_max_age``).
+
+        :return: The digests of the documents deleted.
+        """
+        now = now or time.time()
+        cutoff = now - (max_age or self.shared_max_age)
+        pruned = []
+        for digest in self.shared_digests():
+            key = self.used_prefix + digest
+            try:
+                used = float(self.xdb.get_metadata(key).decode())
+            except ValueError:
+                # Never recorded, so its age is unknown: start counting now.
+                self.touch_shared([digest], now)
+                continue
+            if used >= cutoff:
+                continue
+            self.xdb.delete_document(self.find_document(
+                self.content_term(digest)))
+            self.xdb.set_metadata(key, "")
+            pruned.append(digest)
+        return pruned
+
+    def committed(self):
+        self.revision += 1
+
 
 class OracleController:
     """
     Mediator and Listener class.
+
+    Rulebooks belong to a game system rather than to any one campaign, so
+    documents mined by the ``shared_providers`` go into an index shared by
+    every campaign of the game system, if there is one. A rulebook is then
+    mined once per machine, however many campaigns refer to it. The
+    campaign's index only records which of its notes have which contents,
+    and the two are searched together.
     """
     database_prefix = "dmoracle"
     database_suffix = "xapian.db"
+    sync_interval = 2
 
-    def __init__(self, oracle_connection, engine, database, providers=None):
+    # The requests Delphi may make, and whether each is answered (and so
+    # whether its handler takes the request id).
+    requests = {"search": True, "complete": True, "metrics": True,
+                "queue": True, "sync_notes": False, "boost": False,
+                "entities": False}
+
+    # Search results are streamed to Delphi in batches of this many.
+    result_batch = 25
+
+    # The minimum number of seconds between progress events sent to Delphi
+    # while indexing.
+    progress_interval = 1.0
+
+    # The providers whose documents go in the game system's shared index.
+    shared_providers = ("pdf",)
+
+    def __init__(self, oracle_connection, engine, database, providers=None,
+                 shared=None):
         """
 
-        :param oracle_connection: The oracle's connection to Delphi.
+        :param oracle_connection: The oracle's ``Channel`` to Delphi.
         :param engine: An SQLAlchemy engine associated with the campaign
                        database.
         :param database: The ``OracleDatabase`` to work from.
+        :param shared: The ``OracleDatabase`` of the game system's shared
+                       index, if any.
         """
         self.oracle_connection = oracle_connection
 
@@ -103,103 +439,642 @@ class OracleController:
         self.Session = self.create_session(self.campaign_engine)
 
         self.database = database
+        self.writer = BatchWriter(database, dropped=self.write_dropped)
+        self.indexing = IndexingMetrics(
+            commit_latency=self.writer.commit_latency)
+        self.last_progress = 0
+
+        # Note id to version record, for everything in the database.
+        self.notemap = database.records()
 
-        self.notemap = {}
+        self.shared = shared
+        self.shared_writer = None
+        # The content digests of every document in the shared index.
+        self.shared_digests = set()
+        # Those of the shared documents whose words are in ``completions``.
+        self.shared_completions = set()
+        self.shared_completions_lock = Lock()
+        if shared is not None:
+            self.shared_writer = BatchWriter(
+                shared, dropped=self.shared_write_dropped)
+            with shared.lock:
+                shared.touch_shared(self.referenced_shared_digests())
+                pruned = shared.prune_shared()
+                shared.xdb.commit()
+            if pruned:
+                log.info("pruned %d unused documents from the shared index",
+                         len(pruned))
+            self.shared_digests = shared.shared_digests()
+        # Content digest to the ids of the notes with that content. Indexing
+        # threads change it while searcher threads read it, so every access
+        # holds ``digests_lock``.
+        self.digests = {}
+        self.digests_lock = Lock()
+        for note_id, record in self.notemap.items():
+            self.add_digest(note_id, record)
+        # Notes that have been compared against their record this session.
+        self.checked = set()
+        # The last change-log sequence number consumed, or ``None`` if the
+        # notes have not been reconciled against the index yet.
+        self.last_change = None
         if not providers:
             providers = {}
         self.providers = providers
+        for provider in providers.values():
+            provider.metrics = self.indexing
+        self.shareable = {providers[name] for name in self.shared_providers
+                          if name in providers}
+        # URL to the provider of each local file seen.
+        self.file_providers = {}
 
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        self.pending = []
+        self.completions = database.build_completions()
+        # The number of players, and their largest id, when last read.
+        self.players_version = None
+        self.sync_shared_completions()
+        self.scheduler = IndexScheduler()
+        self.searcher = Searcher(xapian.Stem("english"), database,
+                                 self.reply_search, self.page_text, shared,
+                                 self.shared_notes)
         self.thread = Thread(target=self.exec, name="listener")
 
     @classmethod
     def create_session(cls, engine):
-        return sessionmaker(bind=engine)
+        # Notes are handed to the scheduler after their session has committed.
+        return sessionmaker(bind=engine, expire_on_commit=False)
+
+    def reply(self, method, request_id, payload, kind=RESPONSE):
+        """Send the response to a request back to Delphi."""
+        self.oracle_connection.send(kind, method, request_id, payload)
+
+    def reply_search(self, response):
+        """
+        Send a search ``response`` to Delphi, streaming all but the last
+        ``result_batch`` results ahead of it.
+        """
+        results = response["results"]
+        last = max(0, len(results) - self.result_batch)
+        for start in range(0, last, self.result_batch):
+            self.reply("search", response["id"],
+                       results[start:min(start + self.result_batch, last)],
+                       PARTIAL)
+        response["results"] = results[last:]
+        self.reply("search", response["id"], response)
+
+    def search(self, request_id, query, offset=0, limit=10):
+        """
+        Search for ``query``. The response is sent back to Delphi tagged with
+        ``request_id``; see ``oracle.search``.
+        """
+        self.searcher.submit(request_id, query, offset, limit)
+
+    def complete(self, request_id, prefix, limit=10):
+        """Send up to ``limit`` completions of ``prefix`` back to Delphi."""
+        start = time.perf_counter()
+        completions = self.completions.complete(prefix, limit)
+        self.reply("complete", request_id, {
+            "id": request_id, "prefix": prefix, "completions": completions,
+            "latency": time.perf_counter() - start})
+
+    def entities(self, kind, names):
+        """
+        Set the names of every campaign entity of ``kind`` the oracle cannot
+        see for itself (e.g. map pins).
+        """
+        self.completions.set_entities(kind, names)
+
+    def refresh_entities(self, session, notes=True):
+        """
+        Read the names of notes (if ``notes``), and of players if there are
+        more or fewer of them than last time, for completion.
+        """
+        if notes:
+            self.completions.set_entities(
+                "note", (name for name, in session.query(Note.name) if name))
+        try:
+            # Players are not in the change-log, so they are only read again
+            # when one is added or removed.
+            version = session.query(func.count(Player.id),
+                                    func.max(Player.id)).one()
+            if version == self.players_version:
+                return
+            players = [name for name, in session.query(Player.name) if name]
+        except SQLAlchemyError as e:
+            log.debug("cannot read players: %s", e)
+        else:
+            self.players_version = version
+            self.completions.set_entities("player", players)
 
-    def search(self, *query):
-        self.searcher.pending.put(' '.join(query))
+    def page_text(self, data, page):
+        """:return: The text of ``page`` of the indexed document ``data``."""
+        if "digest" in data:
+            # A shared document may have been mined in another campaign, so
+            # this campaign's own copy is used.
+            notes = self.shared_notes(data["digest"])
+            if notes:
+                data = dict(data, url=self.notemap[notes[0]]["url"])
+        if not data.get("url"):
+            notes = document_notes(data)
+            return self.internal_note_text(notes[0]) if notes else None
+        provider = self.provider_for(data["url"])
+        if provider is None:
+            return None
+        return provider.document_page(data["url"], page)
+
+    def provider_for(self, url):
+        """
+        Providers are looked up by the scheme of ``url`` first. Local files
+        (``file://`` URLs) go to the first file provider that will accept
+        them, e.g. by their extension.
+
+        Only the providers found are remembered: a file that nothing will
+        accept (yet) may have been missing, and is checked again next time.
+
+        :return: The provider for the document at ``url``, or ``None``.
+        """
+        provider = self.providers.get(urlparse(url).scheme)
+        if provider is not None:
+            return provider
+        try:
+            return self.file_providers[url]
+        except KeyError:
+            pass
+        for provider in self.providers.values():
+            if not isinstance(provider, FileProvider):
+                continue
+            try:
+                if provider.is_acceptable_document(provider.local_path(url)):
+                    break
+            except Exception as e:
+                log.debug("cannot check `%s': %s", url, e)
+        else:
+            return None
+        self.file_providers[url] = provider
+        return provider
 
     def exec(self):
-        conn = self.oracle_connection
+        channel = self.oracle_connection
         while 1:
             try:
-                if conn.poll(2):
-                    self.execute_command(conn.recv())
+                if channel.poll(self.sync_interval):
+                    self.handle(channel.recv())
                 else:
                     self.sync_notes()
             except EOFError:
                 log.error("error: received end-of-file")
                 break
-            except UnicodeDecodeError as e:
-                log.error("error receiving command: %s", e)
-
-    def execute_command(self, cmdstr):
-        log.debug("received command: `%s'", cmdstr)
-        cmd, *args = cmdstr.split(' ')
-        log.debug("got cmd %s(%s)", cmd, args)
-        cmd_method = getattr(self, cmd, None)
-        if not cmd_method:
-            log.error("invalid command `%s'", cmdstr)
+            except ProtocolError as e:
+                log.error("error receiving request: %s", e.msg)
+
+    def handle(self, message):
+        """Dispatch a request ``Message`` from Delphi."""
+        kind, method, request_id, payload = message
+        log.debug("received %s request %d", method, request_id)
+        if kind != REQUEST or method not in self.requests:
+            log.error("invalid request `%s'", method)
             return
-        ret = cmd_method(*args)
-        if ret:
-            log.warning("cmd returned something...")
+        handler = getattr(self, method)
+        try:
+            if self.requests[method]:
+                handler(request_id, **(payload or {}))
+            else:
+                handler(**(payload or {}))
+        except Exception as e:
+            log.exception("%s request %d failed", method, request_id)
+            if self.requests[method]:
+                self.reply(method, request_id, str(e), ERROR)
 
     def sync_notes(self):
+        """
+        The first call reconciles every note against the index. Subsequent
+        calls only look at notes in the change-log since the previous call,
+        and only read the names of notes if there were any.
+
+        Errors reading the campaign database (which dmclient writes to at the
+        same time, so it may well be locked) are logged, and the sync is
+        tried again on the next call.
+        """
         session = self.Session()
-        notes = session.query(Note)
-        self.process_notes(notes)
+        try:
+            if self.last_change is None:
+                last_change = session.query(
+                    func.max(NoteChange.seq)).scalar() or 0
+                self.process_notes(session, session.query(Note).all())
+                self.last_change = last_change
+                changed = True
+            else:
+                changed = self.process_changes(session)
+            self.refresh_entities(session, notes=changed)
+        except SQLAlchemyError as e:
+            session.rollback()
+            log.warning("cannot sync notes, will retry: %s", e)
+        finally:
+            session.close()
 
-    def process_notes(self, notes):
-        notemap = self.notemap
+    def process_changes(self, session):
+        """:return: ``True`` if there were any changes."""
+        changes = session.query(NoteChange.seq, NoteChange.note_id) \
+            .filter(NoteChange.seq > self.last_change) \
+            .order_by(NoteChange.seq).all()
+        if not changes:
+            return False
+        note_ids = {change.note_id for change in changes}
+        notes = {note.id: note for note in
+                 session.query(Note).filter(Note.id.in_(note_ids))}
+        self.index_notes(session, notes.values(), recent=True)
+        for note_id in note_ids - set(notes):
+            self.remove_note(note_id)
+        # Only now are the changes consumed: if the database could not be
+        # read, they are read again next time.
+        self.last_change = changes[-1].seq
+        # Nothing else reads the change-log, so it may as well stay small.
+        session.query(NoteChange) \
+            .filter(NoteChange.seq <= self.last_change) \
+            .delete(synchronize_session=False)
+        session.commit()
+        return True
+
+    def process_notes(self, session, notes):
+        present = {note.id for note in notes}
+        self.index_notes(session, [note for note in notes
+                                   if note.id not in self.checked])
+        for note_id in set(self.notemap) - present:
+            self.remove_note(note_id)
+
+    def index_notes(self, session, notes, recent=False):
+        """
+        Schedule ``notes`` to be indexed. Internal notes (those without a URL)
+        are read from the campaign database together, see
+        ``index_internal_notes()``.
+        """
+        internal = []
         for note in notes:
-            if note.id not in notemap:
-                self.index_note(note)
+            if note.url:
+                self.index_note(note, recent)
+            else:
+                internal.append(note)
+        if internal:
+            self.index_internal_notes(session, internal, recent)
 
-    def index_note(self, note):
-        self.notemap[note.id] = None  # FIXME ugh
+    def index_internal_notes(self, session, notes, recent=False):
+        """
+        Internal notes are indexed straight from their text, which is read in
+        a single query. Notes whose text has the same digest as when they
+        were last indexed are skipped before a job is even scheduled.
+        """
+        texts = self.internal_note_texts(session, [note.id for note in notes])
+        for note in notes:
+            self.checked.add(note.id)
+            text = texts.get(note.id)
+            if text is None:
+                # The note has no text (yet), so there is nothing to find.
+                if note.id in self.notemap:
+                    self.remove_note(note.id)
+                continue
+            digest = hashlib.sha1(text.encode()).hexdigest()
+            record = self.notemap.get(note.id)
+            if record and record.get("digest") == digest:
+                continue
+            if self.shares_digest(note.id, digest):
+                self.link_note(note.id, {
+                    "url": None, "digest": digest,
+                    "indexed_at": datetime.now().isoformat()})
+                continue
+            self.scheduler.submit(
+                note.id, partial(self.internal_index_job, note, text, digest),
+                len(text), recent, lambda job: self.index_complete(job))
+
+    # Beyond this many notes, it is cheaper to read every internal note than
+    # to bind each id as a query parameter (SQLite allows at most 999).
+    internal_note_batch = 500
+
+    def internal_note_texts(self, session, note_ids):
+        """:return: A dictionary of note id to internal note text."""
+        query = session.query(InternalNote.note_id, InternalNote.text)
+        if len(note_ids) <= self.internal_note_batch:
+            query = query.filter(InternalNote.note_id.in_(note_ids))
+        wanted = set(note_ids)
+        return {note_id: text or "" for note_id, text in query
+                if note_id in wanted}
+
+    def internal_index_job(self, note, text, digest, job=None):
+        """Like ``index_job()``, but for the text of an internal note."""
+        indexer = Indexer(self.indexing)
+        cancelled = job.is_cancelled if job else None
+        document, note_id = indexer.index_pages(note, [text], cancelled)
+        record = {"url": None, "digest": digest,
+                  "indexed_at": datetime.now().isoformat()}
+        return document, note_id, record, indexer.indexed_size
+
+    def internal_note_text(self, note_id):
+        session = self.Session()
         try:
-            provider = self.providers[note.type]
-        except KeyError:
+            return self.internal_note_texts(session, [note_id]).get(note_id)
+        finally:
+            session.close()
+
+    @property
+    def pending(self):
+        """The number of notes queued or being indexed."""
+        return self.scheduler.pending
+
+    def index_note(self, note, recent=False):
+        """
+        Schedule ``note`` to be (re)indexed, replacing any indexing of it
+        already in progress.
+
+        :param recent: ``True`` if the note was added or changed during this
+                       session, which gives it priority over older notes.
+        """
+        self.checked.add(note.id)
+        provider = self.provider_for(note.url)
+        if provider is None:
             log.warning("warning: no provider for note `%s'", note.type)
-        else:
-            indexer = Indexer()
-            f = self.executor.submit(indexer.index_note, provider, note)
-            f.add_done_callback(self.index_complete)
-            self.pending.append(f)
+            return
+        try:
+            size = provider.document_size(note.url)
+        except OSError:
+            size = 0
+        self.scheduler.submit(note.id,
+                              lambda job: self.index_job(provider, note, job),
+                              size, recent,
+                              lambda job: self.index_complete(job))
+
+    def index_job(self, provider, note, job=None):
+        """
+        Runs on the scheduler. Notes whose contents match their version record
+        are not extracted again (unless they were in a shared index which is
+        now unavailable).
+
+        :return: A tuple of the new xapian document (or ``None`` if the note
+                 is up to date, or has the same contents as another note),
+                 the note id, the note's version record and the size of the
+                 document's text.
+        :raises: IndexingCancelled if ``job`` is cancelled part way through.
+        """
+        digest = provider.document_digest(note.url)
+        record = self.notemap.get(note.id)
+        stale = record and record.get("shared") \
+            and digest not in self.shared_digests
+        if record and digest and record.get("digest") == digest \
+                and not stale:
+            log.debug("note %d is up to date", note.id)
+            return None, note.id, record, 0
+        record = {"url": note.url, "digest": digest,
+                  "indexed_at": datetime.now().isoformat()}
+        shared = self.is_shared(provider, digest)
+        if shared:
+            record["shared"] = True
+            if digest in self.shared_digests:
+                log.debug("note %d is in the shared index", note.id)
+                return None, note.id, record, 0
+        elif self.shares_digest(note.id, digest):
+            # index_complete() links the note to the existing document.
+            return None, note.id, record, 0
+        indexer = Indexer(self.indexing)
+        cancelled = job.is_cancelled if job else None
+        document, note_id = indexer.index_note(provider, note, cancelled)
+        if shared:
+            data = json.loads(document.get_data().decode())
+            document.set_data(json.dumps({"digest": digest, "url": note.url,
+                                          "pages": data["pages"]}))
+        return document, note_id, record, indexer.indexed_size
 
-    def index_complete(self, f):
+    def is_shared(self, provider, digest):
+        """
+        :return: ``True`` if the document of ``digest`` belongs in the shared
+                 index.
+        """
+        return (self.shared is not None and bool(digest)
+                and provider in self.shareable)
+
+    def shared_notes(self, digest):
+        """:return: The ids of this campaign's notes with ``digest``."""
+        with self.digests_lock:
+            return sorted(self.digests.get(digest, ()))
+
+    def index_complete(self, job):
         try:
-            document, noteid = f.result()
+            document, noteid, record, size = job.result()
+        except IndexingCancelled:
+            log.debug("indexing of note %d was cancelled", job.note_id)
         except Exception as e:
             log.exception("failed to index: %s", e)
         else:
-            with self.database.lock:
-                self.database.xdb.add_document(document)
-            self.notemap[noteid] = document
+            # The note may have been deleted or replaced after it was indexed.
+            if not job.is_cancelled():
+                self.write_note(noteid, document, record, size, job.size)
         finally:
-            self.pending.remove(f)
+            self.flush_if_idle()
+            self.report_progress()
+
+    def write_note(self, note_id, document, record, size, queued_size=None):
+        """
+        Queue the results of ``index_job()`` to be written.
+
+        :param queued_size: The size the note's job was scheduled with.
+        """
+        if document is None and record == self.notemap.get(note_id):
+            return
+        shared = record.get("shared")
+        if document is None and not shared:
+            self.link_note(note_id, record)
+            return
+        if document is not None:
+            self.indexing.indexed(size, queued_size)
+            if shared:
+                self.shared_writer.add_shared(record["digest"], document, size)
+                self.shared_digests.add(record["digest"])
+            else:
+                self.writer.replace_note(note_id, document, record, size)
+        if shared:
+            self.writer.share_note(note_id, record)
+        self.remember(note_id, record)
+
+    def remove_note(self, note_id):
+        self.scheduler.cancel(note_id)
+        self.checked.discard(note_id)
+        if note_id not in self.notemap:
+            return
+        log.debug("note %d was deleted, removing it from the index", note_id)
+        self.writer.delete_note(note_id)
+        self.discard_digest(note_id, self.notemap.pop(note_id))
+        self.flush_if_idle()
+
+    def remember(self, note_id, record):
+        """Record that ``note_id`` has been indexed as ``record``."""
+        old = self.notemap.get(note_id)
+        if old is not None:
+            self.discard_digest(note_id, old)
+        self.notemap[note_id] = record
+        self.add_digest(note_id, record)
+
+    def write_dropped(self, note_id):
+        """
+        Forget the record of a note whose write failed, so that it is
+        indexed again rather than taken to be up to date.
+        """
+        record = self.notemap.pop(note_id, None)
+        if record is not None:
+            self.discard_digest(note_id, record)
+        self.checked.discard(note_id)
+
+    def shared_write_dropped(self, digest):
+        # Notes recorded as in the shared index are now stale, see
+        # ``index_job()``.
+        self.shared_digests.discard(digest)
+
+    def add_digest(self, note_id, record):
+        if record.get("digest"):
+            with self.digests_lock:
+                self.digests.setdefault(record["digest"], set()).add(note_id)
+
+    def discard_digest(self, note_id, record):
+        with self.digests_lock:
+            notes = self.digests.get(record.get("digest"))
+            if notes is not None:
+                notes.discard(note_id)
+                if not notes:
+                    del self.digests[record["digest"]]
+
+    def shares_digest(self, note_id, digest):
+        """
+        :return: ``True`` if a note other than ``note_id`` has been indexed
+                 with contents of ``digest``.
+        """
+        if not digest:
+            return False
+        with self.digests_lock:
+            return bool(self.digests.get(digest, set()) - {note_id})
+
+    def link_note(self, note_id, record):
+        """
+        Index a note by sharing the document of another note with the same
+        contents, rather than extracting it all over again.
+        """
+        log.debug("note %d has the same contents as note(s) %s", note_id,
+                  self.shared_notes(record["digest"]))
+        self.writer.link_note(note_id, record)
+        self.remember(note_id, record)
+
+    def flush_if_idle(self):
+        """Commit outstanding writes once there is no more indexing to do."""
+        if not self.pending:
+            self.writer.flush()
+            if self.shared_writer is not None:
+                self.shared_writer.flush()
+                self.sync_shared_completions()
+
+    def referenced_shared_digests(self):
+        """:return: The digests of the shared documents of this campaign."""
+        return {record["digest"] for record in list(self.notemap.values())
+                if record.get("shared") and record.get("digest")}
+
+    def sync_shared_completions(self):
+        """
+        Complete the words of the shared documents this campaign's notes
+        refer to, but not those of other campaigns' documents.
+        """
+        if self.shared is None:
+            return
+        with self.shared_completions_lock:
+            wanted = self.referenced_shared_digests()
+            for digest in wanted - self.shared_completions:
+                with self.shared.lock:
+                    terms = self.shared.shared_terms(digest)
+                if terms is not None:
+                    self.completions.add_terms(terms)
+                    self.shared_completions.add(digest)
+            for digest in self.shared_completions - wanted:
+                with self.shared.lock:
+                    terms = self.shared.shared_terms(digest)
+                if terms is not None:
+                    self.completions.remove_terms(terms)
+                self.shared_completions.discard(digest)
+
+    def report_progress(self):
+        """
+        Send Delphi a ``progress`` event with the indexing metrics, at most
+        every ``progress_interval`` seconds, and always once the queue has
+        drained.
+        """
+        now = time.monotonic()
+        if self.pending and now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+        self.reply("progress", 0,
+                   self.indexing.snapshot(self.scheduler.queue()), EVENT)
+
+    def boost(self, notes):
+        """
+        Index ``notes`` (a list of note ids) ahead of everything else; the UI
+        has them open, or they were recently searched for.
+        """
+        self.scheduler.boost(notes)
+
+    def queue(self, request_id=0):
+        self.reply("queue", request_id, self.scheduler.queue())
+
+    def metrics(self, request_id=0):
+        metrics = self.writer.metrics()
+        metrics["search_cache"] = self.searcher.cache.stats()
+        metrics["completions"] = self.completions.stats()
+        metrics["indexing"] = self.indexing.snapshot(self.scheduler.queue())
+        self.reply("metrics", request_id, metrics)
 
 
 def main(app_args, oracle_args):
     """
     :param app_args: CLI arguments for oracle process
-    :param oracle_args: The ``Connection`` object that lets us
-                 talk with dmclient proper
+    :param oracle_args: A dictionary of the ``Connection`` object that lets
+                        us talk with dmclient proper (``delphi``), the path
+                        of the ring buffer it reads large responses from
+                        (``ring``) and the paths of the databases,
+                        including the game system's ``shared`` index.
     """
-    delphi_conn = oracle_args["delphi"]
+    ring = None
+    if oracle_args.get("ring"):
+        try:
+            ring = RingBuffer.open(oracle_args["ring"])
+        except OSError as e:
+            log.error("ring buffer is unavailable: %s", e)
+    channel = Channel(oracle_args["delphi"], ring, ring_writer=True)
     engine = create_engine("sqlite:///{}".format(oracle_args["campaign"]))
     database = OracleDatabase.from_xapian(oracle_args["xapian"])
-    providers = _load_default_providers()
-    controller = OracleController(delphi_conn, engine, database, providers)
+    cache = None
+    if oracle_args.get("cache"):
+        try:
+            cache = TextCache(oracle_args["cache"])
+        except (OSError, sqlite3.Error) as e:
+            log.error("text cache is unavailable: %s", e)
+    shared = None
+    if oracle_args.get("shared"):
+        try:
+            os.makedirs(os.path.dirname(oracle_args["shared"]), exist_ok=True)
+            shared = OracleDatabase.from_xapian(oracle_args["shared"])
+        except (OSError, xapian.Error) as e:
+            # Most likely another campaign of the system is open.
+            log.warning("shared index is unavailable, rulebooks will be "
+                        "indexed with the campaign: %s", e)
+    providers = _load_default_providers(cache)
+    controller = OracleController(channel, engine, database, providers,
+                                  shared)
 
+    controller.searcher.start()
     try:
         controller.exec()
     except KeyboardInterrupt:
-        delphi_conn.send("SIGTERM")  # FIXME
-    except Exception:
-        delphi_conn.send("hurk dead")
+        channel.send(EVENT, "terminated")
+    except Exception as e:
+        log.exception("the oracle crashed")
+        channel.send(EVENT, "crashed", payload=str(e))
+    finally:
+        controller.searcher.stop()
+        controller.scheduler.shutdown()
+        controller.writer.close()
+        if controller.shared_writer is not None:
+            controller.shared_writer.close()
+        for provider in providers.values():
+            provider.shutdown()
 
     sys.exit(0)
 
@@ -0,0 +1,242 @@
+# oracle/protocol.py
+# Copyright (C) 2018 Alex Mair. All rights reserved.
+# This file is part of dmclient.
+#
+# dmclient is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# dmclient is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dmclient.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+The messages exchanged between Delphi and the oracle.
+
+Every message is a single frame sent with ``Connection.send_bytes()``, so
+nothing is ever pickled. A frame is a fixed header followed by the payload::
+
+    +------+-------+--------+------------+--------+---------------+
+    | kind | flags | method | request id | length | payload...    |
+    |  u8  |  u8   |  u16   |    u32     |  u32   | length bytes  |
+    +------+-------+--------+------------+--------+---------------+
+
+(all in network byte order). The *kind* says whether the frame is a request,
+a (partial) response, an error or an unsolicited event; *method* is one of
+``METHODS``. Responses carry the id of the request they answer, so any number
+of requests may be outstanding at once, and a response may be streamed as any
+number of ``PARTIAL`` frames followed by a final ``RESPONSE`` frame.
+
+Payloads are plain Python values (dictionaries, lists, strings, numbers...)
+serialized with ``marshal``, which is both ends' interpreter's own, very fast
+format. Large payloads from the oracle are not sent through the pipe at all:
+they are written to a ``RingBuffer`` shared by both processes, and the frame
+(flagged with ``FLAG_RING``) only says where to find them. Delphi's requests
+always go through the pipe, as a ring has a single producer.
+"""
+
+import marshal
+import mmap
+import os
+import struct
+from collections import namedtuple
+from logging import getLogger
+from threading import Lock
+
+from oracle.exceptions import ProtocolError
+
+__all__ = ["Channel", "Message", "RingBuffer", "METHODS", "REQUEST",
+           "RESPONSE", "PARTIAL", "ERROR", "EVENT"]
+
+log = getLogger(__name__)
+
+HEADER = struct.Struct("!BBHII")
+
+# Frame kinds.
+REQUEST = 1
+RESPONSE = 2
+PARTIAL = 3
+ERROR = 4
+EVENT = 5
+
+# Frame flags.
+FLAG_RING = 0x01
+
+# Method names and their codes on the wire. Codes must never be reused.
+METHODS = {
+    "search": 1,
+    "complete": 2,
+    "metrics": 3,
+    "sync_notes": 4,
+    "boost": 5,
+    "queue": 6,
+    "entities": 7,
+    "terminated": 8,
+    "crashed": 9,
+    "progress": 10,
+}
+
+_method_names = {code: name for name, code in METHODS.items()}
+
+Message = namedtuple("Message", "kind method request_id payload")
+
+
+class RingBuffer:
+    """
+    A single-producer, single-consumer byte ring in a memory-mapped file that
+    is shared by two processes.
+
+    The file begins with two unsigned 64-bit counters: the total number of
+    bytes ever written, and ever consumed. Only the producer advances the
+    first, and only the consumer the second, so no locking is needed
+    between the processes. The producer writes a payload, then tells the
+    consumer where it is through the pipe; the consumer copies it out and
+    advances its counter, which frees the space.
+    """
+
+    _counters = struct.Struct("=QQ")
+
+    def __init__(self, path, size):
+        """Use ``create()`` or ``open()`` instead."""
+        self.path = path
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), self._counters.size + size)
+        self.size = size
+
+    @classmethod
+    def create(cls, path, size=4 * 1024 * 1024):
+        with open(path, 'wb') as f:
+            f.truncate(cls._counters.size + size)
+        return cls(path, size)
+
+    @classmethod
+    def open(cls, path):
+        size = os.path.getsize(path) - cls._counters.size
+        return cls(path, size)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def counters(self):
+        return self._counters.unpack_from(self.map, 0)
+
+    def write(self, data):
+        """
+        :return: The position ``data`` was written at, to be passed to
+                 ``read()``, or ``None`` if there is not enough free space.
+        """
+        written, consumed = self.counters()
+        if len(data) > self.size - (written - consumed):
+            return None
+        self._copy_in(written, data)
+        struct.pack_into("=Q", self.map, 0, written + len(data))
+        return written
+
+    def read(self, position, length):
+        """Copy out (and free) the ``length`` bytes at ``position``."""
+        data = self._copy_out(position, length)
+        struct.pack_into("=Q", self.map, 8, position + length)
+        return data
+
+    def _copy_in(self, position, data):
+        base = self._counters.size
+        start = position % self.size
+        head = min(len(data), self.size - start)
+        self.map[base + start:base + start + head] = data[:head]
+        if head < len(data):
+            self.map[base:base + len(data) - head] = data[head:]
+
+    def _copy_out(self, position, length):
+        base = self._counters.size
+        start = position % self.size
+        head = min(length, self.size - start)
+        data = self.map[base + start:base + start + head]
+        if head < length:
+            data += self.map[base:base + length - head]
+        return data
+
+
+class Channel:
+    """
+    One end of a connection between Delphi and the oracle. Instances may be
+    used to send from several threads at once, but only one thread should
+    receive.
+    """
+
+    _location = struct.Struct("!QI")
+
+    # Payloads at least this large go through the ring buffer, if any.
+    ring_threshold = 16 * 1024
+
+    def __init__(self, connection, ring=None, ring_writer=False):
+        """
+        :param connection: A ``multiprocessing`` ``Connection``.
+        :param ring: An optional ``RingBuffer``. The oracle writes large
+                     payloads to it; Delphi reads them from it.
+        :param ring_writer: ``True`` for the end that writes to ``ring``. A
+                            ring only has a single producer, so the other
+                            end sends everything through the pipe.
+        """
+        self.connection = connection
+        self.ring = ring
+        self.ring_writer = ring_writer
+        self.lock = Lock()
+
+    def poll(self, timeout=0.0):
+        return self.connection.poll(timeout)
+
+    def send(self, kind, method, request_id=0, payload=None):
+        """
+        :param method: A name from ``METHODS``.
+        """
+        body = marshal.dumps(payload)
+        flags = 0
+        with self.lock:
+            if self.ring is not None and self.ring_writer \
+                    and len(body) >= self.ring_threshold:
+                position = self.ring.write(body)
+                if position is not None:
+                    body = self._location.pack(position, len(body))
+                    flags |= FLAG_RING
+            header = HEADER.pack(kind, flags, METHODS[method], request_id,
+                                 len(body))
+            self.connection.send_bytes(header + body)
+
+    def recv(self):
+        """
+        :return: The next ``Message``.
+        :raises: EOFError if the other end has closed the connection, or
+                 ProtocolError if the frame is malformed.
+        """
+        frame = self.connection.recv_bytes()
+        if len(frame) < HEADER.size:
+            raise ProtocolError("truncated frame ({} bytes)".format(
+                len(frame)))
+        kind, flags, code, request_id, length = HEADER.unpack_from(frame)
+        body = memoryview(frame)[HEADER.size:]
+        if len(body) != length:
+            raise ProtocolError("frame length mismatch")
+        try:
+            method = _method_names[code]
+        except KeyError:
+            raise ProtocolError("unknown method {}".format(code))
+        if flags & FLAG_RING:
+            if self.ring is None:
+                raise ProtocolError("ring buffer frame without a ring")
+            body = self.ring.read(*self._location.unpack(body))
+        try:
+            payload = marshal.loads(body)
+        except (EOFError, ValueError, TypeError) as e:
+            raise ProtocolError("bad payload: {}".format(e))
+        return Message(kind, method, request_id, payload)
+
+    def close(self):
+        self.connection.close()
+        if self.ring is not None:
+            self.ring.close()
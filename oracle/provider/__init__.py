@@ -18,13 +18,57 @@ editor.
 
 """
 
+import os
+
+from core import deurlify
+from oracle.cache import file_digest
+
 
 class SearchProvider:
     def __init__(self):
-        pass
+        # The oracle's ``IndexingMetrics``, if it is collecting any; set by
+        # the ``OracleController``.
+        self.metrics = None
+
+    def shutdown(self):
+        """Release any worker processes or other resources held."""
+
+    def document_digest(self, url):
+        """
+        :return: A digest of the contents of the document at ``url``, used to
+                 detect whether it has changed since it was last indexed.
+                 ``None`` means the provider cannot tell, and the document
+                 is always reindexed.
+        """
+        return None
+
+    def document_size(self, url):
+        """
+        :return: The size of the document at ``url`` in bytes, if known, which
+                 is used to index smaller documents first.
+        """
+        return 0
+
+    def document_page(self, url, page):
+        """
+        Used to show a snippet of a search result. Providers should only
+        return text they can get at cheaply, e.g. from a cache.
+
+        :return: The text of (zero-based) ``page`` of the document at ``url``,
+                 or ``None`` if it is not readily available.
+        """
+        return None
 
 
 class FileProvider(SearchProvider):
+    def __init__(self, cache=None):
+        """
+        :param cache: An optional ``oracle.cache.TextCache`` to consult before
+                      extracting a document, and to fill afterwards.
+        """
+        super().__init__()
+        self.cache = cache
+
     def is_acceptable_document(self, path):
         """
         Most provider subclasses will check the path and use ``magic`` module.
@@ -35,11 +79,64 @@ class FileProvider(SearchProvider):
         """
         return True
 
+    @staticmethod
+    def local_path(url):
+        """
+        :return: The filesystem path of ``url``, which may either be a
+                 ``file://`` URL or already a plain path.
+        """
+        if url.startswith("file://"):
+            return deurlify(url)
+        return url
+
+    def document_size(self, url):
+        return os.path.getsize(self.local_path(url))
+
+    def document_digest(self, url):
+        path = self.local_path(url)
+        if self.cache is not None:
+            return self.cache.digest(path)
+        return file_digest(path)
+
+    def document_page(self, url, page):
+        if self.cache is None:
+            return None
+        return self.cache.get_page(self.document_digest(url), page)
+
     def extract_document_text(self, path):  # wtf is path
+        return ''.join(self.extract_document_pages(path))
+
+    def extract_document_pages(self, url):
+        """
+        Pages are produced (and, on a cache miss, written to the cache) one at
+        a time, so a document never has to be held in memory in its entirety.
+
+        :return: An iterator over the (post-processed) text of each page of
+                 the document at ``url``.
+        """
+        path = self.local_path(url)
         try:
-            return self.extract_file_text(path)
+            if self.cache is None:
+                yield from self.extract_file_pages(path)
+                return
+            digest = self.cache.digest(path)
+            cached = self.cache.iter_pages(digest)
+            if cached is not None:
+                yield from cached
+                return
+            with self.cache.writer(digest) as writer:
+                for page in self.extract_file_pages(path):
+                    writer.write(page)
+                    yield page
         except OSError as e:
             raise IndexError("failed to index document!") from e
 
+    def extract_file_pages(self, path):
+        """
+        Providers for paginated formats should override this, preferably with
+        a generator. By default, the whole file is treated as a single page.
+        """
+        return [self.extract_file_text(path)]
+
     def extract_file_text(self, path):
         raise NotImplementedError
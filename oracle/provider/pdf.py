@@ -5,15 +5,25 @@ Provides a means to index PDFs.
 """
 import io
 import logging
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
-import autocorrect
 import magic
 import pdfminer
 import pdfminer.high_level
 import pdfminer.layout
 from pdfminer.image import ImageWriter
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdftypes import PDFException, PDFStream, resolve1
+from pdfminer.psparser import LIT, PSException
 
 from oracle.provider import FileProvider
+from oracle.spellcheck import SpellChecker
 
 __all__ = ["Provider"]
 
@@ -25,13 +35,20 @@ log = logging.getLogger(__name__)
 #   5 -> s
 #   1 -> t, l, variety of things...
 #
-# need to fix autocorrect too:
-#   it loves to turn d4, d6, etc into junk
-#
-# also, single punctuation does stupid things: & spellchecked to a
+# (autocorrect's own blunders, like turning d4 or & into junk, are avoided by
+# oracle.spellcheck.)
+
+def pdf_text(file, outfile, page_numbers=None, fast=False):
+    """
+    Renders the text of ``file`` into ``outfile``.
 
-def pdf_text(file, outfile):
-    no_laparams = False
+    :param page_numbers: A container of zero-based page numbers to restrict
+                         extraction to, or ``None`` for the whole document.
+    :param fast: Skip layout analysis. Text comes out in content stream
+                 order rather than reading order, and words at the ends of
+                 lines may run together, but it is several times faster.
+    """
+    no_laparams = fast
     all_texts = None
     detect_vertical = None
     word_margin = None
@@ -42,7 +59,6 @@ def pdf_text(file, outfile):
     codec = 'utf-8'
     strip_control = False
     maxpages = 0
-    page_numbers = None
     password = ""
     scale = 1.0
     rotation = 0
@@ -71,7 +87,183 @@ def pdf_text(file, outfile):
     pdfminer.high_level.extract_text_to_fp(file, outfile, **locals())
 
 
+def page_count(file):
+    """
+    Count the pages of ``file`` without interpreting any of them. The file
+    position is rewound afterwards.
+    """
+    try:
+        return sum(1 for _ in PDFPage.get_pages(file))
+    finally:
+        file.seek(0)
+
+
+# A string operand followed by one of the operators that show text: Tj, TJ,
+# ' and ".
+_show_text_re = re.compile(rb'[)>\]]\s*(?:Tj|TJ|\'|")(?![^\s/\[(<])')
+
+_form = LIT("Form")
+
+
+def has_text(page):
+    """
+    Cheaply tell whether a ``PDFPage`` has any text to extract, by scanning
+    its content streams (and those of the forms it draws) for text showing
+    operators without interpreting them. Scanned maps and artwork have none.
+
+    If the page cannot be scanned it is assumed to have text, so nothing is
+    ever wrongly skipped.
+    """
+    try:
+        return _streams_have_text(page.contents, page.resources, set())
+    except (PDFException, PSException, TypeError, ValueError) as e:
+        log.debug("cannot scan page %s for text: %s", page.pageid, e)
+        return True
+
+
+def _streams_have_text(streams, resources, seen):
+    for stream in streams:
+        stream = resolve1(stream)
+        if isinstance(stream, PDFStream) and \
+                _show_text_re.search(stream.get_data()):
+            return True
+    xobjects = resolve1((resolve1(resources) or {}).get("XObject")) or {}
+    for ref in xobjects.values():
+        xobject = resolve1(ref)
+        if not isinstance(xobject, PDFStream) or id(xobject) in seen \
+                or xobject.get("Subtype") is not _form:
+            continue
+        seen.add(id(xobject))
+        if _streams_have_text([xobject], xobject.get("Resources"), seen):
+            return True
+    return False
+
+
+def text_pages(file, first, last):
+    """
+    :return: The set of the zero-based numbers of the pages in
+             ``[first, last)`` of ``file`` that have text (see
+             ``has_text()``). The file position is rewound afterwards.
+    """
+    try:
+        # get_pages() yields only the pages asked for, in order.
+        pages = PDFPage.get_pages(file, range(first, last))
+        return {number for number, page in zip(range(first, last), pages)
+                if has_text(page)}
+    finally:
+        file.seek(0)
+
+
+def mine_pages(path, first, last, spellcheck=True, fast=False):
+    """
+    Extract the text of pages ``[first, last)`` from the PDF at ``path``.
+    Pages without any text (see ``has_text()``) are not interpreted at all,
+    and come out empty.
+
+    This is the unit of work handed to the provider's process pool, so it
+    must remain a module-level function (it is pickled by reference) and open
+    its own file handle.
+
+    :param fast: Skip layout analysis (see ``pdf_text()``).
+    :return: A list containing the text of each page, and a tuple of the
+             number of spellchecker lookups and corrections made, the
+             seconds spent spellchecking and the number of pages skipped.
+    """
+    with open(path, 'rb') as f:
+        numbers = text_pages(f, first, last)
+        mined = []
+        if numbers:
+            of = io.StringIO()
+            pdf_text(f, of, page_numbers=numbers, fast=fast)
+            mined = split_pages(of.getvalue())
+    mined = iter(mined)
+    pages = [next(mined, '') if number in numbers else ''
+             for number in range(first, last)]
+    skipped = last - first - len(numbers)
+    if not spellcheck:
+        return pages, (0, 0, 0, skipped)
+    checker = spellchecker()
+    lookups, corrections = checker.lookups, checker.corrections
+    start = time.perf_counter()
+    pages = [checker.spellchecked(page) for page in pages]
+    return pages, (checker.lookups - lookups,
+                   checker.corrections - corrections,
+                   time.perf_counter() - start, skipped)
+
+
+def split_pages(text):
+    """
+    Split the output of ``pdf_text()`` into pages. pdfminer terminates every
+    page with a form feed, so the last element of the split is always empty.
+    """
+    pages = text.split('\f')
+    if pages and not pages[-1]:
+        pages.pop()
+    return pages
+
+
+_spellchecker = None
+
+
+def spellchecker():
+    """
+    :return: This process's ``SpellChecker``. Each pool worker has its own, so
+             that their memos are not shipped back and forth.
+    """
+    global _spellchecker
+    if _spellchecker is None:
+        _spellchecker = SpellChecker()
+    return _spellchecker
+
+
+def spellchecked(text):
+    return spellchecker().spellchecked(text)
+
+
 class Provider(FileProvider):
+    """
+    Mines PDFs by splitting them into runs of ``pages_per_job`` pages, which
+    are extracted (and spellchecked) on a process pool and then reassembled
+    in page order. Documents small enough to fit in a single job are mined
+    in-process, as forking would cost more than it saves.
+
+    Pages without text, such as scanned maps and artwork, are skipped. In
+    ``fast`` mode, layout analysis is skipped too, which is fine for
+    indexing as the order of the words on a page hardly matters.
+    """
+
+    pages_per_job = 8
+
+    def __init__(self, max_workers=None, cache=None, fast=False):
+        """
+        :param max_workers: The size of the mining process pool. Defaults to
+                            the number of processors on the machine.
+        :param fast: Extract text without layout analysis.
+        """
+        super().__init__(cache)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.fast = fast
+        self._pool = None
+        self.spellcheck_lookups = 0
+        self.spellcheck_corrections = 0
+        self.pages_skipped = 0
+
+    @property
+    def pool(self):
+        # Created lazily: the oracle may never see a PDF at all. By then the
+        # oracle has threads of its own, any of which may hold a lock (e.g.
+        # logging's) that a forked worker would inherit, held forever.
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
     def is_acceptable_document(self, path):
         if not path.endswith(".pdf"):
             log.debug("cowardly refusing to index `%s' because "
@@ -83,31 +275,97 @@ class Provider(FileProvider):
             return False
         return True
 
-    def extract_file_text(self, path):
+    def extract_file_pages(self, path):
+        return self.iter_pages(path, spellcheck=True)
+
+    def pdf_text(self, pdffile, spellcheck=False):
+        return ''.join(page + '\f' for page in
+                       self.iter_pages(pdffile.name, spellcheck=spellcheck))
+
+    def pdf_pages(self, pdffile, spellcheck=False):
+        """
+        :param pdffile: A PDF file opened in binary mode. It must have a
+                        ``name``, as the pool workers reopen it by path.
+        :param spellcheck: Spellcheck each run of pages as it is mined.
+        :return: A list of the text of each page, in page order.
+        """
+        return list(self.iter_pages(pdffile.name, spellcheck=spellcheck))
+
+    def iter_pages(self, path, spellcheck=False):
+        """
+        Mine the PDF at ``path``, yielding the text of each page in order as
+        soon as it (and every page before it) is available.
+        """
+        log.debug("pdf2txt-ing `%s'...", path)
         with open(path, 'rb') as f:
-            text = self.pdf_text(f)
-        return self.spellchecked(text)
+            npages = page_count(f)
+        ranges = self.page_ranges(npages)
+        if len(ranges) <= 1:
+            runs = [mine_pages(path, 0, npages, spellcheck, self.fast)]
+        else:
+            runs = self._mine_runs(path, ranges, spellcheck)
+        spellcheck_time = 0
+        skipped = 0
+        for run, (lookups, corrections, seconds, empty) in runs:
+            self.spellcheck_lookups += lookups
+            self.spellcheck_corrections += corrections
+            spellcheck_time += seconds
+            skipped += empty
+            yield from run
+        self.pages_skipped += skipped
+        if skipped:
+            log.debug("skipped %d of %d pages without text", skipped, npages)
+        if self.metrics is not None:
+            self.metrics.skipped_pages(skipped)
+            if spellcheck:
+                self.metrics.stage("spellcheck").add(spellcheck_time)
+        if spellcheck:
+            log.debug("spellcheck hit rate is now %.1f%%",
+                      100 * self.spellcheck_hit_rate)
+
+    def _mine_runs(self, path, ranges, spellcheck):
+        """
+        Keep at most two jobs per worker in flight, so that memory use is
+        bounded by the consumer's pace rather than by the document's size.
+        """
+        pool = self.pool
+        ranges = iter(ranges)
+        window = deque(
+            pool.submit(mine_pages, path, first, last, spellcheck, self.fast)
+            for first, last in islice(ranges, 2 * self.max_workers))
+        try:
+            while window:
+                run = window.popleft().result()
+                for first, last in islice(ranges, 1):
+                    window.append(pool.submit(mine_pages, path, first, last,
+                                              spellcheck, self.fast))
+                yield run
+        finally:
+            # The consumer may stop early, e.g. if the note was deleted.
+            for f in window:
+                f.cancel()
+
+    @property
+    def spellcheck_hit_rate(self):
+        """
+        :return: The fraction of words that the spellcheckers did not have to
+                 send to ``autocorrect``, across every pool worker.
+        """
+        if not self.spellcheck_lookups:
+            return 0.0
+        return 1 - self.spellcheck_corrections / self.spellcheck_lookups
 
-    def pdf_text(self, pdffile):
-        of = io.StringIO()
-        log.debug("pdf2txt-ing `%s'...", pdffile.name)
-        pdf_text(pdffile, of)
-        return of.getvalue()
+    def page_ranges(self, npages):
+        """
+        :return: A list of ``(first, last)`` half-open page ranges covering
+                 ``npages`` pages.
+        """
+        step = self.pages_per_job
+        return [(first, min(first + step, npages))
+                for first in range(0, npages, step)]
 
     def spellchecked(self, text):
-        # TODO: Why does this strip punctuation? Does it matter?
-        buf = io.StringIO()
-        for line in text.split('\n'):
-            for word in line.split(' '):
-                # Not sure why, but blank lines/words are turned into `a'.
-                if not word:
-                    continue
-                new_word = autocorrect.spell(word)
-                log.debug("%s spellchecked to %s", word, new_word)
-                buf.write(new_word)
-                buf.write(' ')
-            buf.write('\n')
-        return buf.getvalue()
+        return spellchecked(text)
 
 
 def main():
@@ -115,6 +373,8 @@ def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument("--disable-spellcheck", action='store_true',
                            help="Skip spell-correcting the mined text.")
+    argparser.add_argument("--fast", action='store_true',
+                           help="Skip layout analysis.")
     argparser.add_argument("file", type=argparse.FileType('rb'),
                            help="PDF file to extract text from.")
     argparser.add_argument("outfile", type=argparse.FileType('w'),
@@ -123,16 +383,14 @@ def main():
     logging.getLogger("pdfminer").setLevel(logging.ERROR)
     args = argparser.parse_args()
 
-    p = Provider()
+    p = Provider(fast=args.fast)
 
     log.info("begin text extraction")
-    text = p.pdf_text(args.file)
-    if not args.disable_spellcheck:
-        log.info("begin spellcheck")
-        text = str(p.spellchecked(text))
+    text = p.pdf_text(args.file, spellcheck=not args.disable_spellcheck)
+    p.shutdown()
     print(text, file=args.outfile)
 
-    log.info("done")
+    log.info("done, skipped %d pages without text", p.pages_skipped)
 
 
 if __name__ == '__main__':
@@ -6,18 +6,204 @@
 4. Others?!
 5. The "custom monster format" alex has developed for his campaigns  :)
 
+Files are memory-mapped and decoded incrementally, a chunk at a time, so that
+a campaign log hundreds of megabytes long is never held in memory all at once.
+Each chunk is fed to the indexer as a *page* of the document.
+
 """
+import codecs
+import logging
+import mmap
+import os
+import re
+
+import magic
+
 from oracle.provider import FileProvider
 
+try:
+    import chardet
+except ImportError:
+    chardet = None
 
-class Provider(FileProvider):
-    def __init__(self):
+log = logging.getLogger(__name__)
+
+_boms = [(codecs.BOM_UTF8, "utf-8-sig"),
+         (codecs.BOM_UTF32_LE, "utf-32"),
+         (codecs.BOM_UTF32_BE, "utf-32"),
+         (codecs.BOM_UTF16_LE, "utf-16"),
+         (codecs.BOM_UTF16_BE, "utf-16")]
+
+
+def detect_encoding(sample, truncated=False):
+    """
+    Guess the encoding of a file from a ``sample`` of its first bytes.
+
+    A byte order mark is trusted; otherwise UTF-8 is assumed if the sample
+    decodes as such (which plain ASCII always does), and ``chardet`` is asked
+    if it is installed. Failing all that, cp1252 is the likeliest encoding
+    of a text file written on Windows.
+
+    :param truncated: ``True`` if ``sample`` is only the start of the file,
+                      and so may end part way through a character.
+    """
+    for bom, encoding in _boms:
+        if sample.startswith(bom):
+            return encoding
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(
+            sample, final=not truncated)
+        return "utf-8"
+    except UnicodeDecodeError:
         pass
+    if chardet is not None:
+        guess = chardet.detect(sample)
+        if guess.get("encoding"):
+            try:
+                return codecs.lookup(guess["encoding"]).name
+            except LookupError:
+                pass
+    return "cp1252"
+
+
+class MarkupStripper:
+    """
+    Removes markup from text, one line at a time. Strippers may keep state
+    between lines (e.g. whether they are inside a code block), so a new one
+    is needed for each document.
+    """
+
+    def strip_line(self, line):
+        return line
+
+    def strip(self, lines):
+        return ''.join(self.strip_line(line) for line in lines)
+
+
+class MarkdownStripper(MarkupStripper):
+    _patterns = [
+        (re.compile(r'<[^>\n]+>'), ''),                      # HTML tags
+        (re.compile(r'!?\[([^\]\n]*)\]\([^)\n]*\)'), r'\1'),  # links, images
+        (re.compile(r'^\s{0,3}(?:#{1,6}|>+|[*+-]|\d+\.)\s+'), ''),
+        (re.compile(r'(\*{1,3}|_{2,3}|`+|~~)'), ''),         # emphasis, code
+    ]
+    _fence_re = re.compile(r'^\s*(```|~~~)')
+    _rule_re = re.compile(r'^\s*([-*_=])(\s*\1){2,}\s*$')
+
+    def __init__(self):
+        self.in_code = False
+
+    def strip_line(self, line):
+        # Code blocks are indexed as-is, minus their fences.
+        if self._fence_re.match(line):
+            self.in_code = not self.in_code
+            return '\n'
+        if self.in_code:
+            return line
+        if self._rule_re.match(line):
+            return '\n'
+        for pattern, replacement in self._patterns:
+            line = pattern.sub(replacement, line)
+        return line
+
+
+class RestructuredTextStripper(MarkupStripper):
+    _patterns = [
+        (re.compile(r'`([^`<\n]*?)\s*<[^>\n]*>`_{1,2}'), r'\1'),  # links
+        (re.compile(r':[\w:+-]+:`([^`\n]*)`'), r'\1'),          # roles
+        (re.compile(r'(\*{1,2}|`{1,2})'), ''),
+        (re.compile(r'(?<=\w)_{1,2}\b'), ''),                   # refs
+    ]
+    _directive_re = re.compile(r'^\s*\.\.\s+[\w:-]*(::)?')
+    _adornment_re = re.compile(r'^([=\-`:\'"~^_*+#<>.])\1+\s*$')
+
+    def strip_line(self, line):
+        if self._adornment_re.match(line):
+            return '\n'
+        match = self._directive_re.match(line)
+        if match:
+            line = line[match.end():]
+        for pattern, replacement in self._patterns:
+            line = pattern.sub(replacement, line)
+        return line
+
+
+class Provider(FileProvider):
+    """
+    Extracts the text of plaintext, Markdown and reStructuredText files.
+    """
+
+    # The number of bytes decoded (and indexed) at a time.
+    chunk_size = 256 * 1024
+
+    # Enough to tell UTF-8 from cp1252 without reading the whole file.
+    encoding_sample_size = 64 * 1024
+
+    strippers = {".md": MarkdownStripper, ".markdown": MarkdownStripper,
+                 ".rst": RestructuredTextStripper,
+                 ".rest": RestructuredTextStripper}
+
+    extensions = {".txt", ".text", ".log"} | set(strippers)
+
+    def __init__(self, cache=None):
+        super().__init__(cache)
 
     def index_file_metadata(self, path):
         pass
 
+    def is_acceptable_document(self, path):
+        _, ext = os.path.splitext(path)
+        if ext.lower() in self.extensions:
+            return True
+        try:
+            mime = magic.from_file(path, mime=True)
+        except (OSError, magic.MagicException) as e:
+            log.debug("cannot identify `%s': %s", path, e)
+            return False
+        return mime.startswith("text/")
+
+    def stripper(self, path):
+        _, ext = os.path.splitext(path)
+        return self.strippers.get(ext.lower(), MarkupStripper)()
+
     def extract_file_text(self, path):
-        with open(path) as f:
-            return f.readlines()
+        return ''.join(self.extract_file_pages(path))
+
+    def extract_file_pages(self, path):
+        """
+        :return: An iterator over chunks of the file's text, with markup
+                 removed. Chunks always end on a line boundary.
+        """
+        with open(path, 'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped.
+                return
+            with data:
+                yield from self.iter_chunks(data, self.stripper(path))
 
+    def iter_chunks(self, data, stripper):
+        """
+        :param data: A buffer (e.g. an ``mmap``) of the file's contents.
+        :param stripper: The ``MarkupStripper`` for the file.
+        """
+        sample_size = self.encoding_sample_size
+        encoding = detect_encoding(data[:sample_size],
+                                   truncated=len(data) > sample_size)
+        log.debug("decoding as %s", encoding)
+        decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        carry = ''
+        size = len(data)
+        chunk_size = self.chunk_size
+        for start in range(0, size, chunk_size):
+            end = min(start + chunk_size, size)
+            text = carry + decoder.decode(data[start:end], final=end == size)
+            if end < size:
+                # Hold back the last, probably incomplete, line (or word, if
+                # the line is longer than a chunk).
+                cut = (text.rfind('\n') + 1 or text.rfind(' ') + 1
+                       or len(text))
+                text, carry = text[:cut], text[cut:]
+            if text:
+                yield stripper.strip(text.splitlines(keepends=True))
@@ -0,0 +1,212 @@
+# oracle/scheduler.py
+# Copyright (C) 2018 Alex Mair. All rights reserved.
+# This file is part of dmclient.
+#
+# dmclient is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# dmclient is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dmclient.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Scheduling of the oracle's indexing work.
+
+Jobs are run in priority order rather than in the order the notes were found
+in. In order of importance, the following go first:
+
+1. Notes the UI has reported as open or recently searched for (*boosted*).
+2. Notes that have been added or changed during this session (*recent*).
+3. Smaller documents.
+"""
+
+import heapq
+from collections import OrderedDict
+from itertools import count
+from logging import getLogger
+from threading import Condition, Event, Thread
+
+__all__ = ["IndexJob", "IndexScheduler"]
+
+log = getLogger(__name__)
+
+
+class IndexJob:
+    """
+    A unit of indexing work for a single note. Like a future, it has a
+    ``result()`` once it has run.
+    """
+
+    def __init__(self, note_id, fn, size=0, recent=False, callback=None):
+        """
+        :param fn: Called with the job itself as its only argument, so that
+                   it may poll ``is_cancelled()``.
+        :param size: The size of the document in bytes.
+        :param callback: Called with the job once it has run. It is not
+                         called for jobs cancelled before they started.
+        """
+        self.note_id = note_id
+        self.fn = fn
+        self.size = size
+        self.recent = recent
+        self.callback = callback
+        self.running = False
+        self._cancelled = Event()
+        self._result = None
+        self._exception = None
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def result(self):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def run(self):
+        try:
+            self._result = self.fn(self)
+        except Exception as e:
+            self._exception = e
+
+
+class IndexScheduler:
+    """
+    A priority queue of ``IndexJob`` instances, serviced by worker threads.
+    There is at most one job per note: submitting a job for a note cancels
+    any job already queued or running for it.
+    """
+
+    max_boosted = 64
+
+    def __init__(self, workers=1):
+        self._heap = []
+        self._jobs = {}
+        self._boosted = OrderedDict()
+        self._seq = count()
+        # Jobs taken by a worker whose callback has not yet returned.
+        self._busy = 0
+        self._cond = Condition()
+        self._keep_going = True
+        self._threads = [Thread(target=self._work, name="indexer-%d" % i,
+                                daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, note_id, fn, size=0, recent=False, callback=None):
+        job = IndexJob(note_id, fn, size, recent, callback)
+        with self._cond:
+            self._cancel(note_id)
+            self._jobs[note_id] = job
+            heapq.heappush(self._heap, self._entry(job))
+            self._cond.notify()
+        return job
+
+    def cancel(self, note_id):
+        with self._cond:
+            self._cancel(note_id)
+            self._cond.notify_all()
+
+    def boost(self, note_ids):
+        """
+        Move ``note_ids`` (and any queued jobs for them) to the front of the
+        queue. Only the ``max_boosted`` most recently boosted notes are kept.
+        """
+        with self._cond:
+            for note_id in note_ids:
+                self._boosted.pop(note_id, None)
+                self._boosted[note_id] = None
+            while len(self._boosted) > self.max_boosted:
+                self._boosted.popitem(last=False)
+            self._heap = [self._entry(job) for *_, job in self._heap
+                          if not job.is_cancelled()]
+            heapq.heapify(self._heap)
+
+    def priority(self, job):
+        """:return: A sort key for ``job``; lower keys run first."""
+        return (job.note_id not in self._boosted, not job.recent, job.size)
+
+    @property
+    def pending(self):
+        """The number of jobs that are queued or running."""
+        with self._cond:
+            return len(self._jobs)
+
+    def queue(self):
+        """
+        :return: A list of dictionaries describing each pending job, in the
+                 order they will be run (running jobs first).
+        """
+        with self._cond:
+            entries = sorted(self._heap)
+            jobs = [job for job in self._jobs.values() if job.running]
+        jobs += [job for *_, job in entries if not job.is_cancelled()]
+        return [{"note": job.note_id, "size": job.size, "recent": job.recent,
+                 "boosted": job.note_id in self._boosted,
+                 "running": job.running} for job in jobs]
+
+    def join(self, timeout=None):
+        """Wait until there are no pending jobs, and their callbacks ran."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._jobs and not self._busy, timeout)
+
+    def shutdown(self):
+        with self._cond:
+            self._keep_going = False
+            for note_id in list(self._jobs):
+                self._cancel(note_id)
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _entry(self, job):
+        return [self.priority(job), next(self._seq), job]
+
+    def _cancel(self, note_id):
+        job = self._jobs.pop(note_id, None)
+        if job is not None:
+            log.debug("cancelling indexing of note %d", note_id)
+            job.cancel()
+
+    def _next(self):
+        with self._cond:
+            while self._keep_going:
+                while self._heap:
+                    *_, job = heapq.heappop(self._heap)
+                    if not job.is_cancelled():
+                        job.running = True
+                        self._busy += 1
+                        return job
+                self._cond.wait()
+        return None
+
+    def _work(self):
+        while 1:
+            job = self._next()
+            if job is None:
+                return
+            job.run()
+            with self._cond:
+                job.running = False
+                if self._jobs.get(job.note_id) is job:
+                    del self._jobs[job.note_id]
+            try:
+                if job.callback:
+                    job.callback(job)
+            except Exception:
+                log.exception("indexing callback failed")
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self._cond.notify_all()
@@ -1,41 +1,333 @@
+# oracle/search.py
+# Copyright (C) 2018 Alex Mair. All rights reserved.
+# This file is part of dmclient.
+#
+# dmclient is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# dmclient is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dmclient.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Searching of the oracle's index.
+
+Each query produces a single response dictionary, which is sent back to
+Delphi::
+
+    {"id": 3, "query": "fireball", "offset": 0, "limit": 10,
+     "estimated": 42, "latency": 0.0012, "error": None,
+     "results": [{"note": 7, "notes": [7, 12], "rank": 0, "percent": 98,
+                  "page": 211,
+                  "snippet": "...a <b>fireball</b> explodes..."}, ...]}
+
+A document may be the content of several notes (see ``OracleDatabase``), all
+of which are listed in ``notes``; ``note`` is the first of them.
+
+If the campaign has a game system's shared index, it is searched together
+with the campaign's own as a single xapian multi-database. The shared index
+holds the rulebooks of every campaign of the system, so only the documents
+this campaign has notes for are matched.
+
+Only the matched page of each result is ever read back, to build its
+snippet; document bodies never cross the connection.
+
+Queries never take the database lock that indexing writes under. Instead,
+each searcher thread keeps its own read-only ``xapian.Database`` snapshot of
+the index, which is reopened whenever a batch of writes has been committed
+since the snapshot was taken. Xapian database objects are not thread-safe, so
+snapshots are never shared between threads.
+
+The UI searches on every (debounced) keystroke, and users retype and backspace
+over the same prefixes constantly, so recent responses are kept in a
+``ResultCache``. Entries are keyed by the parsed query rather than its text,
+so that e.g. ``fireball`` and ``fireball  `` share an entry, and they
+are discarded as soon as a later revision of the index is searched.
+"""
+
+import json
 import queue
-from threading import Thread
+import time
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock, Thread, local
 
 import xapian
 
+from oracle.index import VALUE_DIGEST, VALUE_PAGES, document_notes, \
+    page_of, unpack_page_starts
+
+__all__ = ["ResultCache", "Searcher"]
+
+log = getLogger(__name__)
+
+
+class ResultCache:
+    """
+    A bounded, least-recently-used map of query keys to search results, for a
+    single revision of the index.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.revision = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key, revision):
+        """
+        :return: The results stored for ``key`` against ``revision`` of the
+                 index, or ``None``.
+        """
+        with self.lock:
+            self._check_revision(revision)
+            try:
+                self.entries.move_to_end(key)
+                results = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return results
+
+    def put(self, key, revision, results):
+        with self.lock:
+            self._check_revision(revision)
+            if self.revision != revision:
+                # Results from an older snapshot, which finished after a
+                # newer one had been searched.
+                return
+            self.entries[key] = results
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _check_revision(self, revision):
+        if self.revision is None or revision > self.revision:
+            self.entries.clear()
+            self.revision = revision
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class SharedDocumentDecider(xapian.MatchDecider):
+    """
+    Matches the campaign's own documents, and those of the shared index which
+    it has notes for.
+    """
+
+    def __init__(self, shared_notes):
+        super().__init__()
+        self.shared_notes = shared_notes
+
+    def __call__(self, document):
+        digest = document.get_value(VALUE_DIGEST)
+        return not digest or bool(self.shared_notes(digest.decode()))
+
 
 class Searcher:
-    def __init__(self, stemmer):
-        self.query_parser = xapian.QueryParser()
-        self.query_parser.set_stemmer(stemmer)
-        self.query_parser.set_stemming_strategy(xapian.QueryParser.STEM_SOME)
-        self.thread = Thread(target=self.run, name="searcher")
+    snippet_length = 200
+
+    def __init__(self, stemmer, database, send, page_text=None, shared=None,
+                 shared_notes=None, workers=2, cache_size=256):
+        """
+        :param database: The ``OracleDatabase`` to search.
+        :param send: Called with each response dictionary.
+        :param page_text: An optional function of a result's document data
+                          and page number to the text of that page, which is
+                          used to build snippets. It may return ``None``.
+        :param shared: The ``OracleDatabase`` of a game system's shared
+                       index, to search as well as ``database``.
+        :param shared_notes: A function of the digest of a document in the
+                             shared index to the ids of the campaign's notes
+                             with that content.
+        :param workers: The number of queries which may run concurrently.
+        :param cache_size: The number of responses to keep in the cache.
+        """
+        self.stemmer = stemmer
+        self.threads = [Thread(target=self.run, name="searcher-%d" % i,
+                               daemon=True)
+                        for i in range(workers)]
         self.pending = queue.Queue()
-        self.database = None
+        self.database = database
+        self.shared = shared
+        self.shared_notes = shared_notes
+        self.decider = None
+        if shared is not None:
+            self.decider = SharedDocumentDecider(shared_notes)
+        self.send = send
+        self.page_text = page_text
         self.keep_going = True
+        self.local = local()
+        self.cache = ResultCache(cache_size)
 
-    def database_changed(self, database):
-        # FIXME this is going to cause a race condition if the db changes
-        # whilst we are searching for something......
-        self.database = database
-        self.query_parser.set_database(database.xdb)
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.keep_going = False
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join()
+
+    def submit(self, query_id, query, offset=0, limit=10):
+        self.pending.put((query_id, query, offset, limit))
 
     def run(self):
         while self.keep_going:
             try:
-                query = self.pending.get(timeout=1)
-                with self.database.lock:
-                    self.print_results(query)
+                request = self.pending.get(timeout=1)
             except queue.Empty:
-                pass
-
-    def print_results(self, query):
-        enquire = xapian.Enquire(self.database.xdb)
-        query = self.query_parser.parse_query(query)
-        enquire.set_query(query)
-        matches = enquire.get_mset(0, 10)
-        print("%d results found" % matches.get_matches_estimated())
-        for m in matches:
-            print("\t{}: {}%% docid={}\n\t\t{}".format(m.rank, m.percent,
-                                                       m.docid,
-                                                       m.document.get_data()))
+                continue
+            try:
+                self.send(self.search(*request))
+            except Exception:
+                log.exception("search for `%s' failed", request[1])
+
+    def snapshot(self):
+        """
+        :return: The calling thread's read-only snapshot of the index, which
+                 is reopened first if there have been commits since it was
+                 last used.
+        """
+        state = self.local
+        revision = self.revision()
+        if getattr(state, "xdb", None) is None:
+            state.xdb = xapian.Database(self.database.path)
+            if self.shared is not None:
+                state.xdb.add_database(xapian.Database(self.shared.path))
+            state.query_parser = self.create_query_parser(state.xdb)
+        elif state.revision != revision:
+            state.xdb.reopen()
+        state.revision = revision
+        return state.xdb, state.query_parser
+
+    def revision(self):
+        """
+        :return: The revision of the index. Revisions only increase, even if
+                 there is a shared index.
+        """
+        if self.shared is None:
+            return self.database.revision
+        return self.database.revision, self.shared.revision
+
+    def create_query_parser(self, xdb):
+        query_parser = xapian.QueryParser()
+        query_parser.set_stemmer(self.stemmer)
+        query_parser.set_stemming_strategy(xapian.QueryParser.STEM_SOME)
+        query_parser.set_database(xdb)
+        return query_parser
+
+    def search(self, query_id, query, offset=0, limit=10):
+        """
+        :return: The response dictionary for ``query``, see the module
+                 documentation.
+        """
+        response = {"id": query_id, "query": query, "offset": offset,
+                    "limit": limit, "estimated": 0, "results": [],
+                    "error": None}
+        start = time.perf_counter()
+        try:
+            xdb, query_parser = self.snapshot()
+            parsed = query_parser.parse_query(query)
+            key = (parsed.get_description(), offset, limit)
+            revision = self.local.revision
+            cached = self.cache.get(key, revision)
+            if cached is None:
+                cached = self.run_query(xdb, query_parser, parsed, offset,
+                                        limit)
+                self.cache.put(key, revision, cached)
+            response.update(cached)
+        except xapian.DatabaseModifiedError:
+            # The snapshot was overwritten by a later commit part way through
+            # the query; a fresh one will be opened next time.
+            self.local.xdb = None
+            response["error"] = "the index changed during the search"
+        except xapian.QueryParserError as e:
+            response["error"] = str(e)
+        except (xapian.Error, ValueError) as e:
+            # E.g. the shared index could not be opened, or a document's
+            # data is corrupt. Delphi must be answered all the same.
+            log.exception("query %s `%s' failed", query_id, query)
+            self.local.xdb = None
+            response["error"] = str(e) or type(e).__name__
+        response["latency"] = time.perf_counter() - start
+        log.debug("query %s `%s': %d results in %.3fs", query_id, query,
+                  len(response["results"]), response["latency"])
+        return response
+
+    def run_query(self, xdb, query_parser, parsed, offset, limit):
+        enquire = xapian.Enquire(xdb)
+        enquire.set_query(parsed)
+        mset = enquire.get_mset(offset, limit, 0, None, self.decider)
+        results = []
+        for m in mset:
+            data = json.loads(m.document.get_data().decode())
+            page = self.matched_page(xdb, query_parser, enquire, m)
+            if "digest" in data:
+                notes = self.shared_notes(data["digest"])
+            else:
+                notes = document_notes(data)
+            results.append({"note": notes[0] if notes else None,
+                            "notes": notes, "rank": m.rank,
+                            "percent": m.percent, "page": page,
+                            "snippet": self.snippet(mset, data, page)})
+        return {"estimated": mset.get_matches_estimated(), "results": results}
+
+    def matched_page(self, xdb, query_parser, enquire, match):
+        """
+        :return: The zero-based page of the first occurrence of any term of
+                 the query in the document, or ``None`` if it is unknown.
+        """
+        starts = match.document.get_value(VALUE_PAGES)
+        if not starts:
+            return None
+        first = None
+        for term in self.positional_terms(query_parser, enquire, match):
+            try:
+                for position in xdb.positionlist(match.docid, term):
+                    if first is None or position < first:
+                        first = position
+                    break
+            except xapian.Error:
+                continue
+        if first is None:
+            return 0
+        return page_of(unpack_page_starts(starts), first)
+
+    @staticmethod
+    def positional_terms(query_parser, enquire, match):
+        """
+        Stemmed (``Z``-prefixed) terms carry no positions, so the words which
+        were stemmed to produce them are used instead.
+        """
+        for term in enquire.matching_terms(match):
+            if term.startswith(b'Z'):
+                yield from query_parser.unstemlist(term)
+            else:
+                yield term
+
+    def snippet(self, mset, data, page):
+        if self.page_text is None or page is None:
+            return ""
+        try:
+            text = self.page_text(data, page)
+        except Exception as e:
+            log.warning("cannot read page %s of notes %s: %s", page,
+                        document_notes(data), e)
+            return ""
+        if not text:
+            return ""
+        return mset.snippet(text, self.snippet_length, self.stemmer)
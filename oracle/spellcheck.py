@@ -0,0 +1,134 @@
+# oracle/spellcheck.py
+# Copyright (C) 2018 Alex Mair. All rights reserved.
+# This file is part of dmclient.
+#
+# dmclient is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# dmclient is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dmclient.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Spellchecking of mined text.
+
+Text mined from PDFs is full of small errors (pdfminer confuses ``5`` and
+``s``, ``1`` and ``l``...) which are fixed up with ``autocorrect``. Asking
+``autocorrect`` about a word is expensive, and a rulebook asks about the same
+few thousand words millions of times, so ``SpellChecker`` only ever asks about
+a word that is neither in the vocabulary nor in its memo.
+"""
+
+import re
+from collections import OrderedDict
+from threading import Lock
+
+__all__ = ["SpellChecker"]
+
+_whitespace_re = re.compile(r'(\s+)')
+_punctuation_re = re.compile(r'^(\W*)(.*?)(\W*)$', re.DOTALL)
+
+
+class SpellChecker:
+    """
+    Words are split from their surrounding punctuation, which is never sent to
+    the corrector (``autocorrect`` turns ``&`` into ``a``). A word is passed
+    through untouched if it is:
+
+    * in the vocabulary,
+    * in the protected word list (case-insensitively), or
+    * not purely alphabetic. This covers dice notation such as ``d4`` and
+      ``2d6``, which ``autocorrect`` loves to turn into junk, as well as
+      numbers, identifiers and hyphenated words.
+    """
+
+    protected_words = frozenset(["ac", "dc", "dm", "gm", "hp", "npc", "pc",
+                                 "xp"])
+
+    def __init__(self, correct=None, vocabulary=None, memo_size=1 << 16,
+                 protected=()):
+        """
+        :param correct: A function of a word to its correction. Defaults to
+                        ``autocorrect.spell``.
+        :param vocabulary: A container of lower-case words which are known to
+                           be correct. Defaults to ``autocorrect``'s.
+        :param memo_size: The number of corrections to remember.
+        :param protected: Extra words which must never be corrected.
+        """
+        if correct is None:
+            import autocorrect
+            correct = autocorrect.spell
+            if vocabulary is None:
+                from autocorrect.word import KNOWN_WORDS
+                vocabulary = KNOWN_WORDS
+        self.correct = correct
+        self.vocabulary = vocabulary if vocabulary is not None else frozenset()
+        self.protected = self.protected_words | {w.lower() for w in protected}
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        self.lookups = 0
+        self.corrections = 0
+        self.lock = Lock()
+
+    @property
+    def hit_rate(self):
+        """
+        :return: The fraction of words looked up that did not need to be sent
+                 to the corrector.
+        """
+        if not self.lookups:
+            return 0.0
+        return 1 - self.corrections / self.lookups
+
+    def stats(self):
+        return {"lookups": self.lookups, "corrections": self.corrections,
+                "hit_rate": self.hit_rate}
+
+    def spellchecked(self, text):
+        """
+        :return: ``text`` with every word corrected. Whitespace and
+                 punctuation are preserved.
+        """
+        tokens = _whitespace_re.split(text)
+        # Every other token is whitespace; each distinct word is only looked
+        # up once per chunk of text.
+        words = tokens[0::2]
+        corrected = {word: self.check_token(word) for word in set(words)
+                     if word}
+        tokens[0::2] = [corrected.get(word, word) for word in words]
+        return ''.join(tokens)
+
+    def check_token(self, token):
+        leading, word, trailing = _punctuation_re.match(token).groups()
+        if not word:
+            return token
+        return leading + self.check_word(word) + trailing
+
+    def check_word(self, word):
+        self.lookups += 1
+        if self.is_protected(word):
+            return word
+        with self.lock:
+            try:
+                self.memo.move_to_end(word)
+                return self.memo[word]
+            except KeyError:
+                pass
+        self.corrections += 1
+        correction = self.correct(word)
+        with self.lock:
+            self.memo[word] = correction
+            if len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return correction
+
+    def is_protected(self, word):
+        lower = word.lower()
+        return (not word.isalpha() or lower in self.vocabulary
+                or lower in self.protected)
@@ -1,3 +1,5 @@
+import hashlib
+
 import pytest
 import xapian
 from sqlalchemy import create_engine
@@ -6,6 +8,7 @@ from sqlalchemy.orm import sessionmaker
 from campaign.note import Note
 from model import GameBase
 from oracle.oracle import OracleDatabase
+from oracle.provider import SearchProvider
 
 
 class DummyNote(Note):
@@ -18,13 +21,23 @@ def note():
     return DummyNote()
 
 
-class FooProvider:
+class FooProvider(SearchProvider):
     def __init__(self, text):
+        super().__init__()
         self.text = text
 
     def extract_document_text(self, _url):
         return self.text
 
+    def extract_document_pages(self, _url):
+        return self.text.split('\f')
+
+    def document_page(self, _url, page):
+        return self.text.split('\f')[page]
+
+    def document_digest(self, _url):
+        return hashlib.sha1(self.text.encode()).hexdigest()
+
 
 @pytest.fixture
 def provider():
@@ -35,7 +48,8 @@ def provider():
 def campaign_db(note):
     engine = create_engine("sqlite:///:memory:")
     GameBase.metadata.create_all(engine)
-    session = sessionmaker(bind=engine)()
+    # The note fixture is used after this session has gone.
+    session = sessionmaker(bind=engine, expire_on_commit=False)()
     session.add(note)
     session.commit()
     return engine
@@ -43,7 +57,7 @@ def campaign_db(note):
 
 @pytest.fixture
 def oracle_db(tmpdir):
-    xapiandb = xapian.WritableDatabase(str(tmpdir.join("xapian.db")),
-                                       xapian.DB_CREATE)
-    database = OracleDatabase(xapiandb)
+    path = str(tmpdir.join("xapian.db"))
+    xapiandb = xapian.WritableDatabase(path, xapian.DB_CREATE)
+    database = OracleDatabase(xapiandb, path)
     return database
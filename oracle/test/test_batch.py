@@ -0,0 +1,109 @@
+from threading import Lock
+
+import pytest
+
+from oracle.batch import BatchWriter
+
+
+class FakeXapianDatabase:
+    def __init__(self):
+        self.in_transaction = False
+        self.transactions = []
+
+    def begin_transaction(self):
+        assert not self.in_transaction
+        self.in_transaction = True
+        self.transactions.append([])
+
+    def commit_transaction(self):
+        self.in_transaction = False
+
+    def cancel_transaction(self):
+        self.in_transaction = False
+        self.transactions.pop()
+
+
+class FakeOracleDatabase:
+    def __init__(self):
+        self.xdb = FakeXapianDatabase()
+        self.lock = Lock()
+        self.revision = 0
+
+    def begin_transaction(self):
+        self.xdb.begin_transaction()
+
+    def commit_transaction(self):
+        self.xdb.commit_transaction()
+
+    def cancel_transaction(self):
+        self.xdb.cancel_transaction()
+
+    def replace_note(self, note_id, document, record):
+        assert self.xdb.in_transaction
+        self.xdb.transactions[-1].append(("replace", note_id))
+
+    def delete_note(self, note_id):
+        assert self.xdb.in_transaction
+        if note_id < 0:
+            raise ValueError("bad note")
+        self.xdb.transactions[-1].append(("delete", note_id))
+
+    def committed(self):
+        self.revision += 1
+
+
+@pytest.fixture
+def database():
+    return FakeOracleDatabase()
+
+
+@pytest.fixture
+def writer(database):
+    writer = BatchWriter(database, max_documents=3, max_bytes=100,
+                         max_delay=60)
+    yield writer
+    writer.close()
+
+
+def test_flush_on_document_count(writer, database):
+    for note_id in range(4):
+        writer.replace_note(note_id, None, {})
+    assert database.xdb.transactions == [
+        [("replace", 0), ("replace", 1), ("replace", 2)]]
+    assert len(writer) == 1
+    assert database.revision == 1
+
+
+def test_flush_on_size(writer, database):
+    writer.replace_note(1, None, {}, size=60)
+    assert not database.xdb.transactions
+    writer.replace_note(2, None, {}, size=60)
+    assert len(database.xdb.transactions) == 1
+
+
+def test_explicit_flush(writer, database):
+    writer.delete_note(1)
+    writer.flush()
+    writer.flush()
+    assert database.xdb.transactions == [[("delete", 1)]]
+    assert writer.metrics()["batch_size"]["count"] == 1
+
+
+def test_flush_on_timer(database):
+    writer = BatchWriter(database, max_delay=0.1)
+    writer.delete_note(1)
+    timer = writer._timer
+    timer.join()
+    assert database.xdb.transactions == [[("delete", 1)]]
+
+
+def test_failed_write_only_drops_itself(database):
+    dropped = []
+    writer = BatchWriter(database, max_delay=60, dropped=dropped.append)
+    writer.replace_note(1, None, {})
+    writer.delete_note(-1)
+    writer.delete_note(2)
+    writer.flush()
+    assert database.xdb.transactions == [[("replace", 1)], [("delete", 2)]]
+    assert dropped == [-1]
+    assert database.revision == 1
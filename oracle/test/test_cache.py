@@ -0,0 +1,74 @@
+import pytest
+
+from oracle.cache import TextCache, file_digest
+
+
+@pytest.fixture
+def cache(tmpdir):
+    cache = TextCache(str(tmpdir.join("cache")), max_bytes=64)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def document(tmpdir):
+    path = tmpdir.join("doc.txt")
+    path.write("contents")
+    return str(path)
+
+
+def test_digest_is_content_addressed(cache, document, tmpdir):
+    copy = tmpdir.join("copy.txt")
+    copy.write("contents")
+    assert cache.digest(document) == cache.digest(str(copy))
+    assert cache.digest(document) == file_digest(document)
+
+
+def test_digest_notices_changes(cache, document):
+    before = cache.digest(document)
+    with open(document, 'a') as f:
+        f.write(" and then some")
+    assert cache.digest(document) != before
+
+
+def test_round_trip(cache):
+    pages = ["first page\n", "séconde page\n", ""]
+    cache.put("abc", pages)
+    assert cache.get("abc") == pages
+    assert cache.get_page("abc", 1) == "séconde page\n"
+    assert cache.get_page("abc", 3) is None
+    assert cache.hits == 1
+
+
+def test_miss(cache):
+    assert cache.get("nope") is None
+    assert cache.misses == 1
+    assert cache.hit_rate == 0.0
+
+
+def test_lru_eviction(cache):
+    cache.put("old", ["x" * 40])
+    cache.put("new", ["y" * 40])
+    assert cache.get("old") is None
+    assert cache.get("new") == ["y" * 40]
+
+
+def test_aborted_writer_leaves_nothing(cache, tmpdir):
+    with pytest.raises(RuntimeError):
+        with cache.writer("abc") as writer:
+            writer.write("half a document")
+            raise RuntimeError
+    assert cache.get("abc") is None
+    assert not [p for p in tmpdir.join("cache").listdir()
+                if p.ext in (".tmp", ".txt")]
+
+
+def test_concurrent_writers_of_a_digest(cache):
+    first = cache.writer("abc")
+    second = cache.writer("abc")
+    assert first.tmp_path != second.tmp_path
+    first.write("first")
+    second.write("second")
+    second.commit()
+    first.abort()
+    assert ["second"] == list(cache.iter_pages("abc"))
@@ -0,0 +1,69 @@
+import time
+
+from oracle.completion import CompletionIndex, completion_terms
+
+
+def test_completion_terms():
+    terms = completion_terms([(b"fire", 3), (b"Zfire", 3), (b"Q12", 1),
+                              (b"2d6", 1), (b"a", 5), ("fireball", 1)])
+    assert terms == {"fire": 3, "fireball": 1}
+
+
+def test_words_ranked_by_frequency():
+    index = CompletionIndex()
+    index.add_terms({"fire": 3, "fireball": 10, "firearm": 1, "frost": 8})
+    assert index.complete("fi") == [("fireball", "term"), ("fire", "term"),
+                                    ("firearm", "term")]
+    assert index.complete("FIRE", limit=1) == [("fireball", "term")]
+    assert index.complete("x") == []
+
+
+def test_incremental_updates():
+    index = CompletionIndex()
+    index.add_terms({"fire": 3, "fireball": 10})
+    assert index.complete("f")[0] == ("fireball", "term")
+    index.remove_terms({"fireball": 10})
+    assert index.complete("f") == [("fire", "term")]
+    index.add_terms({"fireball": 1})
+    assert index.complete("f") == [("fire", "term"), ("fireball", "term")]
+    assert index.words == ["fire", "fireball"]
+
+    index.update_terms({"fire": 3, "fireball": 1}, {"fire": 1, "firebolt": 2})
+    assert index.weights == {"fire": 1, "firebolt": 2}
+
+
+def test_entities_rank_first():
+    index = CompletionIndex()
+    index.add_terms({"dragon": 100, "drake": 5})
+    index.set_entities("pin", ["Dragon's Lair", "Waterdeep"])
+    index.set_entities("player", ["Red Dragon"])
+    completions = index.complete("dra")
+    assert set(completions[:2]) == {("Dragon's Lair", "pin"),
+                                    ("Red Dragon", "player")}
+    assert ("drake", "term") in completions
+    assert index.complete("water") == [("Waterdeep", "pin")]
+
+
+def test_completion_is_fast():
+    index = CompletionIndex()
+    index.add_terms({"w%06d" % i: i % 97 for i in range(200000)})
+    start = time.perf_counter()
+    for prefix in ("w", "w1", "w12", "w123"):
+        index.complete(prefix)
+    assert (time.perf_counter() - start) / 4 < 0.01
+
+
+def test_adding_a_document_merges_into_the_best_words():
+    index = CompletionIndex()
+    index.add_terms({"w%06d" % i: i % 97 for i in range(200000)})
+    # Another rulebook: some new words, and some existing ones made heavier.
+    document = {"w%06d" % i: 500 + i for i in range(0, 20000, 100)}
+    document.update({"wx%04d" % i: i for i in range(1000)})
+    start = time.perf_counter()
+    index.add_terms(document)
+    assert time.perf_counter() - start < 0.05
+    top = dict(index.top)
+    for prefix in ("w", "w0", "wx"):
+        index._rank_prefix(prefix)
+        assert top[prefix] == index.top[prefix]
+    assert index.words == sorted(index.weights)
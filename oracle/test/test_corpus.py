@@ -0,0 +1,41 @@
+import io
+
+from oracle.benchmark import compare
+from oracle.corpus import CorpusGenerator, pdf_document
+from oracle.provider.pdf import page_count, pdf_text
+
+
+def test_deterministic(tmpdir):
+    first = CorpusGenerator(seed=7).generate(str(tmpdir.join("a")), 2, 3,
+                                             (1, 3))
+    second = CorpusGenerator(seed=7).generate(str(tmpdir.join("b")), 2, 3,
+                                              (1, 3))
+    assert [d.size for d in first] == [d.size for d in second]
+    for a, b in zip(first, second):
+        with open(a.path, 'rb') as f, open(b.path, 'rb') as g:
+            assert f.read() == g.read()
+    third = CorpusGenerator(seed=8).generate(str(tmpdir.join("c")), 2, 3,
+                                             (1, 3))
+    assert [d.size for d in first] != [d.size for d in third]
+
+
+def test_pdf_document():
+    data = pdf_document([["A fireball (8d6) explodes."], ["Owlbear \\ hug"]])
+    f = io.BytesIO(data)
+    assert page_count(f) == 2
+    out = io.StringIO()
+    pdf_text(f, out)
+    text = out.getvalue()
+    assert "A fireball (8d6) explodes." in text
+    assert "Owlbear \\ hug" in text
+
+
+def test_compare():
+    before = {"indexing": {"documents_per_second": 10.0},
+              "search_idle": {"p99": 0.02}}
+    after = {"indexing": {"documents_per_second": 12.0},
+             "search_idle": {"p99": 0.03}}
+    rows = {metric: change for metric, _, _, change in compare(before, after)}
+    assert rows["indexing.documents_per_second"] == 0.2
+    assert round(rows["search_idle.p99"], 6) == -0.5
+    assert len(rows) == 2
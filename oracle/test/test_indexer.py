@@ -1,6 +1,10 @@
+import json
+
 import pytest
 
-from oracle.index import Indexer
+from oracle.index import Indexer, VALUE_PAGES, page_of, unpack_page_starts
+from oracle.metrics import IndexingMetrics
+from oracle.test.conftest import FooProvider
 
 
 @pytest.fixture
@@ -15,10 +19,32 @@ def indexed_document(indexer, provider, note):
 
 
 def test_document_data(indexed_document):
-    assert indexed_document.get_data().decode() == "foo bar baz"
+    data = json.loads(indexed_document.get_data().decode())
+    assert data["url"] == "foo://bar"
+    assert data["pages"] == 1
 
 
 def test_term_list(indexed_document):
     termlist = {term.term.decode() for term in indexed_document.termlist()}
     # Why the 'Z's?
     assert termlist == {'foo', 'bar', 'baz', 'Zfoo', 'Zbar', 'Zbaz'}
+
+
+def test_pages(indexer, note):
+    provider = FooProvider("foo bar\fbaz\fqux quux")
+    document, _ = indexer.index_note(provider, note)
+    starts = unpack_page_starts(document.get_value(VALUE_PAGES))
+    assert len(starts) == 3
+    positions = {term.term.decode(): list(term.positer)
+                 for term in document.termlist()}
+    assert page_of(starts, positions["foo"][0]) == 0
+    assert page_of(starts, positions["baz"][0]) == 1
+    assert page_of(starts, positions["quux"][0]) == 2
+
+
+def test_stage_metrics(note):
+    metrics = IndexingMetrics()
+    Indexer(metrics).index_note(FooProvider("foo bar\fbaz"), note)
+    assert metrics.stage("extract").count == 1
+    assert metrics.stage("terms").count == 1
+    assert metrics.stage("commit").count == 0
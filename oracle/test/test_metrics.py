@@ -0,0 +1,75 @@
+from oracle import metrics
+from oracle.metrics import Histogram, IndexingMetrics, Rate
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in range(1, 101):
+        histogram.add(value)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 100
+    assert snapshot["min"] == 1 and snapshot["max"] == 100
+    assert snapshot["p50"] == 51
+
+
+def test_rate_window():
+    clock = Clock()
+    rate = Rate(window=10, clock=clock)
+    assert rate.per_second() == 0
+    for _ in range(10):
+        rate.add(100)
+        clock.now += 1
+    assert rate.per_second() == 100
+    assert rate.total == 1000
+    clock.now += 60
+    assert rate.per_second() == 0
+    assert rate.total == 1000
+
+
+def test_eta():
+    clock = Clock()
+    metrics = IndexingMetrics(window=10)
+    metrics.documents.clock = metrics.bytes.clock = clock
+    metrics.queued_bytes.clock = clock
+    queue = [{"size": 500}, {"size": 1500}]
+    assert metrics.snapshot(queue)["eta"] is None
+    for _ in range(10):
+        metrics.indexed(100)
+        clock.now += 1
+    snapshot = metrics.snapshot(queue)
+    assert snapshot["bytes_per_second"] == 100
+    assert snapshot["eta"] == 20
+    assert snapshot["queue_depth"] == 2
+    assert set(snapshot["stages"]) == {"extract", "spellcheck", "terms",
+                                       "commit"}
+    assert metrics.snapshot([])["eta"] == 0
+
+
+def test_eta_of_compressed_documents():
+    # Queued sizes are file sizes, e.g. of PDFs with 10 times as much text.
+    clock = Clock()
+    metrics = IndexingMetrics(window=10)
+    metrics.documents.clock = metrics.bytes.clock = clock
+    metrics.queued_bytes.clock = clock
+    for _ in range(10):
+        metrics.indexed(1000, queued_size=100)
+        clock.now += 1
+    snapshot = metrics.snapshot([{"size": 500}, {"size": 1500}])
+    assert snapshot["bytes_per_second"] == 1000
+    assert snapshot["eta"] == 20
+
+
+def test_resident_memory_without_psutil(monkeypatch):
+    monkeypatch.setattr(metrics, "psutil", None)
+    if metrics.resource is None:
+        assert metrics.resident_memory() is None
+    else:
+        assert metrics.resident_memory() > 1024 * 1024
@@ -1,13 +1,28 @@
+import os
+
 import pytest
+import xapian
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from campaign.note import InternalNote, Note, NoteChange
+from oracle.oracle import OracleController, OracleDatabase
+from oracle.provider import FileProvider
+
 
-from oracle import DummyDelphi
-from oracle.oracle import OracleController
+class DummyChannel:
+    """
+    Stands in for the oracle's end of the channel to Delphi.
+    """
+
+    def send(self, kind, method, request_id=0, payload=None):
+        pass
 
 
 @pytest.fixture
 def oracle_controller(campaign_db, oracle_db, provider):
     fooproviders = {'foo': provider}
-    controller = OracleController(DummyDelphi(), campaign_db, oracle_db,
+    controller = OracleController(DummyChannel(), campaign_db, oracle_db,
                                   fooproviders)
     return controller
 
@@ -22,10 +37,223 @@ class TestOracleController:
 
         def new_index_complete(*args):
             old_index_complete(*args)
-            assert len(oracle_controller.pending) == 0
+            assert oracle_controller.pending == 0
             assert 'foo' in oracle_controller.providers
             assert len(oracle_controller.notemap) == 1
             assert 1 in oracle_controller.notemap
 
         oracle_controller.index_complete = new_index_complete
         oracle_controller.index_note(note)
+
+    def test_records_survive_reopen(self, note, oracle_controller, oracle_db,
+                                    campaign_db, provider):
+        oracle_controller.index_note(note)
+        oracle_controller.scheduler.join()
+
+        reopened = OracleController(DummyChannel(), campaign_db, oracle_db,
+                                    {'foo': provider})
+        record = reopened.notemap[1]
+        assert record["url"] == note.url
+        assert record["digest"] == provider.document_digest(note.url)
+
+    def test_deleted_note_is_removed(self, note, oracle_controller, oracle_db):
+        oracle_controller.index_note(note)
+        oracle_controller.scheduler.join()
+
+        oracle_controller.process_notes(None, [])
+        assert 1 not in oracle_controller.notemap
+        assert 1 not in oracle_db.records()
+        assert oracle_db.xdb.get_doccount() == 0
+
+    def test_failed_write_is_forgotten(self, note, oracle_controller,
+                                       oracle_db, monkeypatch):
+        def fail(*_):
+            raise xapian.DatabaseError("disk full")
+        monkeypatch.setattr(oracle_db, "replace_note", fail)
+        oracle_controller.index_note(note)
+        oracle_controller.scheduler.join()
+        oracle_controller.writer.flush()
+        assert 1 not in oracle_controller.notemap
+        assert 1 not in oracle_controller.digests.get(
+            oracle_controller.providers["foo"].document_digest(note.url),
+            ())
+
+    def test_failed_write_leaves_completions(self, note, oracle_controller,
+                                             oracle_db, monkeypatch):
+        def fail(*_):
+            raise xapian.DatabaseError("disk full")
+        # Fails after the completions of the document have been worked out.
+        monkeypatch.setattr(oracle_db, "set_record", fail)
+        oracle_controller.index_note(note)
+        oracle_controller.scheduler.join()
+        oracle_controller.writer.flush()
+        assert oracle_controller.completions.complete("ba") == []
+
+    def test_missing_file_is_checked_again(self, campaign_db, oracle_db,
+                                           tmpdir):
+        class ExistingFileProvider(FileProvider):
+            def is_acceptable_document(self, path):
+                return os.path.exists(path)
+
+        provider = ExistingFileProvider()
+        controller = OracleController(DummyChannel(), campaign_db, oracle_db,
+                                      {"txt": provider})
+        path = tmpdir.join("handout.txt")
+        url = "file://" + str(path)
+        assert controller.provider_for(url) is None
+        path.write("the lich lives")
+        assert controller.provider_for(url) is provider
+
+    def test_sync_follows_change_log(self, oracle_controller, campaign_db):
+        oracle_controller.sync_notes()
+        oracle_controller.scheduler.join()
+        assert 1 in oracle_controller.notemap
+
+        session = sessionmaker(bind=campaign_db)()
+        session.delete(session.query(Note).get(1))
+        session.commit()
+
+        oracle_controller.sync_notes()
+        assert 1 not in oracle_controller.notemap
+        assert session.query(NoteChange).count() == 0
+
+    def test_sync_survives_locked_database(self, oracle_controller,
+                                           campaign_db, monkeypatch):
+        oracle_controller.sync_notes()
+        oracle_controller.scheduler.join()
+        session = sessionmaker(bind=campaign_db)()
+        session.delete(session.query(Note).get(1))
+        session.commit()
+
+        def locked(*_):
+            raise OperationalError("DELETE", {}, "database is locked")
+        monkeypatch.setattr(oracle_controller, "remove_note", locked)
+        oracle_controller.sync_notes()
+        assert 1 in oracle_controller.notemap
+
+        monkeypatch.undo()
+        oracle_controller.sync_notes()
+        assert 1 not in oracle_controller.notemap
+        assert session.query(NoteChange).count() == 0
+
+    def test_idle_sync_skips_entities(self, oracle_controller, campaign_db,
+                                      monkeypatch):
+        refreshed = []
+        set_entities = oracle_controller.completions.set_entities
+        monkeypatch.setattr(
+            oracle_controller.completions, "set_entities",
+            lambda kind, names: refreshed.append(kind)
+            or set_entities(kind, names))
+        oracle_controller.sync_notes()
+        assert "note" in refreshed
+        del refreshed[:]
+        oracle_controller.sync_notes()
+        assert [] == refreshed
+
+        session = sessionmaker(bind=campaign_db)()
+        session.add(Note(name="Bestiary"))
+        session.commit()
+        oracle_controller.sync_notes()
+        assert ["note"] == refreshed
+        oracle_controller.scheduler.join()
+
+    def test_internal_notes(self, oracle_controller, campaign_db):
+        session = sessionmaker(bind=campaign_db)()
+        note = Note(name="Plot")
+        session.add(note)
+        session.flush()
+        session.add(InternalNote(note_id=note.id, text="the lich lives"))
+        session.commit()
+
+        oracle_controller.sync_notes()
+        oracle_controller.scheduler.join()
+        record = oracle_controller.notemap[note.id]
+        assert record["url"] is None
+
+        # Unchanged text is not indexed again.
+        oracle_controller.checked.clear()
+        oracle_controller.process_notes(session, session.query(Note).all())
+        queued = [job["note"] for job in oracle_controller.scheduler.queue()]
+        assert note.id not in queued
+        oracle_controller.scheduler.join()
+
+        session.query(InternalNote).filter_by(note_id=note.id) \
+            .update({"text": "the lich is dead"})
+        session.commit()
+        oracle_controller.sync_notes()
+        oracle_controller.scheduler.join()
+        assert oracle_controller.notemap[note.id]["digest"] != record["digest"]
+
+    def test_identical_notes_share_a_document(self, oracle_controller,
+                                              oracle_db, campaign_db):
+        session = sessionmaker(bind=campaign_db)()
+        session.add_all([Note(name="Handout", url="foo://handout"),
+                         Note(name="Handout again", url="foo://copy")])
+        session.commit()
+
+        extracted = []
+        provider = oracle_controller.providers["foo"]
+        extract = provider.extract_document_pages
+        provider.extract_document_pages = \
+            lambda url: extracted.append(url) or extract(url)
+        oracle_controller.sync_notes()
+        oracle_controller.scheduler.join()
+        assert len(extracted) == 1
+        assert oracle_db.xdb.get_doccount() == 1
+        docid = oracle_db.find_document(oracle_db.note_term(3))
+        assert docid == oracle_db.find_document(oracle_db.note_term(1))
+        assert oracle_db.document_data(docid)["notes"] == [1, 2, 3]
+
+        oracle_controller.remove_note(1)
+        oracle_controller.remove_note(2)
+        assert oracle_db.xdb.get_doccount() == 1
+        assert oracle_db.document_data(docid)["url"] == "foo://copy"
+        oracle_controller.remove_note(3)
+        assert oracle_db.xdb.get_doccount() == 0
+
+    def test_shared_index(self, note, campaign_db, oracle_db, provider,
+                          tmpdir, monkeypatch):
+        monkeypatch.setattr(OracleController, "shared_providers", ("foo",))
+        path = str(tmpdir.join("shared.db"))
+        shared = OracleDatabase(
+            xapian.WritableDatabase(path, xapian.DB_CREATE), path)
+        controller = OracleController(DummyChannel(), campaign_db, oracle_db,
+                                      {"foo": provider}, shared)
+        controller.index_note(note)
+        controller.scheduler.join()
+        assert oracle_db.xdb.get_doccount() == 0
+        assert shared.xdb.get_doccount() == 1
+        assert controller.notemap[1]["shared"]
+
+        # Another campaign of the game system finds the document there.
+        path = str(tmpdir.join("other.db"))
+        other_db = OracleDatabase(
+            xapian.WritableDatabase(path, xapian.DB_CREATE), path)
+        other = OracleController(DummyChannel(), campaign_db, other_db,
+                                 {"foo": provider}, shared)
+        # Only the words of its own documents are completed.
+        assert other.completions.complete("ba") == []
+        extracted = []
+        extract = provider.extract_document_pages
+        provider.extract_document_pages = \
+            lambda url: extracted.append(url) or extract(url)
+        other.index_note(note)
+        other.scheduler.join()
+        assert not extracted
+        assert shared.xdb.get_doccount() == 1
+        response = other.searcher.search(1, "baz")
+        assert [r["notes"] for r in response["results"]] == [[1]]
+        other.flush_if_idle()
+        assert ("baz", "term") in other.completions.complete("ba")
+
+    def test_unused_shared_documents_are_pruned(self, tmpdir):
+        path = str(tmpdir.join("shared.db"))
+        shared = OracleDatabase(
+            xapian.WritableDatabase(path, xapian.DB_CREATE), path)
+        for digest in ("old", "new"):
+            document = xapian.Document()
+            document.set_data("{}")
+            shared.add_shared(digest, document)
+        shared.touch_shared(["old"], now=1000)
+        assert shared.prune_shared(max_age=60, now=2000) == ["old"]
+        assert shared.shared_digests() == {"new"}
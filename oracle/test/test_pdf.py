@@ -0,0 +1,40 @@
+import pytest
+
+from oracle.corpus import pdf_document
+from oracle.provider.pdf import Provider, text_pages
+
+
+@pytest.fixture
+def pdf_provider():
+    provider = Provider(max_workers=2)
+    yield provider
+    provider.shutdown()
+
+
+@pytest.mark.parametrize('npages,expected', [
+    (0, []),
+    (3, [(0, 3)]),
+    (8, [(0, 8)]),
+    (20, [(0, 8), (8, 16), (16, 20)]),
+])
+def test_page_ranges(pdf_provider, npages, expected):
+    assert pdf_provider.page_ranges(npages) == expected
+
+
+def test_pdf_text(pdf_provider):
+    with open("resources/test/libreoffice_pdf.pdf", 'rb') as f:
+        text = pdf_provider.pdf_text(f)
+    assert text.startswith("Here is a test document written in LibreOffice")
+
+
+@pytest.mark.parametrize('fast', [False, True])
+def test_pages_without_text_are_skipped(pdf_provider, tmpdir, fast):
+    path = str(tmpdir.join("map.pdf"))
+    with open(path, 'wb') as f:
+        f.write(pdf_document([["The dungeon"], None, ["The tower"]]))
+    pdf_provider.fast = fast
+    pages = list(pdf_provider.iter_pages(path))
+    assert [page.strip() for page in pages] == ["The dungeon", "", "The tower"]
+    assert pdf_provider.pages_skipped == 1
+    with open(path, 'rb') as f:
+        assert text_pages(f, 0, 3) == {0, 2}
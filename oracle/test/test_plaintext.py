@@ -0,0 +1,92 @@
+import pytest
+
+from oracle.provider.plaintext import Provider, detect_encoding
+
+
+@pytest.fixture
+def text_provider():
+    return Provider()
+
+
+def write(tmpdir, name, text, encoding="utf-8"):
+    path = tmpdir.join(name)
+    path.write_binary(text.encode(encoding))
+    return str(path)
+
+
+@pytest.mark.parametrize('data,expected', [
+    (b"plain ascii", "utf-8"),
+    ("café".encode(), "utf-8"),
+    ("café".encode("cp1252"), None),
+    ("café".encode("utf-16"), "utf-16"),
+    (b"\xef\xbb\xbfbom", "utf-8-sig"),
+])
+def test_detect_encoding(data, expected):
+    encoding = detect_encoding(data)
+    if expected is None:
+        assert data.decode(encoding) == "café"
+    else:
+        assert encoding == expected
+
+
+def test_chunks_end_on_lines(text_provider, tmpdir):
+    text_provider.chunk_size = 16
+    lines = ["line number %d\n" % i for i in range(50)]
+    path = write(tmpdir, "log.txt", ''.join(lines))
+    pages = list(text_provider.extract_document_pages("file://" + path))
+    assert len(pages) > 1
+    assert all(page.endswith('\n') for page in pages)
+    assert ''.join(pages) == ''.join(lines)
+
+
+def test_truncated_sample():
+    assert detect_encoding("café".encode()[:4], truncated=True) == "utf-8"
+
+
+def test_multibyte_characters_across_chunks(text_provider, tmpdir):
+    text_provider.chunk_size = 5
+    text = "ééé üüü\n" * 10
+    path = write(tmpdir, "notes.txt", text)
+    assert text_provider.extract_file_text(path) == text
+
+
+def test_empty_file(text_provider, tmpdir):
+    path = write(tmpdir, "empty.txt", "")
+    assert list(text_provider.extract_file_pages(path)) == []
+
+
+def test_markdown(text_provider, tmpdir):
+    path = write(tmpdir, "session.md",
+                 "# Session 1\n"
+                 "The party met **Strahd** at [the castle](castle.md).\n"
+                 "```\n"
+                 "*not emphasis*\n"
+                 "```\n")
+    assert text_provider.extract_file_text(path) == (
+        "Session 1\n"
+        "The party met Strahd at the castle.\n"
+        "\n"
+        "*not emphasis*\n"
+        "\n")
+
+
+def test_restructured_text(text_provider, tmpdir):
+    path = write(tmpdir, "npcs.rst",
+                 "NPCs\n"
+                 "====\n"
+                 ".. note:: Secret\n"
+                 "See :ref:`villains` and `the wiki <http://x>`_.\n")
+    assert text_provider.extract_file_text(path) == (
+        "NPCs\n"
+        "\n"
+        " Secret\n"
+        "See villains and the wiki.\n")
+
+
+def test_is_acceptable_document(text_provider, tmpdir):
+    assert text_provider.is_acceptable_document(
+        write(tmpdir, "a.md", "# hi"))
+    assert text_provider.is_acceptable_document(
+        write(tmpdir, "README", "hello there\n"))
+    assert not text_provider.is_acceptable_document(
+        "resources/test/libreoffice_pdf.pdf")
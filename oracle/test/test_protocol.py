@@ -0,0 +1,79 @@
+from multiprocessing import Pipe
+
+import pytest
+
+from oracle.exceptions import ProtocolError
+from oracle.protocol import Channel, Message, RingBuffer, EVENT, REQUEST, \
+    RESPONSE
+
+
+def test_round_trip():
+    a, b = Pipe()
+    sender, receiver = Channel(a), Channel(b)
+    sender.send(REQUEST, "search", 7, {"query": "fireball", "offset": 0,
+                                       "limit": 10})
+    sender.send(EVENT, "terminated")
+    assert receiver.poll(1)
+    assert receiver.recv() == Message(REQUEST, "search", 7, {
+        "query": "fireball", "offset": 0, "limit": 10})
+    assert receiver.recv() == Message(EVENT, "terminated", 0, None)
+
+
+def test_large_payloads_use_ring(tmpdir):
+    path = str(tmpdir.join("ring"))
+    a, b = Pipe()
+    sender = Channel(a, RingBuffer.create(path, size=64), ring_writer=True)
+    receiver = Channel(b, RingBuffer.open(path))
+    sender.ring_threshold = 16
+    payload = {"results": ["x" * 8] * 2}
+    for request_id in range(10):
+        # Each payload is written to, and freed from, the ring in turn, so
+        # that it wraps around several times.
+        sender.send(RESPONSE, "search", request_id, payload)
+        assert sender.ring.counters()[0] > 0
+        assert receiver.recv() == Message(RESPONSE, "search", request_id,
+                                          payload)
+    written, consumed = receiver.ring.counters()
+    assert written == consumed > 64
+
+
+def test_full_ring_falls_back_to_pipe(tmpdir):
+    path = str(tmpdir.join("ring"))
+    a, b = Pipe()
+    sender = Channel(a, RingBuffer.create(path, size=16), ring_writer=True)
+    receiver = Channel(b, RingBuffer.open(path))
+    sender.ring_threshold = 1
+    payload = "y" * 100
+    sender.send(RESPONSE, "queue", 1, payload)
+    assert sender.ring.counters() == (0, 0)
+    assert receiver.recv().payload == payload
+
+
+def test_only_the_oracle_writes_to_the_ring(tmpdir):
+    path = str(tmpdir.join("ring"))
+    a, b = Pipe()
+    delphi = Channel(a, RingBuffer.create(path, size=64))
+    oracle = Channel(b, RingBuffer.open(path), ring_writer=True)
+    delphi.ring_threshold = oracle.ring_threshold = 16
+    names = ["pin {}".format(i) for i in range(100)]
+    delphi.send(REQUEST, "entities", 1, {"kind": "pin", "names": names})
+    assert delphi.ring.counters() == (0, 0)
+    assert oracle.recv().payload["names"] == names
+    oracle.send(RESPONSE, "search", 2, {"results": ["x" * 8] * 2})
+    assert delphi.recv().request_id == 2
+    written, consumed = delphi.ring.counters()
+    assert written == consumed > 0
+
+
+def test_malformed_frames():
+    a, b = Pipe()
+    receiver = Channel(b)
+    a.send_bytes(b"\x01\x00")
+    with pytest.raises(ProtocolError):
+        receiver.recv()
+    a.send_bytes(b"\x01\x00\xff\xff\x00\x00\x00\x01\x00\x00\x00\x00")
+    with pytest.raises(ProtocolError):
+        receiver.recv()
+    a.close()
+    with pytest.raises(EOFError):
+        receiver.recv()
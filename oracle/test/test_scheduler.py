@@ -0,0 +1,87 @@
+from threading import Event
+
+from oracle.exceptions import IndexingCancelled
+from oracle.scheduler import IndexScheduler
+
+
+def blocked_scheduler():
+    """A scheduler whose only worker is stuck on a job until released."""
+    scheduler = IndexScheduler()
+    started, release = Event(), Event()
+
+    def block(job):
+        started.set()
+        release.wait()
+
+    scheduler.submit(0, block)
+    assert started.wait(5)
+    return scheduler, release
+
+
+def test_priority_order():
+    scheduler, release = blocked_scheduler()
+    order = []
+
+    def record(job):
+        order.append(job.note_id)
+
+    scheduler.submit(1, record, size=100)
+    scheduler.submit(2, record, size=10)
+    scheduler.submit(3, record, size=1000, recent=True)
+    scheduler.submit(4, record, size=5000)
+    scheduler.boost([4])
+    release.set()
+    assert scheduler.join(5)
+    assert order == [4, 3, 2, 1]
+    scheduler.shutdown()
+
+
+def test_resubmit_cancels_queued_job():
+    scheduler, release = blocked_scheduler()
+    calls = []
+    first = scheduler.submit(1, lambda job: calls.append("first"))
+    scheduler.submit(1, lambda job: calls.append("second"))
+    assert first.is_cancelled()
+    assert scheduler.pending == 2
+    release.set()
+    assert scheduler.join(5)
+    assert calls == ["second"]
+    scheduler.shutdown()
+
+
+def test_cancel_running_job():
+    scheduler = IndexScheduler()
+    started = Event()
+    results = []
+
+    def work(job):
+        started.set()
+        while not job.is_cancelled():
+            job._cancelled.wait(0.01)
+        raise IndexingCancelled(job.note_id)
+
+    def done(job):
+        try:
+            job.result()
+        except IndexingCancelled:
+            results.append("cancelled")
+
+    scheduler.submit(1, work, callback=done)
+    assert started.wait(5)
+    scheduler.cancel(1)
+    assert scheduler.join(5)
+    assert results == ["cancelled"]
+    scheduler.shutdown()
+
+
+def test_queue():
+    scheduler, release = blocked_scheduler()
+    scheduler.submit(1, lambda job: None, size=10)
+    scheduler.submit(2, lambda job: None, size=5, recent=True)
+    queue = scheduler.queue()
+    assert [entry["note"] for entry in queue] == [0, 2, 1]
+    assert queue[0]["running"]
+    release.set()
+    assert scheduler.join(5)
+    assert scheduler.queue() == []
+    scheduler.shutdown()
@@ -1,2 +1,95 @@
-class TestSearcher:
-    pass
+import pytest
+import xapian
+
+from oracle.index import Indexer
+from oracle.search import ResultCache, Searcher
+from oracle.test.conftest import FooProvider
+
+
+@pytest.fixture
+def searcher(campaign_db, oracle_db, note):
+    provider = FooProvider("nothing to see\fthe wizard casts fireball\fdone")
+    document, note_id = Indexer().index_note(provider, note)
+    oracle_db.replace_note(note_id, document, {})
+    oracle_db.xdb.commit()
+    return Searcher(xapian.Stem("english"), oracle_db, lambda _: None,
+                    lambda data, page: provider.document_page(None, page))
+
+
+def test_search_response(searcher, note):
+    response = searcher.search(7, "fireball")
+    assert response["id"] == 7
+    assert response["error"] is None
+    assert response["estimated"] == 1
+    assert response["latency"] >= 0
+    result, = response["results"]
+    assert result["note"] == note.id
+    assert result["notes"] == [note.id]
+    assert result["rank"] == 0
+    assert result["page"] == 1
+    assert "fireball" in result["snippet"]
+
+
+def test_search_pagination(searcher):
+    response = searcher.search(0, "fireball", offset=1, limit=10)
+    assert response["estimated"] == 1
+    assert response["results"] == []
+
+
+@pytest.mark.parametrize("error", [xapian.DatabaseOpeningError("gone"),
+                                   ValueError("bad document data")])
+def test_search_errors_are_answered(searcher, monkeypatch, error):
+    def fail(*_):
+        raise error
+    monkeypatch.setattr(searcher, "run_query", fail)
+    response = searcher.search(3, "fireball")
+    assert response["id"] == 3
+    assert response["error"]
+    assert response["results"] == []
+
+
+def test_snapshot_reopened_after_commit(searcher, oracle_db):
+    assert searcher.search(0, "dragon")["estimated"] == 0
+    other = FooProvider("here be dragon")
+    note = type("Note", (), {"id": 2, "url": "foo://dragon"})()
+    document, note_id = Indexer().index_note(other, note)
+    with oracle_db.lock:
+        oracle_db.replace_note(note_id, document, {})
+        oracle_db.xdb.commit()
+    # Without a new revision, the old snapshot is still used.
+    assert searcher.search(0, "dragon")["estimated"] == 0
+    oracle_db.committed()
+    assert searcher.search(0, "dragon")["estimated"] == 1
+
+
+def test_shared_document_lists_every_note(campaign_db, oracle_db, note):
+    provider = FooProvider("the wizard casts fireball")
+    document, note_id = Indexer().index_note(provider, note)
+    oracle_db.replace_note(note_id, document, {"digest": "abc"})
+    assert oracle_db.link_note(5, {"digest": "abc"})
+    assert not oracle_db.link_note(6, {"digest": "def"})
+    oracle_db.xdb.commit()
+    searcher = Searcher(xapian.Stem("english"), oracle_db, lambda _: None)
+    result, = searcher.search(0, "fireball")["results"]
+    assert result["notes"] == [note.id, 5]
+
+
+def test_repeated_query_is_cached(searcher):
+    first = searcher.search(0, "fireball")
+    second = searcher.search(1, "  fireball ")
+    assert second["id"] == 1
+    assert second["results"] == first["results"]
+    assert searcher.cache.hits == 1
+
+
+def test_result_cache_revisions():
+    cache = ResultCache(max_entries=2)
+    cache.put("a", 1, "A")
+    cache.put("b", 1, "B")
+    cache.put("c", 1, "C")
+    assert cache.get("a", 1) is None
+    assert cache.get("c", 1) == "C"
+    assert cache.get("c", 2) is None
+    # Stale results must not repopulate the cache.
+    cache.put("c", 1, "C")
+    assert cache.get("c", 2) is None
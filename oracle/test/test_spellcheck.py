@@ -0,0 +1,57 @@
+import pytest
+
+from oracle.spellcheck import SpellChecker
+
+
+class Corrector:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, word):
+        self.calls.append(word)
+        return {"teh": "the", "orcz": "orcs"}.get(word, word)
+
+
+@pytest.fixture
+def corrector():
+    return Corrector()
+
+
+@pytest.fixture
+def checker(corrector):
+    return SpellChecker(corrector, vocabulary={"the", "goblin"}, memo_size=2)
+
+
+def test_corrections(checker):
+    assert checker.spellchecked("teh goblin") == "the goblin"
+
+
+def test_whitespace_and_punctuation_preserved(checker):
+    text = "  (teh)\n\n\"orcz!\"\tgoblin "
+    assert checker.spellchecked(text) == "  (the)\n\n\"orcs!\"\tgoblin "
+
+
+@pytest.mark.parametrize('token', ["d4", "2d6", "1d20+3", "&", "--", "DM",
+                                   "UTF-8", "42"])
+def test_protected(checker, corrector, token):
+    assert checker.spellchecked(token) == token
+    assert not corrector.calls
+
+
+def test_vocabulary_pass_through(checker, corrector):
+    checker.spellchecked("The GOBLIN")
+    assert not corrector.calls
+
+
+def test_memo(checker, corrector):
+    checker.spellchecked("teh teh orcz")
+    checker.spellchecked("teh orcz")
+    assert sorted(corrector.calls) == ["orcz", "teh"]
+    assert checker.hit_rate == pytest.approx(0.5)
+
+
+def test_memo_is_bounded(checker, corrector):
+    for word in ["teh", "orcz", "foo", "teh"]:
+        checker.spellchecked(word)
+    assert len(checker.memo) == 2
+    assert corrector.calls.count("teh") == 2
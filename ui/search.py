@@ -15,7 +15,7 @@
 # along with dmclient.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from PyQt5.QtCore import QSize, Qt
+from PyQt5.QtCore import QSize, QStringListModel, Qt
 from PyQt5.QtWidgets import *
 
 from widgets import ProgressIndicator
@@ -37,6 +37,28 @@ class SearchCompleter(QCompleter):
     def __init__(self):
         super().__init__()
         self.setCompletionMode(QCompleter.PopupCompletion)
+        self.setCaseSensitivity(Qt.CaseInsensitive)
+        self.completions = QStringListModel(self)
+        self.setModel(self.completions)
+
+    @staticmethod
+    def last_word(text):
+        """:return: The word being typed at the end of ``text``."""
+        if not text or text[-1].isspace():
+            return ""
+        return text.split()[-1]
+
+    def set_completions(self, text, completions):
+        """
+        :param text: The text being completed.
+        :param completions: A list of ``(completion, kind)`` pairs for the
+                            last word of ``text``.
+        """
+        head = text[:len(text) - len(self.last_word(text))]
+        self.completions.setStringList(
+            [head + completion for completion, _ in completions])
+        if completions and self.widget() and self.widget().hasFocus():
+            self.complete()
 
     def showIndexingBlurb(self):
         pass
@@ -59,6 +81,7 @@ class SearchResultsView(QAbstractItemView):
         text = QLabel(self.grey_text("dmclient is indexing your documents..."))
         text.setTextFormat(Qt.RichText)
         layout.addWidget(text)
+        self.indexing_text = text
 
         layout.addSpacerItem(
                 QSpacerItem(4, 4, QSizePolicy.Expanding, QSizePolicy.Minimum))
@@ -67,6 +90,33 @@ class SearchResultsView(QAbstractItemView):
         self.indexing_blurb.setLayout(layout)
         self.indexing_blurb.hide()
 
+    def set_indexing_progress(self, progress):
+        """
+        :param progress: The indexing metrics published by the oracle, see
+                         ``oracle.metrics.IndexingMetrics.snapshot()``.
+        """
+        if not progress.get("queue_depth"):
+            self.indexing_blurb.hide()
+            return
+        self.indexing_text.setText(
+            self.grey_text(self.indexing_blurb_text(progress)))
+        self.indexing_blurb.show()
+
+    @staticmethod
+    def indexing_blurb_text(progress):
+        pending = progress["queue_depth"]
+        total = progress.get("indexed", 0) + pending
+        text = "dmclient is indexing your documents ({} of {})".format(
+            total - pending, total)
+        eta = progress.get("eta")
+        if eta is None:
+            return text + "..."
+        if eta < 60:
+            return text + ", less than a minute left..."
+        minutes = round(eta / 60)
+        return text + ", about {} minute{} left...".format(
+            minutes, "" if minutes == 1 else "s")
+
     @staticmethod
     def grey_text(text):
         return (